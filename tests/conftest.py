@@ -0,0 +1,63 @@
+"""
+The checker's modules import each other by their plain names and read their
+config from the environment on import (see bench.py), so both are set up here
+before any test imports them.
+
+Tests that need Postgres take the `db` fixture. They only run when
+VISA_CHECKER_TEST_DB_NAME names a scratch database, since every table in it is
+emptied before each of them. The host and credentials come from the usual
+VISA_CHECKER_DB_* variables.
+
+    VISA_CHECKER_TEST_DB_NAME=visa_checker_test poetry run pytest
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [_ROOT, os.path.join(_ROOT, "visa_checker")]
+
+_TEST_DB_NAME = os.environ.get("VISA_CHECKER_TEST_DB_NAME")
+if _TEST_DB_NAME:
+    os.environ["VISA_CHECKER_DB_NAME"] = _TEST_DB_NAME
+
+for name, value in {
+    "VISA_CHECKER_NTFY_TOPIC": "tests",
+    "VISA_CHECKER_APP_USER_EMAIL": "tests@example.com",
+    "VISA_CHECKER_APP_USER_PW": "tests",
+    "VISA_CHECKER_DB_NAME": "visa_checker_test",
+    "VISA_CHECKER_DB_HOST": "localhost",
+    "VISA_CHECKER_DB_USER": "postgres",
+    "VISA_CHECKER_DB_PW": "",
+    "VISA_CHECKER_PREFERRED_DATE_RULES": "[]",
+}.items():
+    os.environ.setdefault(name, value)
+
+os.environ["VISA_CHECKER_SESSION_STATE_DIR"] = tempfile.mkdtemp()
+
+
+@pytest.fixture
+def db():
+    """
+    Empty scratch database with every table created, and nothing cached about it.
+    """
+    if not _TEST_DB_NAME:
+        pytest.skip("VISA_CHECKER_TEST_DB_NAME isn't set")
+
+    from db import create_db_connection, create_tables
+    from repo import invalidate_last_known_dates
+
+    create_tables()
+    with create_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT tablename FROM pg_tables WHERE schemaname = 'public'")
+            tables = [table for (table,) in cur.fetchall()]
+            cur.execute(f"TRUNCATE {', '.join(tables)} RESTART IDENTITY")
+    conn.close()
+
+    invalidate_last_known_dates()
+    yield
+    invalidate_last_known_dates()
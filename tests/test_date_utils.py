@@ -0,0 +1,110 @@
+import datetime
+
+import pytest
+
+from date_utils import Availability
+
+DATES = ["2024-02-28", "2024-02-29", "2024-03-01", "2031-12-31"]
+
+
+def test_availability_iterates_sorted_date_strings():
+    availability = Availability.from_dates(reversed(DATES))
+
+    assert list(availability) == DATES
+    assert list(availability.dates()) == [datetime.date.fromisoformat(d) for d in DATES]
+    assert len(availability) == 4
+    assert availability.first() == datetime.date(2024, 2, 28)
+
+
+def test_availability_accepts_dates_and_strings():
+    assert Availability.from_dates(DATES) == Availability.from_dates(
+        datetime.date.fromisoformat(d) for d in DATES
+    )
+    assert Availability.from_dates([datetime.datetime(2024, 2, 29, 12)]) == (
+        Availability.from_dates(["2024-02-29"])
+    )
+
+
+@pytest.mark.parametrize(
+    "dates",
+    [
+        [],
+        ["2020-01-01"],
+        ["2024-03-01"],
+        DATES,
+        [f"2025-01-{day:02}" for day in range(1, 32)],
+    ],
+)
+def test_availability_bytes_round_trip(dates):
+    availability = Availability.from_dates(dates)
+
+    assert Availability.from_bytes(availability.to_bytes()) == availability
+    assert list(Availability.from_bytes(availability.to_bytes())) == dates
+
+
+def test_availability_bytes_skip_leading_empty_days():
+    near = Availability.from_dates(["2020-01-01", "2020-01-02"])
+    far = Availability.from_dates(["2040-01-01", "2040-01-02"])
+
+    assert len(far.to_bytes()) == len(near.to_bytes())
+
+
+def test_empty_availability():
+    assert not Availability()
+    assert Availability().to_bytes() == b""
+    assert Availability.from_bytes(b"") == Availability()
+
+    with pytest.raises(ValueError):
+        Availability().first()
+
+
+def test_availability_set_operations():
+    a = Availability.from_dates(["2025-01-01", "2025-01-02"])
+    b = Availability.from_dates(["2025-01-02", "2025-01-03"])
+
+    assert list(a | b) == ["2025-01-01", "2025-01-02", "2025-01-03"]
+    assert list(a & b) == ["2025-01-02"]
+    assert list(a - b) == ["2025-01-01"]
+    assert a.with_date("2025-01-03") == a | b
+    assert (a | b).without_date("2025-01-02") == Availability.from_dates(
+        ["2025-01-01", "2025-01-03"]
+    )
+
+
+def test_availability_contains():
+    availability = Availability.from_dates(DATES)
+
+    assert "2024-02-29" in availability
+    assert datetime.date(2031, 12, 31) in availability
+    assert "2024-03-02" not in availability
+    # Before the bitset's epoch
+    assert "2019-12-31" not in availability
+
+
+def test_availability_ranges():
+    assert list(Availability.between("2025-01-30", "2025-02-02")) == [
+        "2025-01-30",
+        "2025-01-31",
+        "2025-02-01",
+        "2025-02-02",
+    ]
+    assert Availability.between("2025-02-02", "2025-01-30") == Availability()
+    assert "2025-01-31" in Availability.before("2025-02-01")
+    assert "2025-02-01" not in Availability.before("2025-02-01")
+    assert Availability.before("2020-01-01") == Availability()
+
+
+def test_availability_on_weekdays():
+    january = Availability.between("2025-01-01", "2025-01-31")
+
+    mondays = january.on_weekdays([0])
+    assert list(mondays) == ["2025-01-06", "2025-01-13", "2025-01-20", "2025-01-27"]
+
+    weekend = january.on_weekdays([5, 6])
+    assert len(weekend) == 8
+    assert all(d.weekday() >= 5 for d in weekend.dates())
+
+
+def test_availability_rejects_dates_before_epoch():
+    with pytest.raises(ValueError):
+        Availability.from_dates(["2019-12-31"])
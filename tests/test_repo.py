@@ -0,0 +1,90 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from analytics import get_release_profile
+from config import CITIES
+from date_utils import Availability
+from db import pooled_connection
+from repo import get_last_known_dates, invalidate_last_known_dates, record_new_dates
+
+CITY = CITIES["94"]
+
+
+def _fetch(query: str, *params) -> list[tuple]:
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            return cur.fetchall()
+
+
+def _open_slots() -> list[str]:
+    return [
+        date.isoformat()
+        for (date,) in _fetch(
+            "SELECT date FROM open_slots WHERE city_id = %s ORDER BY date", CITY.id
+        )
+    ]
+
+
+def _slot_lifetimes() -> int:
+    return sum(
+        slots
+        for (slots,) in _fetch(
+            "SELECT slots FROM slot_lifetime_stats WHERE city_id = %s", CITY.id
+        )
+    )
+
+
+def test_record_new_dates_appear_disappear_cycle(db):
+    first = Availability.from_dates(["2030-01-02", "2030-01-03"])
+    assert record_new_dates(CITY, first) == first
+    assert _open_slots() == ["2030-01-02", "2030-01-03"]
+    # What was there before any history isn't a release
+    assert sum(get_release_profile().get(CITY.id, [])) == 0
+
+    assert record_new_dates(CITY, first) == Availability()
+
+    second = Availability.from_dates(["2030-01-03", "2030-01-04"])
+    assert record_new_dates(CITY, second) == Availability.from_dates(["2030-01-04"])
+    assert _open_slots() == ["2030-01-03", "2030-01-04"]
+    assert _slot_lifetimes() == 1
+    assert sum(get_release_profile()[CITY.id]) == 1
+
+    assert record_new_dates(CITY, Availability()) == Availability()
+    assert _open_slots() == []
+    assert _slot_lifetimes() == 3
+
+    events = _fetch(
+        "SELECT date, kind FROM availability_events WHERE city_id = %s ORDER BY id",
+        CITY.id,
+    )
+    assert [(date.isoformat(), kind) for date, kind in events] == [
+        ("2030-01-02", "appeared"),
+        ("2030-01-03", "appeared"),
+        ("2030-01-04", "appeared"),
+        ("2030-01-02", "disappeared"),
+        ("2030-01-03", "disappeared"),
+        ("2030-01-04", "disappeared"),
+    ]
+
+    invalidate_last_known_dates()
+    assert get_last_known_dates(CITY) == Availability()
+
+
+def test_concurrent_checks_record_a_change_once(db):
+    dates = Availability.from_dates(["2030-01-02"])
+    record_new_dates(CITY, Availability())
+    barrier = threading.Barrier(8)
+
+    def record():
+        barrier.wait()
+        return record_new_dates(CITY, dates)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: record(), range(8)))
+
+    assert results.count(dates) == 1
+    assert results.count(Availability()) == 7
+    assert _fetch(
+        "SELECT count(*) FROM availability_events WHERE city_id = %s", CITY.id
+    ) == [(1,)]
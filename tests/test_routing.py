@@ -0,0 +1,76 @@
+import pytest
+
+from routing import ResourceBlocker
+
+SITE = "https://ais.usvisa-info.com"
+
+
+@pytest.fixture
+def blocker() -> ResourceBlocker:
+    return ResourceBlocker(
+        blocked_extensions=["png", "jpg", "woff2"],
+        allowed_domains=["usvisa-info.com"],
+        allowed_url_patterns=["jquery", "ui-icons"],
+    )
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        f"{SITE}/en-ca/niv/schedule/123/appointment/days/94.json?expedite=false",
+        f"{SITE}/en-ca/niv/schedule/123/appointment",
+        f"{SITE}/assets/application.css",
+        f"{SITE}/assets/application.js?v=1.png",
+        f"{SITE}/assets/jquery-ui/ui-icons_444444_256x240.png",
+        "https://code.jquery.com/jquery-3.7.1.min.js",
+        "https://cdn.usvisa-info.com/scripts/app.js",
+        "HTTPS://AIS.USVISA-INFO.COM/en-ca/niv/users/sign_in",
+        "https://ais.usvisa-info.com:8443/en-ca/niv/users/sign_in",
+    ],
+)
+def test_allowed_urls(blocker, url):
+    assert blocker.url_regex.search(url) is None
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        f"{SITE}/assets/logo.png",
+        f"{SITE}/assets/logo.PNG?v=2",
+        f"{SITE}/assets/photo.jpg#top",
+        f"{SITE}/fonts/icons.woff2",
+        "https://www.google-analytics.com/analytics.js",
+        "https://usvisa-info.com.evil.com/script.js",
+        "https://notusvisa-info.com/script.js",
+    ],
+)
+def test_blocked_urls(blocker, url):
+    assert blocker.url_regex.search(url) is not None
+
+
+def test_nothing_to_block():
+    blocker = ResourceBlocker([], [], [])
+
+    assert blocker.url_regex.search(f"{SITE}/assets/logo.png") is None
+
+
+class _Route:
+    def __init__(self, resource_type: str):
+        self.request = type("Request", (), {"resource_type": resource_type})()
+        self.aborted_with = None
+
+    def abort(self, error_code: str):
+        self.aborted_with = error_code
+
+
+def test_blocked_requests_are_counted(blocker):
+    routes = [_Route("image"), _Route("image"), _Route("font")]
+
+    for route in routes:
+        blocker.handle(route)
+
+    assert [route.aborted_with for route in routes] == ["blockedbyclient"] * 3
+    stats = blocker.stats()
+    assert stats["blocked"] == {"image": 2, "font": 1}
+    assert stats["blocked_total"] == 3
+    assert stats["estimated_bytes_saved"] > 0
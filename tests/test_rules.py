@@ -0,0 +1,100 @@
+import datetime
+
+import pytest
+
+from date_utils import Availability
+from rules import PreferredDateRules
+
+CURRENT_APPOINTMENT = datetime.datetime(2030, 6, 1)
+# 2030-01-01 is a Tuesday
+JANUARY = Availability.between("2030-01-01", "2030-01-31")
+
+
+def _preferred(rules: list[dict], city_id: str = "94", dates=JANUARY) -> list[str]:
+    return list(
+        PreferredDateRules(rules).preferred_dates(city_id, dates, CURRENT_APPOINTMENT)
+    )
+
+
+def test_no_rules_prefer_nothing():
+    assert _preferred([]) == []
+
+
+def test_before_is_exclusive():
+    assert _preferred([{"before": "2030-01-04"}]) == [
+        "2030-01-01",
+        "2030-01-02",
+        "2030-01-03",
+    ]
+
+
+def test_after_is_exclusive():
+    assert _preferred([{"after": "2030-01-29"}]) == ["2030-01-30", "2030-01-31"]
+
+
+def test_between_is_inclusive():
+    assert _preferred([{"between": ["2030-01-10", "2030-01-12"]}]) == [
+        "2030-01-10",
+        "2030-01-11",
+        "2030-01-12",
+    ]
+
+
+def test_weekdays():
+    assert _preferred([{"weekdays": ["monday", "Friday"]}]) == [
+        "2030-01-04",
+        "2030-01-07",
+        "2030-01-11",
+        "2030-01-14",
+        "2030-01-18",
+        "2030-01-21",
+        "2030-01-25",
+        "2030-01-28",
+    ]
+
+
+def test_conditions_in_a_rule_all_apply():
+    assert _preferred(
+        [{"after": "2030-01-05", "before": "2030-01-20", "weekdays": ["Monday"]}]
+    ) == ["2030-01-07", "2030-01-14"]
+
+
+def test_any_rule_can_match():
+    assert _preferred([{"before": "2030-01-02"}, {"after": "2030-01-30"}]) == [
+        "2030-01-01",
+        "2030-01-31",
+    ]
+
+
+def test_rules_scoped_to_cities():
+    rules = [
+        {"before": "2030-01-02", "cities": ["89"]},
+        {"after": "2030-01-30"},
+    ]
+
+    assert _preferred(rules, city_id="89") == ["2030-01-01", "2030-01-31"]
+    assert _preferred(rules, city_id="94") == ["2030-01-31"]
+
+
+def test_min_days_earlier_than_current_appointment():
+    dates = Availability.between("2030-05-20", "2030-06-05")
+
+    assert _preferred([{"min_days_earlier": 7}], dates=dates) == [
+        "2030-05-20",
+        "2030-05-21",
+        "2030-05-22",
+        "2030-05-23",
+        "2030-05-24",
+        "2030-05-25",
+    ]
+
+
+def test_only_offered_dates_are_preferred():
+    dates = Availability.from_dates(["2030-01-03", "2030-02-03"])
+
+    assert _preferred([{"before": "2030-01-10"}], dates=dates) == ["2030-01-03"]
+
+
+def test_unknown_rule_keys_are_rejected():
+    with pytest.raises(ValueError):
+        PreferredDateRules([{"befor": "2030-01-10"}])
@@ -0,0 +1,139 @@
+import datetime
+import itertools
+
+import pytest
+
+from config import City
+from date_utils import Availability
+from scheduler import (
+    POLL_BURST,
+    POLL_MAX_BAN_MULTIPLIER,
+    POLL_MAX_INTERVAL,
+    POLL_MIN_INTERVAL,
+    POLL_RELEASE_MAX_BOOST,
+    POLL_REQUESTS_PER_HOUR,
+    PollScheduler,
+    ban_probe_offsets,
+)
+
+CALGARY = City(name="Calgary", id="89", skip=False)
+TORONTO = City(name="Toronto", id="94", skip=False)
+SKIPPED = City(name="Skipped", id="1", skip=True)
+
+HOURS_PER_WEEK = 7 * 24
+
+
+def _dates(n: int) -> Availability:
+    return Availability.from_dates([datetime.date(2030, 1, 1 + n)])
+
+
+@pytest.fixture(autouse=True)
+def no_jitter(monkeypatch):
+    monkeypatch.setattr("scheduler.random.uniform", lambda a, b: 1.0)
+
+
+def test_every_city_is_due_once_until_checked():
+    scheduler = PollScheduler([CALGARY, TORONTO, SKIPPED])
+
+    assert scheduler.due_cities() == [CALGARY, TORONTO]
+    assert scheduler.due_cities() == []
+
+    scheduler.record_check(CALGARY, _dates(0))
+    # Not due again until its interval is up
+    assert scheduler.due_cities() == []
+
+
+def test_skipped_cities_are_not_scheduled():
+    scheduler = PollScheduler([SKIPPED])
+
+    assert scheduler.record_check(SKIPPED, _dates(0)) is None
+
+
+def test_quiet_cities_are_checked_every_max_interval():
+    scheduler = PollScheduler([CALGARY])
+
+    # The first dates seen aren't a change
+    assert scheduler.record_check(CALGARY, _dates(0)) == POLL_MAX_INTERVAL
+    assert scheduler.record_check(CALGARY, _dates(0)) == POLL_MAX_INTERVAL
+    # Unchanged (304)
+    assert scheduler.record_check(CALGARY, None) == POLL_MAX_INTERVAL
+    assert scheduler.churn(CALGARY) == 0.0
+
+
+def test_churning_cities_are_checked_more_often():
+    scheduler = PollScheduler([CALGARY, TORONTO])
+    scheduler.record_check(CALGARY, _dates(0))
+    scheduler.record_check(TORONTO, _dates(0))
+
+    intervals = [scheduler.record_check(CALGARY, _dates(n)) for n in range(1, 30)]
+
+    assert intervals == sorted(intervals, reverse=True)
+    assert POLL_MIN_INTERVAL <= intervals[-1] < POLL_MIN_INTERVAL + 60
+    assert scheduler.churn(CALGARY) > 0.99
+    # Only the city that changed
+    assert scheduler.record_check(TORONTO, _dates(0)) == POLL_MAX_INTERVAL
+
+    # And they slow down again once they go quiet
+    quiet = [scheduler.record_check(CALGARY, None) for _ in range(30)]
+    assert quiet == sorted(quiet)
+    assert quiet[-1] > POLL_MAX_INTERVAL - 60
+
+
+def test_bans_slow_every_city_down():
+    scheduler = PollScheduler([CALGARY])
+
+    scheduler.record_ban()
+    assert scheduler.record_check(CALGARY, None) == 2 * POLL_MAX_INTERVAL
+    scheduler.record_ban()
+    assert scheduler.record_check(CALGARY, None) == 4 * POLL_MAX_INTERVAL
+
+    for _ in range(10):
+        scheduler.record_ban()
+    assert scheduler.stats()["ban_multiplier"] == POLL_MAX_BAN_MULTIPLIER
+
+
+def test_requests_wait_for_tokens_after_the_burst():
+    scheduler = PollScheduler([CALGARY])
+
+    waits = [scheduler.reserve_request() for _ in range(POLL_BURST + 2)]
+
+    assert waits[:POLL_BURST] == [0.0] * POLL_BURST
+    seconds_per_request = 3600 / POLL_REQUESTS_PER_HOUR
+    assert waits[POLL_BURST] == pytest.approx(seconds_per_request, rel=0.01)
+    assert waits[POLL_BURST + 1] == pytest.approx(2 * seconds_per_request, rel=0.01)
+
+
+def test_release_hours_boost_polling():
+    scheduler = PollScheduler([CALGARY, TORONTO])
+    releases = [0] * HOURS_PER_WEEK
+    # This hour and the next in case the hour turns over mid test
+    for hour in [datetime.datetime.now() + datetime.timedelta(hours=i) for i in (0, 1)]:
+        releases[hour.weekday() * 24 + hour.hour] = 50
+    scheduler.set_release_profile({CALGARY.id: releases})
+
+    assert scheduler.record_check(CALGARY, None) == (
+        POLL_MAX_INTERVAL / POLL_RELEASE_MAX_BOOST
+    )
+    assert scheduler.record_check(TORONTO, None) == POLL_MAX_INTERVAL
+
+
+def test_ban_probes_without_history():
+    assert list(itertools.islice(ban_probe_offsets([]), 3)) == [3600, 5400, 7200]
+    assert list(itertools.islice(ban_probe_offsets([60, 120]), 1)) == [3600]
+
+
+def test_ban_probes_follow_past_ban_durations():
+    hours = [hour * 3600 for hour in range(1, 11)]
+
+    offsets = list(itertools.islice(ban_probe_offsets(hours), 8))
+
+    # The 20th to 80th percentiles, then backing off
+    assert offsets[:5] == [3 * 3600, 4 * 3600, 6 * 3600, 7 * 3600, 9 * 3600]
+    assert offsets[5:] == [11.25 * 3600, 13.25 * 3600, 15.25 * 3600]
+
+
+def test_ban_probes_never_repeat():
+    offsets = list(itertools.islice(ban_probe_offsets([3600] * 5), 5))
+
+    assert offsets == sorted(set(offsets))
+    assert offsets[0] == 3600
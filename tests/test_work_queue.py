@@ -0,0 +1,75 @@
+import time
+
+from config import CITIES
+from work_queue import PRIORITY_RETRY, WorkQueue
+
+CALGARY = CITIES["89"]
+OTTAWA = CITIES["92"]
+TORONTO = CITIES["94"]
+
+
+def _drain(work_queue: WorkQueue) -> list[str]:
+    cities = []
+    while (city := work_queue.get_nowait()) is not None:
+        cities.append(city.name)
+    return cities
+
+
+def test_each_city_is_queued_once():
+    work_queue = WorkQueue()
+
+    assert work_queue.put(CALGARY)
+    assert not work_queue.put(CALGARY)
+    assert not work_queue.put(CALGARY, delay=60)
+
+    assert len(work_queue) == 1
+    assert CALGARY in work_queue
+    assert work_queue.stats()["deduplicated"] == 2
+    assert _drain(work_queue) == ["Calgary"]
+    assert CALGARY not in work_queue
+
+
+def test_requeueing_keeps_the_sooner_and_higher_priority_entry():
+    work_queue = WorkQueue()
+
+    work_queue.put(CALGARY, delay=60)
+    assert work_queue.get_nowait() is None
+
+    assert work_queue.put(CALGARY, priority=1.0, delay=120)
+    assert work_queue.get_nowait() is None
+
+    assert work_queue.put(CALGARY)
+    work_queue.put(TORONTO)
+    # Still has the priority it was bumped to
+    assert _drain(work_queue) == ["Calgary", "Toronto"]
+
+
+def test_highest_priority_first_then_by_due_time():
+    work_queue = WorkQueue()
+
+    work_queue.put(CALGARY, priority=PRIORITY_RETRY)
+    work_queue.put(OTTAWA)
+    work_queue.put(TORONTO, priority=1.0)
+    time.sleep(0.01)
+
+    assert _drain(work_queue) == ["Toronto", "Ottawa", "Calgary"]
+
+
+def test_same_priority_in_due_order():
+    work_queue = WorkQueue()
+
+    work_queue.put(CALGARY, delay=0.02)
+    work_queue.put(OTTAWA, delay=0.01)
+    work_queue.put(TORONTO)
+    time.sleep(0.03)
+
+    assert _drain(work_queue) == ["Toronto", "Ottawa", "Calgary"]
+
+
+def test_get_waits_for_the_next_due_check():
+    work_queue = WorkQueue()
+    work_queue.put(CALGARY, delay=0.05)
+
+    assert work_queue.get(timeout=0.01) is None
+    assert work_queue.get(timeout=1) == CALGARY
+    assert work_queue.stats()["gets"] == 1
@@ -0,0 +1,348 @@
+"""
+Report when slots get released and how long they last, per city.
+
+The aggregates behind the report are kept up to date by `repo.record_new_dates`
+as availability changes are recorded, so the report never scans the history.
+History recorded before the aggregates existed can be folded in with --rebuild.
+
+    poetry run python visa_checker/analytics.py [--city 94] [--rebuild]
+"""
+
+import argparse
+import datetime
+import itertools
+import logging
+from collections import Counter, defaultdict
+from typing import Optional
+
+from psycopg2.extras import execute_values
+
+from config import CITIES
+from date_utils import Availability
+from db import create_db_connection, execute_prepared, pooled_connection
+
+# Upper bounds (in seconds) of the slot lifetime buckets, the last is unbounded
+LIFETIME_BUCKETS = [
+    60,
+    5 * 60,
+    15 * 60,
+    30 * 60,
+    60 * 60,
+    3 * 60 * 60,
+    6 * 60 * 60,
+    12 * 60 * 60,
+    24 * 60 * 60,
+    3 * 24 * 60 * 60,
+    7 * 24 * 60 * 60,
+    None,
+]
+
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+HOURS_PER_WEEK = 7 * 24
+
+
+def _lifetime_bucket(seconds: float) -> int:
+    for bucket, upper_bound in enumerate(LIFETIME_BUCKETS):
+        if upper_bound is None or seconds <= upper_bound:
+            return bucket
+
+
+def _format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "longer"
+    if seconds < 60 * 60:
+        return f"{seconds / 60:.0f}m"
+    if seconds < 24 * 60 * 60:
+        return f"{seconds / 3600:.0f}h"
+    return f"{seconds / 86400:.0f}d"
+
+
+def record_availability_changes(
+    cur,
+    city_id: str,
+    appeared: Availability,
+    disappeared: Availability,
+    at: datetime.datetime,
+    first_record: bool = False,
+):
+    """
+    Fold one recorded availability change into the aggregates. Runs on the
+    cursor of `repo.record_new_dates` so they commit along with the events.
+
+    Hours and weekdays are in the checker's local time. Lifetimes run from the
+    check that first saw a slot to the one that found it gone, so they're only
+    as precise as the poll interval.
+
+    :param first_record - the city had no history yet, so its dates are what was
+        already available rather than a release
+    """
+
+    if appeared and not first_record:
+        execute_prepared(
+            cur,
+            "record_release",
+            "INSERT INTO release_stats (city_id, weekday, hour, releases,"
+            " dates_released) VALUES ($1, $2, $3, 1, $4) ON CONFLICT (city_id,"
+            " weekday, hour) DO UPDATE SET releases = release_stats.releases + 1,"
+            " dates_released = release_stats.dates_released +"
+            " EXCLUDED.dates_released",
+            (city_id, at.weekday(), at.hour, len(appeared)),
+        )
+
+    if appeared:
+        execute_prepared(
+            cur,
+            "open_slots",
+            "INSERT INTO open_slots (city_id, date, appeared_at) SELECT $1,"
+            " unnest($2::date[]), $3 ON CONFLICT (city_id, date) DO NOTHING",
+            # Bound as dates, psycopg2 would send strings as a text[]
+            (city_id, list(appeared.dates()), at),
+        )
+
+    if not disappeared:
+        return
+
+    execute_prepared(
+        cur,
+        "close_slots",
+        "DELETE FROM open_slots WHERE city_id = $1 AND date = ANY($2::date[])"
+        " RETURNING appeared_at",
+        (city_id, list(disappeared.dates())),
+    )
+
+    # Slots that appeared before the aggregates were kept aren't in open_slots
+    lifetimes = defaultdict(list)
+    for (appeared_at,) in cur.fetchall():
+        seconds = (at - appeared_at).total_seconds()
+        lifetimes[_lifetime_bucket(seconds)].append(seconds)
+
+    for bucket, seconds in lifetimes.items():
+        execute_prepared(
+            cur,
+            "record_slot_lifetimes",
+            "INSERT INTO slot_lifetime_stats (city_id, bucket, slots, total_seconds)"
+            " VALUES ($1, $2, $3, $4) ON CONFLICT (city_id, bucket) DO UPDATE SET"
+            " slots = slot_lifetime_stats.slots + EXCLUDED.slots, total_seconds ="
+            " slot_lifetime_stats.total_seconds + EXCLUDED.total_seconds",
+            (city_id, bucket, len(seconds), sum(seconds)),
+        )
+
+
+def get_release_profile() -> dict[str, list[int]]:
+    """
+    Fetch how many releases each city has had in each hour of the week, indexed
+    by weekday * 24 + hour with Monday as 0.
+    """
+
+    profile = defaultdict(lambda: [0] * HOURS_PER_WEEK)
+
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(
+                cur,
+                "get_release_profile",
+                "select city_id, weekday, hour, releases from release_stats",
+            )
+
+            for city_id, weekday, hour, releases in cur:
+                profile[city_id][weekday * 24 + hour] = releases
+
+    return dict(profile)
+
+
+def _fetch_report_rows(city_id: Optional[str]) -> tuple[list, list]:
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "select city_id, weekday, hour, releases, dates_released from"
+                " release_stats where %(city_id)s is null or city_id = %(city_id)s",
+                {"city_id": city_id},
+            )
+            releases = cur.fetchall()
+
+            cur.execute(
+                "select city_id, bucket, slots, total_seconds from slot_lifetime_stats"
+                " where %(city_id)s is null or city_id = %(city_id)s",
+                {"city_id": city_id},
+            )
+            lifetimes = cur.fetchall()
+
+    return releases, lifetimes
+
+
+def _bar(value: int, largest: int, width: int = 30) -> str:
+    return "#" * round(width * value / largest) if largest else ""
+
+
+def print_report(city_id: Optional[str] = None, top: int = 10):
+    release_rows, lifetime_rows = _fetch_report_rows(city_id)
+
+    releases_by_city = defaultdict(list)
+    for row in release_rows:
+        releases_by_city[row[0]].append(row[1:])
+
+    lifetimes_by_city = defaultdict(dict)
+    for row_city_id, bucket, slots, total_seconds in lifetime_rows:
+        lifetimes_by_city[row_city_id][bucket] = (slots, total_seconds)
+
+    for report_city_id in sorted(set(releases_by_city) | set(lifetimes_by_city)):
+        city = CITIES.get(report_city_id)
+        rows = releases_by_city[report_city_id]
+        total_releases = sum(row[2] for row in rows)
+        total_dates = sum(row[3] for row in rows)
+
+        print(f"\n{city.name if city else report_city_id} ({report_city_id})")
+        print(f"  {total_releases} releases of {total_dates} dates")
+
+        if rows:
+            print("  Busiest hours of the week:")
+            for weekday, hour, releases, dates in sorted(
+                rows, key=lambda row: row[2], reverse=True
+            )[:top]:
+                print(
+                    f"    {WEEKDAYS[weekday]} {hour:02}:00  {releases:5} releases"
+                    f" {dates:6} dates"
+                )
+
+            by_hour = Counter()
+            by_weekday = Counter()
+            for weekday, hour, releases, _ in rows:
+                by_hour[hour] += releases
+                by_weekday[weekday] += releases
+
+            print("  By hour of day:")
+            for hour in range(24):
+                print(
+                    f"    {hour:02}  {by_hour[hour]:5} "
+                    f"{_bar(by_hour[hour], max(by_hour.values()))}"
+                )
+
+            print("  By weekday:")
+            for weekday, name in enumerate(WEEKDAYS):
+                print(
+                    f"    {name}  {by_weekday[weekday]:5} "
+                    f"{_bar(by_weekday[weekday], max(by_weekday.values()))}"
+                )
+
+        lifetimes = lifetimes_by_city[report_city_id]
+        slots = sum(count for count, _ in lifetimes.values())
+        if not slots:
+            continue
+
+        mean = sum(seconds for _, seconds in lifetimes.values()) / slots
+        print(f"  {slots} slots gone after {_format_duration(mean)} on average:")
+
+        cumulative = 0
+        for bucket, upper_bound in enumerate(LIFETIME_BUCKETS):
+            count = lifetimes.get(bucket, (0, 0))[0]
+            cumulative += count
+            print(
+                f"    <= {_format_duration(upper_bound):>6}  {count:5} "
+                f"({cumulative / slots:4.0%} by then) {_bar(count, slots)}"
+            )
+
+
+def rebuild():
+    """
+    Recompute the aggregates from the full availability_events history. Only
+    needed once for history recorded before the aggregates were kept.
+    """
+
+    release_stats = Counter()
+    dates_released = Counter()
+    lifetimes = defaultdict(list)
+    open_slots = {}
+
+    with create_db_connection() as conn:
+        with conn.cursor(name="availability_events_history") as history:
+            history.itersize = 10000
+            history.execute(
+                "select city_id, date, kind, created_at from availability_events"
+                " ORDER BY city_id, id"
+            )
+
+            seen_cities = set()
+
+            # Events recorded together share a created_at and make up one change
+            for (city_id, created_at), events in itertools.groupby(
+                history, key=lambda event: (event[0], event[3])
+            ):
+                appeared = 0
+
+                for _, date, kind, _ in events:
+                    if kind == "appeared":
+                        appeared += 1
+                        open_slots.setdefault((city_id, date), created_at)
+                        continue
+
+                    appeared_at = open_slots.pop((city_id, date), None)
+                    if appeared_at is not None:
+                        seconds = (created_at - appeared_at).total_seconds()
+                        lifetimes[(city_id, _lifetime_bucket(seconds))].append(seconds)
+
+                # Same as record_availability_changes' first_record
+                if appeared and city_id in seen_cities:
+                    key = (city_id, created_at.weekday(), created_at.hour)
+                    release_stats[key] += 1
+                    dates_released[key] += appeared
+
+                seen_cities.add(city_id)
+
+        with conn.cursor() as cur:
+            cur.execute("TRUNCATE release_stats, open_slots, slot_lifetime_stats")
+            execute_values(
+                cur,
+                "INSERT INTO release_stats (city_id, weekday, hour, releases,"
+                " dates_released) VALUES %s",
+                [
+                    (*key, releases, dates_released[key])
+                    for key, releases in release_stats.items()
+                ],
+            )
+            execute_values(
+                cur,
+                "INSERT INTO open_slots (city_id, date, appeared_at) VALUES %s",
+                [(*key, appeared_at) for key, appeared_at in open_slots.items()],
+            )
+            execute_values(
+                cur,
+                "INSERT INTO slot_lifetime_stats (city_id, bucket, slots,"
+                " total_seconds) VALUES %s",
+                [
+                    (*key, len(seconds), sum(seconds))
+                    for key, seconds in lifetimes.items()
+                ],
+            )
+
+    logging.info(
+        f"Rebuilt analytics from {sum(release_stats.values())} releases and "
+        f"{sum(len(seconds) for seconds in lifetimes.values())} slot lifetimes"
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--city", help="Only report on this city id")
+    parser.add_argument(
+        "--top", type=int, default=10, help="Number of busiest hours to list"
+    )
+    parser.add_argument(
+        "--rebuild",
+        action=argparse.BooleanOptionalAction,
+        help="Recompute the aggregates from the full history first",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-1s: %(message)s",
+        level=logging.INFO,
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    if args.rebuild:
+        rebuild()
+
+    print_report(args.city, args.top)
@@ -0,0 +1,237 @@
+import asyncio
+import datetime
+import logging
+import random
+import time
+from typing import Optional
+
+from playwright.async_api import async_playwright
+
+from config import ACCOUNTS, City
+from repo import update_appointment_date
+from notify import send_notification
+from date_utils import Availability, date_str_to_datetime
+from event_log import CheckEvent, emit
+from page import (
+    UnauthorizedError,
+    TempBannedError,
+    ServiceUnavailableError,
+    NoResponseError,
+)
+from async_page import AsyncVisaPageWrapper, new_session_context
+from replay import ResponseRecorder
+from routing import ResourceBlocker
+from scheduler import PollScheduler
+from utils import (
+    AvailabilityCheckError,
+    find_preferred_dates,
+    note_check_error,
+    process_availability_for_city,
+)
+from work_queue import PRIORITY_RETRY, WorkQueue
+
+
+def _in_background(follow_ups: set[asyncio.Task], func, *args):
+    """
+    Run a blocking follow up (eg. DB writes) on a worker thread without
+    waiting for it, keeping a reference to the task so it isn't garbage collected.
+    """
+
+    task = asyncio.create_task(asyncio.to_thread(func, *args))
+    follow_ups.add(task)
+    task.add_done_callback(follow_ups.discard)
+
+
+async def _reschedule(
+    page_wrapper: AsyncVisaPageWrapper,
+    city: City,
+    new_date: datetime.datetime,
+    follow_ups: set[asyncio.Task],
+):
+    booked = await page_wrapper.reschedule_appointment(
+        year=new_date.year,
+        month=new_date.month,
+        day=new_date.day,
+        city=city,
+    )
+
+    if booked:
+        _in_background(
+            follow_ups,
+            update_appointment_date,
+            datetime.datetime(
+                month=new_date.month, day=new_date.day, year=new_date.year
+            ),
+        )
+
+
+async def check_availability_for_city(
+    page_wrapper: AsyncVisaPageWrapper, city: City, follow_ups: set[asyncio.Task]
+) -> Optional[Availability]:
+    """
+    Async version of `utils.check_availability_for_city`. Storing the dates and
+    sending notifications are left running in the background so the next city
+    can be checked straight away. Rescheduling runs alongside too when the
+    booking page is ready, otherwise it needs the polling page so it's awaited.
+    """
+
+    start_time = time.monotonic()
+    try:
+        current_dates = await page_wrapper.get_available_dates_for_city(city)
+    except (
+        UnauthorizedError,
+        TempBannedError,
+        ServiceUnavailableError,
+        NoResponseError,
+    ) as e:
+        emit(CheckEvent(city.id, type(e).__name__, time.monotonic() - start_time))
+        await asyncio.sleep(note_check_error(page_wrapper, e))
+        raise AvailabilityCheckError()
+
+    emit(CheckEvent.of(city.id, current_dates, time.monotonic() - start_time))
+
+    if current_dates is None:
+        logging.info(f"304 - No new dates for {city.name}")
+        return None
+
+    _in_background(follow_ups, process_availability_for_city, city.id, current_dates)
+
+    for city_id, dates in (await page_wrapper.pop_unsolicited_dates()).items():
+        _in_background(follow_ups, process_availability_for_city, city_id, dates)
+
+    preferred_dates = await asyncio.to_thread(find_preferred_dates, city, current_dates)
+
+    if preferred_dates:
+        logging.info(f"Found preferred dates - {', '.join(preferred_dates)}")
+
+        new_date = date_str_to_datetime(preferred_dates[0])
+
+        msg = f"Rescheduling to {new_date}"
+        logging.info(msg)
+        send_notification(
+            title=f"Found preferrable appointment date - {city.name}",
+            msg=msg,
+            urgent=True,
+        )
+
+        logging.info(f"Running rescheduler for preferred date - {new_date}")
+        if page_wrapper.booking_page_ready:
+            # Books on the parked booking page so polling carries on meanwhile
+            task = asyncio.create_task(
+                _reschedule(page_wrapper, city, new_date, follow_ups)
+            )
+            follow_ups.add(task)
+            task.add_done_callback(follow_ups.discard)
+        else:
+            await _reschedule(page_wrapper, city, new_date, follow_ups)
+
+    return current_dates
+
+
+async def start_session(
+    browser,
+    work_queue: WorkQueue,
+    poll_scheduler: PollScheduler,
+    one_cycle: bool,
+    direct: bool,
+    response_timeout: float,
+    recorder: Optional[ResponseRecorder] = None,
+):
+    """
+    Async version of `main.start_session` built on `playwright.async_api`. The
+    browser loop keeps checking cities while DB writes and notifications from
+    earlier checks finish on worker threads. The work queue and scheduler can
+    block on the DB so they're called from worker threads too.
+    """
+
+    logging.info("Starting a new async tracking browser session")
+
+    follow_ups: set[asyncio.Task] = set()
+
+    context = await new_session_context(browser, ACCOUNTS[0])
+    try:
+        if direct:
+            # See main.run_sessions
+            await ResourceBlocker().install_async(context)
+        page_wrapper = AsyncVisaPageWrapper(
+            await context.new_page(),
+            direct=direct,
+            response_timeout=response_timeout,
+            recorder=recorder,
+        )
+        await page_wrapper.resume_or_sign_in()
+
+        while page_wrapper.logged_in:
+            await page_wrapper.wait_out_ban()
+            await page_wrapper.keep_booking_page_warm()
+
+            city = await asyncio.to_thread(work_queue.get_nowait)
+
+            if city:
+                await asyncio.sleep(poll_scheduler.reserve_request())
+                logging.info(f"Checking dates for {city.name}")
+
+                try:
+                    current_dates = await check_availability_for_city(
+                        page_wrapper, city, follow_ups
+                    )
+                except AvailabilityCheckError:
+                    if page_wrapper.last_temp_banned_time is not None:
+                        poll_scheduler.record_ban()
+                    await asyncio.to_thread(
+                        work_queue.put, city, priority=PRIORITY_RETRY
+                    )
+                    continue
+
+                await asyncio.to_thread(
+                    poll_scheduler.record_check, city, current_dates
+                )
+            else:
+                if one_cycle and not work_queue:
+                    logging.info("Finished running one cycle of checks and returning")
+                    await asyncio.gather(*follow_ups)
+                    exit(1)
+
+                # Wait for the scheduler to queue up more cities
+                await asyncio.sleep(random.uniform(1, 3))
+    finally:
+        # Don't drop DB writes or notifications that are still in flight
+        await asyncio.gather(*follow_ups, return_exceptions=True)
+        await context.close()
+
+
+async def run_sessions(
+    work_queue: WorkQueue,
+    poll_scheduler: PollScheduler,
+    headed: bool,
+    one_cycle: bool,
+    direct: bool,
+    response_timeout: float,
+    recorder: Optional[ResponseRecorder] = None,
+):
+    """
+    Async version of `main.run_sessions`. The browser is launched once and each
+    session gets a fresh context on it. Unlike `browser.BrowserManager` it's only
+    relaunched if it disconnects, never for its memory use or age.
+    """
+
+    async with async_playwright() as p:
+        browser = None
+
+        try:
+            while True:
+                if browser is None or not browser.is_connected():
+                    browser = await p.firefox.launch(headless=not headed)
+
+                await start_session(
+                    browser,
+                    work_queue,
+                    poll_scheduler,
+                    one_cycle,
+                    direct,
+                    response_timeout,
+                    recorder,
+                )
+        finally:
+            if browser is not None and browser.is_connected():
+                await browser.close()
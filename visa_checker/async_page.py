@@ -0,0 +1,494 @@
+import asyncio
+import calendar
+import logging
+import datetime
+import random
+import time
+from typing import TYPE_CHECKING, Optional
+
+from playwright.async_api import Error as PlaywrightError
+
+from date_utils import Availability, parse_month_year_str
+from config import CITIES, Account, City
+from repo import (
+    get_ban_durations,
+    record_ban_end,
+    record_ban_probe,
+    record_ban_start,
+    record_booking_attempt,
+)
+from event_log import emit
+from metrics import CHECK_STAGE_SECONDS, SIGN_IN_SECONDS
+from page import (
+    APPOINTMENT_URL_REGEX,
+    DIRECT_REQUEST_TIMEOUT,
+    HAS_TIME_OPTION_JS,
+    HAS_TIME_OPTIONS_JS,
+    RESPONSE_TIMEOUT,
+    SET_APPOINTMENT_DATE_JS,
+    TIME_SLOTS_TIMEOUT,
+    VISA_URL,
+    NoResponseError,
+    PageWrapperBase,
+    UnauthorizedError,
+    ban_event,
+    handle_days_response,
+    load_session_state,
+    parse_time_slots,
+    save_session_state,
+)
+
+if TYPE_CHECKING:
+    from replay import ResponseRecorder
+
+
+async def new_session_context(browser, account: Account):
+    """
+    See `page.new_session_context`.
+    """
+    session_state = load_session_state(account)
+    return await browser.new_context(
+        storage_state=session_state["storage_state"] if session_state else None
+    )
+
+
+class AsyncVisaPageWrapper(PageWrapperBase):
+    """
+    `page.VisaPageWrapper` for a `playwright.async_api` page. Behaves the same way
+    but never blocks the event loop, so other work can run while we wait on the
+    site.
+    """
+
+    def __init__(
+        self,
+        page,
+        direct: bool = False,
+        response_timeout: float = RESPONSE_TIMEOUT,
+        account: Optional[Account] = None,
+        recorder: Optional["ResponseRecorder"] = None,
+    ):
+        """
+        :param page - async playwright page used to sign in and drive the scheduler UI
+        :param direct - fetch the days JSON with the context's request API instead
+            of triggering it through the facility dropdown
+        :param response_timeout - seconds to wait for the days JSON response
+        :param account - account to sign in with, defaults to the main account
+        :param recorder - captures every days JSON response handled, see replay.py
+        """
+        super().__init__(page, direct, response_timeout, account, recorder)
+        self._direct_headers: dict[str, str] = {}
+        # Held while a booking runs on the booking page, which can be alongside
+        # polling. keep_booking_page_warm leaves the page alone until it's done
+        self._booking_lock = asyncio.Lock()
+
+    async def sign_in(self):
+        logging.info(f"Signing in as {self.account.email}")
+        start_time = time.monotonic()
+        await self.page.goto(VISA_URL, timeout=60 * 1000)
+        await self.page.type("#user_email", self.account.email, delay=200)
+        await self.page.type("#user_password", self.account.password, delay=200)
+        await self._random_delay()
+        await self.page.locator("#policy_confirmed").click(force=True)
+        await self._random_delay()
+        await self.page.click('input:text-is("Sign In")')
+        await self.page.wait_for_selector('a:text-is("Continue")', timeout=60 * 1000)
+        self.logged_in = True
+        logging.info("Sign in complete")
+
+        logging.info("Navigating to scheduler page")
+        if self._scheduler_url:
+            await self.page.goto(self._scheduler_url, timeout=60 * 1000)
+        else:
+            await self._random_delay()
+            await self.page.click('a:text-is("Continue")')
+            await self._random_delay()
+            await self.page.click('h5:text-is("Reschedule Appointment")')
+            await self._random_delay()
+            await self.page.click('a:text-is("Reschedule Appointment")')
+            await self.page.wait_for_url(APPOINTMENT_URL_REGEX)
+            self._scheduler_url = self.page.url
+        logging.info("Finished navigating to scheduler page")
+
+        save_session_state(
+            self.account, await self.page.context.storage_state(), self._scheduler_url
+        )
+        self._reset_request_state()
+        SIGN_IN_SECONDS.observe(time.monotonic() - start_time, "full")
+
+    async def resume_or_sign_in(self):
+        """
+        See `page.VisaPageWrapper.resume_or_sign_in`.
+        """
+        if self._scheduler_url is None:
+            await self.sign_in()
+            return
+
+        logging.info(f"Resuming saved session for {self.account.email}")
+        start_time = time.monotonic()
+        await self.page.goto(self._scheduler_url, timeout=60 * 1000)
+
+        if (
+            not self._on_scheduler_page()
+            or await self.page.locator(
+                "#appointments_consulate_appointment_facility_id"
+            ).count()
+            == 0
+        ):
+            logging.info("Saved session has expired")
+            await self.sign_in()
+            return
+
+        self.logged_in = True
+        self._reset_request_state()
+        SIGN_IN_SECONDS.observe(time.monotonic() - start_time, "resumed")
+        logging.info("Resumed saved session")
+
+    async def keep_booking_page_warm(self):
+        """
+        See `page.VisaPageWrapper.keep_booking_page_warm`. Does nothing while a
+        booking is using the booking page.
+        """
+        if self._booking_lock.locked() or not self._booking_page_due():
+            return
+
+        if self._booking_page is None or self._booking_page.is_closed():
+            logging.info("Opening booking page")
+            self._booking_page = await self.page.context.new_page()
+
+        self._start_booking_page_load()
+        try:
+            await self._booking_page.goto(self._scheduler_url, timeout=60 * 1000)
+        except PlaywrightError as e:
+            logging.warning(f"Failed to load the booking page - {e}")
+            return
+
+        self._finish_booking_page_load()
+
+    async def wait_out_ban(self):
+        """
+        See `page.VisaPageWrapper.wait_out_ban`.
+        """
+
+        if not (self.logged_in and self.last_temp_banned_time):
+            return
+
+        banned_at = self.last_temp_banned_time
+        ban_id = await asyncio.to_thread(record_ban_start, banned_at)
+        emit(ban_event("started", banned_at))
+        ban_durations = await asyncio.to_thread(get_ban_durations)
+
+        for wait in self._ban_probe_waits(banned_at, ban_durations):
+            await asyncio.sleep(wait)
+
+            try:
+                still_banned = await self.probe_ban()
+            except UnauthorizedError:
+                self._note_ban_probe_unauthorized()
+                return
+
+            await asyncio.to_thread(record_ban_probe, ban_id, still_banned)
+            self._note_ban_probe(banned_at, still_banned)
+
+            if not still_banned:
+                await asyncio.to_thread(record_ban_end, ban_id, datetime.datetime.now())
+                return
+
+    async def probe_ban(self) -> bool:
+        """
+        See `page.VisaPageWrapper.probe_ban`.
+        """
+        city = CITIES["92"]
+
+        try:
+            await self._refresh_request_state()
+            status, url, body = await self._request_days_json(city, conditional=False)
+        except (PlaywrightError, NoResponseError, RuntimeError) as e:
+            logging.info(f"Ban probe failed - {e!r}")
+            return True
+
+        return self._ban_probe_result(city, status, url, body)
+
+    async def _refresh_request_state(self):
+        """
+        See `page.VisaPageWrapper._refresh_request_state`.
+        """
+        if self._scheduler_url is None:
+            return
+
+        await self.page.goto(self._scheduler_url, timeout=60 * 1000)
+        self._check_scheduler_page()
+        self._days_url_base = None
+
+    async def reschedule_appointment(
+        self, month: int, day: int, year: int, city: Optional[City] = None
+    ) -> bool:
+        """
+        See `page.VisaPageWrapper.reschedule_appointment`. When it books on the
+        booking page polling can carry on meanwhile, so the page is only marked
+        for reloading once the booking is over.
+        """
+        logging.info(f"Rescheduling appointment to {month}/{day}/{year}")
+        date = datetime.date(year, month, day)
+
+        if not self.booking_page_ready:
+            return await self._book(self.page, date, city)
+
+        page = self._take_booking_page()
+        async with self._booking_lock:
+            try:
+                return await self._book(page, date, city)
+            finally:
+                self._release_booking_page()
+
+    async def _book(self, page, date: datetime.date, city: Optional[City]) -> bool:
+        start_time = time.monotonic()
+        path = "direct"
+
+        facility_select = "#appointments_consulate_appointment_facility_id"
+        if city is not None and await page.input_value(facility_select) != city.id:
+            await page.select_option(facility_select, city.id)
+
+        try:
+            selected = await self._select_appointment_directly(page, date)
+        except (PlaywrightError, NoResponseError, ValueError, RuntimeError) as e:
+            logging.warning(f"Direct booking failed, using the datepicker - {e!r}")
+            path = "datepicker"
+            selected = await self._select_appointment(
+                page, month=date.month, day=date.day, year=date.year
+            )
+
+        if selected:
+            logging.info("Clicking Reschedule")
+            await page.click('input:text-is("Reschedule")')
+
+            logging.info("Clicking Confirm")
+            await page.click('a:text-is("Confirm")')
+
+        seconds = self._note_booking(city, date, path, selected, start_time)
+        await asyncio.to_thread(
+            record_booking_attempt,
+            city.id if city else None,
+            date,
+            path,
+            selected,
+            seconds,
+        )
+
+        return selected
+
+    async def _select_appointment_directly(self, page, date: datetime.date) -> bool:
+        """
+        See `page.VisaPageWrapper._select_appointment_directly`.
+        """
+        facility_id = await page.input_value(
+            "#appointments_consulate_appointment_facility_id"
+        )
+        times = await self._fetch_time_slots(facility_id, date)
+
+        if not times:
+            logging.info(f"No time slots left on {date}")
+            return False
+
+        await page.evaluate(SET_APPOINTMENT_DATE_JS, date.isoformat())
+        await page.wait_for_function(
+            HAS_TIME_OPTION_JS, arg=times[-1], timeout=TIME_SLOTS_TIMEOUT * 1000
+        )
+
+        logging.info(f"Selecting appointment time {times[-1]}")
+        await page.select_option("#appointments_consulate_appointment_time", times[-1])
+        return True
+
+    async def _fetch_time_slots(
+        self, facility_id: str, date: datetime.date
+    ) -> list[str]:
+        if self._days_url_base is None:
+            await self._prepare_direct_requests()
+
+        response = await self.page.request.get(
+            self._times_json_url(facility_id, date),
+            headers=self._direct_headers,
+            timeout=DIRECT_REQUEST_TIMEOUT * 1000,
+        )
+
+        if not response.ok:
+            raise RuntimeError(f"Times request failed with {response.status}")
+
+        return parse_time_slots(await response.text())
+
+    async def get_available_dates_for_city(self, city: City) -> Optional[Availability]:
+        """
+        See `page.VisaPageWrapper.get_available_dates_for_city`.
+        """
+        if self.direct:
+            return await self._fetch_available_dates_for_city(city)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._response_waiters[city.id] = waiter
+
+        select_time = time.monotonic()
+        try:
+            await self.page.select_option(
+                "#appointments_consulate_appointment_facility_id", city.id
+            )
+            city_response = await asyncio.wait_for(waiter, self.response_timeout)
+            CHECK_STAGE_SECONDS.observe(time.monotonic() - select_time, "response")
+        except asyncio.TimeoutError as e:
+            logging.warning(
+                f"No matching response in {self.response_timeout} seconds. Something "
+                "probably went wrong. Exiting response handler."
+            )
+            raise NoResponseError() from e
+        finally:
+            self._response_waiters.pop(city.id, None)
+
+        body = await city_response.text()
+        return self._handle_selected_response(
+            city, city_response.status, city_response.url, lambda: body, select_time
+        )
+
+    async def pop_unsolicited_dates(self) -> dict[str, Availability]:
+        """
+        See `page.VisaPageWrapper.pop_unsolicited_dates`.
+        """
+        unsolicited_dates = {}
+        for city_id, response in self._take_unsolicited_responses():
+            try:
+                body = await response.text()
+            except PlaywrightError as e:
+                logging.info(f"Unsolicited response for {city_id} is gone - {e}")
+                continue
+
+            current_dates = self._unsolicited_dates(city_id, response, body)
+            if current_dates is not None:
+                unsolicited_dates[city_id] = current_dates
+
+        return unsolicited_dates
+
+    def _deliver_response(self, waiter: asyncio.Future, response):
+        if not waiter.done():
+            waiter.set_result(response)
+
+    async def _fetch_available_dates_for_city(
+        self, city: City, conditional: bool = True
+    ) -> Optional[Availability]:
+        """
+        Request the days JSON for `city` through the browser context's request
+        API, which shares its cookies with the page and runs on the event loop.
+        """
+        status, url, body = await self._request_days_json(city, conditional)
+        return handle_days_response(city, status, url, lambda: body, self.recorder)
+
+    async def _request_days_json(
+        self, city: City, conditional: bool
+    ) -> tuple[int, str, str]:
+        start_time = time.monotonic()
+        if self._days_url_base is None:
+            await self._prepare_direct_requests()
+
+        url = self._days_json_url(city)
+        request_time = time.monotonic()
+        CHECK_STAGE_SECONDS.observe(request_time - start_time, "session")
+
+        try:
+            response = await self.page.request.get(
+                url,
+                headers={
+                    **self._direct_headers,
+                    **self._conditional_headers(city, conditional),
+                },
+                timeout=DIRECT_REQUEST_TIMEOUT * 1000,
+                # A redirect here is to the sign in page, see handle_days_response
+                max_redirects=0,
+            )
+            body = await response.text()
+        except Exception as e:
+            logging.warning(f"Direct request for {city.name} failed - {e}")
+            raise NoResponseError() from e
+
+        CHECK_STAGE_SECONDS.observe(time.monotonic() - request_time, "request")
+
+        self._store_validators(city, response.status, response.headers)
+        return response.status, url, body
+
+    async def _prepare_direct_requests(self):
+        url_base = self._direct_url_base()
+        self._direct_headers = self._direct_headers_for(
+            await self.page.get_attribute('meta[name="csrf-token"]', "content")
+        )
+        self._days_url_base = url_base
+
+    async def _random_delay(self):
+        await asyncio.sleep(random.uniform(0.5, 2))
+
+    async def _get_current_datepicker_months(self, page) -> list[tuple[int, int]]:
+        return [
+            parse_month_year_str(s.replace("\xa0", " "))
+            for s in await page.locator(".ui-datepicker-title").all_text_contents()
+        ]
+
+    async def _go_to_month_datepicker(self, page, target_month: int, target_year: int):
+        target_month_year = (target_month, target_year)
+
+        i = 0
+        current_datepicker_months = await self._get_current_datepicker_months(page)
+
+        while target_month_year not in current_datepicker_months:
+            await page.click(
+                self._datepicker_step(
+                    target_month, target_year, current_datepicker_months
+                )
+            )
+
+            i += 1
+
+            if i == 50:
+                raise RuntimeError(
+                    f"Could not find target month/year ({target_month_year}) after 50"
+                    " iterations."
+                )
+
+            current_datepicker_months = await self._get_current_datepicker_months(page)
+
+    async def _select_day_datepicker(self, page, month: int, day: int):
+        month_name = calendar.month_name[month]
+        datepicker_month = page.locator(
+            ".ui-datepicker-group",
+            has=page.locator(f'span:text-is("{month_name}")'),
+        )
+        date_cell = datepicker_month.locator(f'td a:text-is("{day}")')
+
+        if await date_cell.count() == 0:
+            logging.error(f"Selected day {month}/{day} is not available.")
+            return False
+
+        await date_cell.click()
+        return True
+
+    async def _get_time_option_values(self, page):
+        await page.wait_for_function(
+            HAS_TIME_OPTIONS_JS, timeout=TIME_SLOTS_TIMEOUT * 1000
+        )
+
+        return [
+            value
+            for value in [
+                await option.evaluate("e => e.value")
+                for option in await page.query_selector_all(
+                    "#appointments_consulate_appointment_time option"
+                )
+            ]
+            if value
+        ]
+
+    async def _select_appointment(self, page, month: int, day: int, year: int) -> bool:
+        logging.info(f"Selecting appointment date {month}/{day}/{year}")
+        await page.click("#appointments_consulate_appointment_date_input")
+        await self._go_to_month_datepicker(page, month, year)
+
+        if not await self._select_day_datepicker(page, month, day):
+            return False
+
+        times = await self._get_time_option_values(page)
+        logging.info(f"Selecting appointment time {times[-1]}")
+        await page.select_option("#appointments_consulate_appointment_time", times[-1])
+        return True
@@ -0,0 +1,307 @@
+"""
+Benchmark the checker end to end against the local stand-in site (standin.py)
+so performance changes can be judged on one machine without any network.
+
+Runs the sync engine through `main.run_sessions` with every city queued round
+robin for `--duration` seconds, then reports checks per minute, check latency,
+how long slots took to be detected, notified and booked, and the time spent in
+the db and queueing notifications.
+
+Availability and bookings are stored like in a normal run so this needs a
+scratch Postgres db in the usual VISA_CHECKER_DB_* variables. Everything else
+is pointed at the stand-in.
+
+    poetry run python visa_checker/bench.py --duration 300 --direct
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import os
+import re
+import statistics
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from standin import StandInConfig, StandInSite
+
+_DATE_REGEX = re.compile(r"\d{4}-\d{2}-\d{2}")
+_NOTIFICATION_TITLE_REGEX = re.compile(r"New Visa Appointment Dates \((.+)\)")
+
+
+class _BenchQueue:
+    """
+    Stands in for `main.work_queue`. Hands out every city round robin until the
+    deadline and then runs dry, which ends a `one_cycle` session.
+    """
+
+    def __init__(self, cities: list, deadline: float):
+        self._cities = itertools.cycle(cities)
+        self._deadline = deadline
+        self._lock = threading.Lock()
+        self.handed_out = 0
+
+    def get(self, timeout=None):
+        with self._lock:
+            if time.monotonic() >= self._deadline:
+                return None
+
+            self.handed_out += 1
+            return next(self._cities)
+
+    def get_nowait(self):
+        return self.get()
+
+    def put(self, city, priority=0.0, delay=0.0):
+        # Failed checks aren't retried, the city comes round again anyway
+        return False
+
+    def __len__(self):
+        return 0 if time.monotonic() >= self._deadline else 1
+
+
+class _Recorder:
+    """
+    Wraps functions the checker calls to time them and to note when it first
+    saw each slot that appeared on the stand-in site.
+    """
+
+    def __init__(self, site: StandInSite):
+        self._site = site
+        self._lock = threading.Lock()
+        self.timings: dict[str, list[float]] = defaultdict(list)
+        # (facility_id, date, appeared_at) -> seconds from appearing to detection
+        self.detections: dict[tuple, float] = {}
+
+    def time(self, module, name: str, label: str):
+        func = getattr(module, name)
+
+        def timed(*args, **kwargs):
+            start_time = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.timings[label].append(time.monotonic() - start_time)
+
+        setattr(module, name, timed)
+
+    def watch_detections(self, module, name: str):
+        func = getattr(module, name)
+
+        def watched(city_id: str, current_dates, *args, **kwargs):
+            now = time.monotonic()
+            with self._lock:
+                for date in current_dates:
+                    appeared_at = self._site.appeared_at.get((city_id, date))
+                    key = (city_id, date, appeared_at)
+                    if appeared_at is not None and key not in self.detections:
+                        self.detections[key] = now - appeared_at
+
+            return func(city_id, current_dates, *args, **kwargs)
+
+        setattr(module, name, watched)
+
+
+def _summarize(values: list[float]) -> str:
+    if not values:
+        return "none"
+
+    values = sorted(values)
+    p50 = values[len(values) // 2]
+    p90 = values[min(len(values) - 1, int(len(values) * 0.9))]
+    return (
+        f"n={len(values)} mean={statistics.fmean(values):.3f}s p50={p50:.3f}s "
+        f"p90={p90:.3f}s max={values[-1]:.3f}s"
+    )
+
+
+def _notification_latencies(site: StandInSite) -> list[float]:
+    """
+    Seconds from a slot appearing to the ntfy notification for it arriving,
+    worked out from the city titles and dates in each notification.
+    """
+    facility_ids = {name: id for id, name in site.facility_options()}
+    latencies = []
+    seen = set()
+
+    for notification in site.notifications:
+        facility_id = None
+        for line in [notification.title] + notification.body.split("\n"):
+            title_match = _NOTIFICATION_TITLE_REGEX.search(line)
+            if title_match:
+                facility_id = facility_ids.get(title_match.group(1))
+                continue
+
+            date_match = _DATE_REGEX.match(line)
+            if facility_id is None or date_match is None:
+                continue
+
+            appeared_at = site.appeared_at.get((facility_id, date_match.group(0)))
+            key = (facility_id, date_match.group(0), appeared_at)
+            if appeared_at is not None and key not in seen:
+                seen.add(key)
+                latencies.append(notification.received_at - appeared_at)
+
+    return latencies
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--duration", type=float, default=300)
+    parser.add_argument("--headed", action=argparse.BooleanOptionalAction)
+    parser.add_argument("--direct", action=argparse.BooleanOptionalAction)
+    parser.add_argument("--response-timeout", type=float, default=30)
+    parser.add_argument(
+        "--requests-per-hour",
+        type=int,
+        default=360_000,
+        help="Checker request budget. The default is high enough to not throttle.",
+    )
+    parser.add_argument("--latency", type=float, default=StandInConfig.latency)
+    parser.add_argument(
+        "--churn-interval", type=float, default=StandInConfig.churn_interval
+    )
+    parser.add_argument("--session-ttl", type=float, default=StandInConfig.session_ttl)
+    parser.add_argument(
+        "--unavailable-rate",
+        type=float,
+        default=StandInConfig.unavailable_rate,
+        help="Share of 503s. The checker backs off for 30 minutes after each one.",
+    )
+    parser.add_argument(
+        "--ban-after-requests",
+        type=int,
+        default=StandInConfig.ban_after_requests,
+        help="Requests per minute that get a temp ban. The checker waits bans out.",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log", default="bench_log.txt")
+    return parser.parse_args()
+
+
+def _point_checker_at(base_url: str, site_config: StandInConfig, args):
+    """
+    Configure the checker through its environment variables. Has to happen
+    before any of its modules are imported since config is read on import.
+    """
+    today = datetime.date.today()
+    window_start, window_end = site_config.preferred_window
+
+    os.environ["VISA_CHECKER_BASE_URL"] = base_url
+    os.environ["VISA_CHECKER_NTFY_URL"] = f"{base_url}/ntfy"
+    os.environ["VISA_CHECKER_SESSION_STATE_DIR"] = tempfile.mkdtemp()
+    os.environ["VISA_CHECKER_REQUESTS_PER_HOUR"] = str(args.requests_per_hour)
+    os.environ["VISA_CHECKER_PREFERRED_DATE_RULES"] = json.dumps(
+        [
+            {
+                "between": [
+                    (today + datetime.timedelta(days=window_start)).isoformat(),
+                    (today + datetime.timedelta(days=window_end)).isoformat(),
+                ]
+            }
+        ]
+    )
+    os.environ.setdefault("VISA_CHECKER_NTFY_TOPIC", "bench")
+    os.environ.setdefault("VISA_CHECKER_APP_USER_EMAIL", "bench@example.com")
+    os.environ.setdefault("VISA_CHECKER_APP_USER_PW", "bench")
+
+
+def run_benchmark(args):
+    site_config = StandInConfig(
+        latency=args.latency,
+        churn_interval=args.churn_interval,
+        session_ttl=args.session_ttl,
+        unavailable_rate=args.unavailable_rate,
+        ban_after_requests=args.ban_after_requests,
+        seed=args.seed,
+    )
+    site = StandInSite(site_config)
+    base_url = site.start()
+    logging.info(f"Stand-in site running at {base_url}")
+
+    _point_checker_at(base_url, site_config, args)
+
+    from notify import flush_notifications
+    from visa_checker import main as checker_main
+    from visa_checker import utils as checker_utils
+    from visa_checker.config import CITIES
+    from visa_checker.db import create_db_connection, create_tables
+
+    create_tables()
+    with create_db_connection() as conn:
+        with conn.cursor() as cur:
+            # Far enough out that every date in the preferred window is better
+            cur.execute(
+                "INSERT INTO misc (key, value) VALUES ('current_appointment_date', %s)"
+                " ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value",
+                ((datetime.date.today() + datetime.timedelta(days=3650)).isoformat(),),
+            )
+
+    recorder = _Recorder(site)
+    recorder.time(checker_main, "check_availability_for_city", "check")
+    recorder.time(checker_utils, "record_new_dates", "db")
+    recorder.time(checker_utils, "send_notification", "notify")
+    recorder.watch_detections(checker_utils, "process_availability_for_city")
+
+    start_time = time.monotonic()
+    work_queue = _BenchQueue(
+        [city for city in CITIES.values() if not city.skip],
+        start_time + args.duration,
+    )
+    checker_main.work_queue = work_queue
+
+    checker_main.run_sessions(args.headed, True, args.direct, args.response_timeout)
+
+    elapsed = time.monotonic() - start_time
+    flush_notifications()
+    site.stop()
+
+    check_times = recorder.timings["check"]
+    db_time = sum(recorder.timings["db"])
+    notify_time = sum(recorder.timings["notify"])
+
+    print(
+        "\n".join(
+            [
+                f"Ran for {elapsed:.1f}s against the stand-in site "
+                f"({'direct' if args.direct else 'dropdown'} requests)",
+                f"Checks: {len(check_times)} "
+                f"({len(check_times) / elapsed * 60:.1f}/min)",
+                f"Check latency: {_summarize(check_times)}",
+                f"Detection latency: {_summarize(list(recorder.detections.values()))}",
+                f"Notification latency: {_summarize(_notification_latencies(site))}",
+                "Time to book: "
+                + _summarize(
+                    [
+                        booking.booked_at - booking.appeared_at
+                        for booking in site.bookings
+                        if booking.appeared_at is not None
+                    ]
+                ),
+                f"DB: {len(recorder.timings['db'])} calls, {db_time:.3f}s "
+                f"({db_time / max(sum(check_times), 1e-9):.1%} of check time)",
+                f"Notify: {len(recorder.timings['notify'])} queued, "
+                f"{notify_time:.3f}s, {len(site.notifications)} delivered",
+                f"Site: {site.churn_events} availability changes, "
+                f"requests {dict(site.requests)}",
+            ]
+        )
+    )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-1s [%(threadName)s]: %(message)s",
+        level=logging.INFO,
+        datefmt="%Y-%m-%d %H:%M:%S",
+        handlers=[logging.FileHandler(args.log)],
+    )
+
+    run_benchmark(args)
@@ -0,0 +1,263 @@
+import datetime
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Optional
+
+from playwright.sync_api import Error as PlaywrightError
+
+from config import (
+    BROWSER_MAX_AGE,
+    BROWSER_MAX_RSS_MB,
+    BROWSER_WATCHDOG_INTERVAL,
+    Account,
+)
+from page import new_session_context
+from routing import ResourceBlocker
+
+# Launches are serialized so the processes started by each one can be told apart
+# from those started by other workers' browsers.
+_launch_lock = threading.Lock()
+
+
+def _parent_pids() -> dict[int, int]:
+    """
+    Map every running pid to its parent's pid. Empty where there's no /proc.
+    """
+    parents = {}
+
+    try:
+        entries = os.listdir("/proc")
+    except FileNotFoundError:
+        return parents
+
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            # Exited while we were looking
+            continue
+
+        # The process name is in parentheses and may contain spaces itself
+        parents[int(entry)] = int(stat.rsplit(")", 1)[1].split()[1])
+
+    return parents
+
+
+def _descendants(root: int, parents: dict[int, int]) -> set[int]:
+    children = defaultdict(list)
+    for pid, parent_pid in parents.items():
+        children[parent_pid].append(pid)
+
+    found = set()
+    stack = [root]
+    while stack:
+        for child in children[stack.pop()]:
+            if child not in found:
+                found.add(child)
+                stack.append(child)
+
+    return found
+
+
+def _process_name(pid: int) -> str:
+    try:
+        with open(f"/proc/{pid}/comm") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def _rss_bytes(pids: set[int]) -> int:
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                total += int(f.read().split()[1]) * page_size
+        except OSError:
+            continue
+
+    return total
+
+
+class BrowserManager:
+    """
+    Keeps one browser running across auth sessions. Each session gets a fresh
+    context and page on the same browser so signing back in after a 401 doesn't
+    pay for a browser launch.
+
+    The browser is relaunched once its process tree uses more than
+    BROWSER_MAX_RSS_MB or it's been running for BROWSER_MAX_AGE, to keep memory
+    use predictable over multi-day runs.
+
+    With `block_resources`, every context gets a `routing.ResourceBlocker`. That
+    turns off the browser's HTTP cache, so it's only for sessions that fetch the
+    days JSON directly rather than through the page.
+
+    Like the playwright objects it holds, it belongs to the thread that made it.
+    """
+
+    def __init__(
+        self,
+        playwright,
+        headed: bool,
+        block_resources: bool = False,
+        max_rss_mb: int = BROWSER_MAX_RSS_MB,
+        max_age: datetime.timedelta = BROWSER_MAX_AGE,
+    ):
+        self._playwright = playwright
+        self._headed = headed
+        self._block_resources = block_resources
+        self._max_rss_mb = max_rss_mb
+        self._max_age = max_age
+
+        self._browser = None
+        self._context = None
+        self._launched_at: Optional[datetime.datetime] = None
+        # Top level browser processes, found when the browser is launched
+        self._browser_pids: set[int] = set()
+        self._last_watchdog_check = 0.0
+        self._recycle_reason: Optional[str] = None
+        self.launches = 0
+        self.resource_blocker = ResourceBlocker()
+
+    def new_page(self, account: Account):
+        """
+        Open a page in a new context for `account`, closing the previous one.
+        Relaunches the browser first if it's due to be recycled.
+        """
+        self._close_context()
+
+        if self._browser is not None and (
+            self._recycle_reason is not None or not self._browser.is_connected()
+        ):
+            logging.info(
+                f"Recycling browser ({self._recycle_reason or 'disconnected'})"
+            )
+            self._close_browser()
+
+        if self._browser is None:
+            self._launch()
+
+        self._context = new_session_context(self._browser, account)
+        if self._block_resources:
+            self.resource_blocker.install(self._context)
+        return self._context.new_page()
+
+    def needs_recycle(self) -> bool:
+        """
+        Whether the browser has crossed its memory or age limit and the current
+        session should end so `new_page` can relaunch it. Memory is only measured
+        every BROWSER_WATCHDOG_INTERVAL seconds so this is cheap to call often.
+        """
+        if self._browser is None:
+            return False
+
+        now = time.monotonic()
+        if (
+            self._recycle_reason is None
+            and now - self._last_watchdog_check >= BROWSER_WATCHDOG_INTERVAL
+        ):
+            self._last_watchdog_check = now
+            self._recycle_reason = self._check_limits()
+
+        return self._recycle_reason is not None
+
+    def stats(self) -> dict:
+        """
+        Current browser resource use, for logs and metrics. `rss_mb` is None if
+        the browser's processes can't be measured on this platform.
+        """
+        if self._browser is None:
+            return {"rss_mb": None, "pages": 0, "age": None, "launches": self.launches}
+
+        parents = _parent_pids()
+        pids = set()
+        for root in self._browser_pids:
+            if root in parents:
+                pids |= {root} | _descendants(root, parents)
+
+        return {
+            "rss_mb": _rss_bytes(pids) / (1024 * 1024) if pids else None,
+            "pages": sum(len(context.pages) for context in self._browser.contexts),
+            "age": datetime.datetime.now() - self._launched_at,
+            "launches": self.launches,
+        }
+
+    def close(self):
+        self._close_context()
+        self._close_browser()
+
+    def _check_limits(self) -> Optional[str]:
+        if not self._browser.is_connected():
+            return "disconnected"
+
+        stats = self.stats()
+        rss_mb = stats["rss_mb"]
+        logging.info(
+            f"Browser has been up for {stats['age']} with {stats['pages']} pages "
+            f"using {'unknown' if rss_mb is None else f'{rss_mb:.0f}MB'} of memory"
+        )
+        if self._block_resources:
+            self.resource_blocker.log_stats()
+
+        if stats["age"] >= self._max_age:
+            return f"running for {stats['age']}"
+
+        if rss_mb is not None and rss_mb > self._max_rss_mb:
+            return f"using {rss_mb:.0f}MB of memory"
+
+        return None
+
+    def _launch(self):
+        with _launch_lock:
+            pids_before = set(_parent_pids())
+            self._browser = self._playwright.firefox.launch(headless=not self._headed)
+            parents = _parent_pids()
+
+        # The new processes under us are the browser and its content processes
+        # (plus the playwright driver if another worker just started one)
+        started = _descendants(os.getpid(), parents) - pids_before
+        self._browser_pids = {
+            pid
+            for pid in started
+            if parents[pid] not in started and _process_name(pid) != "node"
+        }
+
+        self._launched_at = datetime.datetime.now()
+        self._last_watchdog_check = time.monotonic()
+        self._recycle_reason = None
+        self.launches += 1
+        logging.info(f"Launched browser (launch {self.launches})")
+
+    def _close_context(self):
+        if self._context is None:
+            return
+
+        try:
+            self._context.close()
+        except PlaywrightError as e:
+            # The browser may have crashed or been closed underneath us
+            logging.info(f"Failed to close browser context: {e}")
+
+        self._context = None
+
+    def _close_browser(self):
+        if self._browser is None:
+            return
+
+        try:
+            self._browser.close()
+        except PlaywrightError as e:
+            logging.info(f"Failed to close browser: {e}")
+
+        self._browser = None
+        self._browser_pids = set()
@@ -0,0 +1,109 @@
+import atexit
+import logging
+import threading
+from typing import Optional
+
+from config import (
+    CITIES,
+    CLUSTER_HEARTBEAT_INTERVAL,
+    CLUSTER_LEASE_SECONDS,
+    CLUSTER_NODE_ID,
+    City,
+)
+from repo import (
+    claim_city_job,
+    complete_city_job,
+    deregister_checker_node,
+    record_node_heartbeat,
+    register_checker_node,
+    release_city_job,
+)
+
+
+class ClusterCoordinator:
+    """
+    Shares city checks with the other checkers using the same db. Each due city
+    is leased to one node at a time through the city_jobs table, so adding nodes
+    spreads the polling over more accounts and IPs instead of repeating it.
+
+    Leases are renewed by a heartbeat every CLUSTER_HEARTBEAT_INTERVAL seconds
+    and expire CLUSTER_LEASE_SECONDS after the last one, at which point any
+    other node can take the check over.
+
+    Thread-safe so it can be shared by every worker.
+    """
+
+    def __init__(
+        self,
+        node_id: str = CLUSTER_NODE_ID,
+        lease_seconds: float = CLUSTER_LEASE_SECONDS,
+        heartbeat_interval: float = CLUSTER_HEARTBEAT_INTERVAL,
+    ):
+        self.node_id = node_id
+        self._lease_seconds = lease_seconds
+        self._heartbeat_interval = heartbeat_interval
+        self._city_ids = [city.id for city in CITIES.values() if not city.skip]
+        self._stopped = threading.Event()
+        self._live_nodes: Optional[int] = None
+
+    def start(self):
+        register_checker_node(self.node_id, self._city_ids)
+        logging.info(f"Joined cluster as {self.node_id}")
+
+        threading.Thread(
+            target=self._heartbeat, name="cluster-heartbeat", daemon=True
+        ).start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self._stopped.is_set():
+            return
+
+        self._stopped.set()
+        deregister_checker_node(self.node_id)
+        logging.info(f"Left cluster as {self.node_id}")
+
+    def claim(self) -> Optional[City]:
+        """
+        Lease the next due city check, if there is one. It has to be handed back
+        with `complete` or `release`.
+        """
+        claimed = claim_city_job(self.node_id, self._lease_seconds, self._city_ids)
+        if claimed is None:
+            return None
+
+        city_id, previous_node_id = claimed
+        if previous_node_id is not None and previous_node_id != self.node_id:
+            logging.info(
+                f"Took over {city_id} from unresponsive node {previous_node_id}"
+            )
+
+        return CITIES[city_id]
+
+    def complete(self, city: City, next_check_in: float):
+        """
+        Hand back a checked city, due again in `next_check_in` seconds.
+        """
+        if not complete_city_job(city.id, self.node_id, next_check_in):
+            logging.warning(
+                f"Lease on {city.name} was taken over before the check finished"
+            )
+
+    def release(self, city: City):
+        """
+        Hand back a city that couldn't be checked so another node can have a go.
+        """
+        release_city_job(city.id, self.node_id)
+
+    def _heartbeat(self):
+        while not self._stopped.wait(self._heartbeat_interval):
+            try:
+                live_nodes = record_node_heartbeat(self.node_id, self._lease_seconds)
+            except Exception as e:
+                # The leases last a few heartbeats so a blip doesn't lose them
+                logging.warning(f"Failed to record cluster heartbeat: {e}")
+                continue
+
+            if live_nodes != self._live_nodes:
+                logging.info(f"Cluster has {live_nodes} live nodes")
+                self._live_nodes = live_nodes
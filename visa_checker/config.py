@@ -1,7 +1,17 @@
 from dataclasses import dataclass
+import datetime
+import json
 import os
+import socket
+from urllib.parse import urlsplit
 
 NTFY_TOPIC = os.environ["VISA_CHECKER_NTFY_TOPIC"]
+NTFY_URL = os.environ.get("VISA_CHECKER_NTFY_URL", "https://ntfy.sh")
+
+# Can point at a local stand-in site (see standin.py) for benchmarks
+VISA_BASE_URL = os.environ.get(
+    "VISA_CHECKER_BASE_URL", "https://ais.usvisa-info.com"
+).rstrip("/")
 
 
 @dataclass
@@ -26,7 +36,155 @@ CITIES = {
 
 VISA_APP_USER_EMAIL = os.environ["VISA_CHECKER_APP_USER_EMAIL"]
 VISA_APP_USER_PW = os.environ["VISA_CHECKER_APP_USER_PW"]
+
+
+@dataclass
+class Account:
+    email: str
+    password: str
+
+
+def _load_accounts() -> list[Account]:
+    """
+    The main account plus any extra accounts for the worker pool, configured as
+    VISA_CHECKER_APP_USER_EMAIL_2/VISA_CHECKER_APP_USER_PW_2, _3, etc.
+    """
+    accounts = [Account(email=VISA_APP_USER_EMAIL, password=VISA_APP_USER_PW)]
+
+    n = 2
+    while f"VISA_CHECKER_APP_USER_EMAIL_{n}" in os.environ:
+        accounts.append(
+            Account(
+                email=os.environ[f"VISA_CHECKER_APP_USER_EMAIL_{n}"],
+                password=os.environ[f"VISA_CHECKER_APP_USER_PW_{n}"],
+            )
+        )
+        n += 1
+
+    return accounts
+
+
+ACCOUNTS = _load_accounts()
+
+# Browser storage state is saved here after signing in so restarts can skip it
+SESSION_STATE_DIR = os.environ.get("VISA_CHECKER_SESSION_STATE_DIR", ".session_state")
+
+# The browser is kept across sessions and only relaunched once its process tree
+# uses more than this much memory (in MB) or has been running this long
+BROWSER_MAX_RSS_MB = int(os.environ.get("VISA_CHECKER_BROWSER_MAX_RSS_MB", "1024"))
+BROWSER_MAX_AGE = datetime.timedelta(
+    hours=int(os.environ.get("VISA_CHECKER_BROWSER_MAX_AGE_HOURS", "12"))
+)
+# Seconds between checks of the browser's memory use
+BROWSER_WATCHDOG_INTERVAL = 60
+
+# Browser requests that aren't needed to check dates or reschedule are aborted:
+# files on the site with these extensions and anything not on the allowed domains
+# or their subdomains. URLs matching any of the allowed patterns are never
+# aborted, by default the scripts, styles and images the datepicker and booking
+# form use. Patterns are regexes run by the browser driver so they need to be
+# valid JavaScript too.
+ROUTE_BLOCKED_EXTENSIONS = [
+    extension
+    for extension in os.environ.get(
+        "VISA_CHECKER_ROUTE_BLOCKED_EXTENSIONS",
+        "png,jpg,jpeg,gif,svg,ico,webp,woff,woff2,ttf,otf,eot,mp4,webm",
+    ).split(",")
+    if extension
+]
+ROUTE_ALLOWED_DOMAINS = os.environ.get(
+    "VISA_CHECKER_ROUTE_ALLOWED_DOMAINS", urlsplit(VISA_BASE_URL).hostname
+).split(",")
+ROUTE_ALLOWED_URL_PATTERNS = json.loads(
+    os.environ.get(
+        "VISA_CHECKER_ROUTE_ALLOWED_URL_PATTERNS",
+        '["jquery", "datepicker", "ui-icons", "ui-bg_"]',
+    )
+)
+
 DB_NAME = os.environ["VISA_CHECKER_DB_NAME"]
 DB_HOST = os.environ["VISA_CHECKER_DB_HOST"]
 DB_USER = os.environ["VISA_CHECKER_DB_USER"]
 DB_PW = os.environ["VISA_CHECKER_DB_PW"]
+DB_POOL_MIN_SIZE = int(os.environ.get("VISA_CHECKER_DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.environ.get("VISA_CHECKER_DB_POOL_MAX_SIZE", "4"))
+# Pooled connections idle for longer than this are checked before being reused
+DB_POOL_HEALTH_CHECK_SECONDS = int(
+    os.environ.get("VISA_CHECKER_DB_POOL_HEALTH_CHECK_SECONDS", "30")
+)
+
+# A full availability snapshot is stored alongside the appeared/disappeared
+# events whenever either of these is reached for a city
+SNAPSHOT_EVERY_EVENTS = 500
+SNAPSHOT_MAX_AGE = datetime.timedelta(days=1)
+
+# Available dates that are worth rescheduling to. A date is preferred if it matches
+# any of the rules and a rule matches if all of its conditions do:
+#   before: "%Y-%m-%d" - dates before this one
+#   after: "%Y-%m-%d" - dates after this one
+#   between: ["%Y-%m-%d", "%Y-%m-%d"] - dates in this range, inclusive
+#   weekdays: ["Monday", ...] - dates on one of these days
+#   cities: ["89", ...] - only applies to these city ids
+#   min_days_earlier: N - dates at least N days before the current appointment
+# Can be overridden with a JSON list in VISA_CHECKER_PREFERRED_DATE_RULES.
+PREFERRED_DATE_RULES = (
+    json.loads(os.environ["VISA_CHECKER_PREFERRED_DATE_RULES"])
+    if "VISA_CHECKER_PREFERRED_DATE_RULES" in os.environ
+    else [
+        {"between": ["2024-06-11", "2024-07-05"]},
+    ]
+)
+
+# Poll scheduling. Each city is checked somewhere between the min and max
+# interval (in seconds) depending on how often its availability changes. Cities
+# start out at the max, hourly like before there was a scheduler, and only move
+# towards the min once their checks find changes.
+POLL_MIN_INTERVAL = 15 * 60
+POLL_MAX_INTERVAL = 60 * 60
+# How quickly a city's churn estimate follows its latest checks, from 0 to 1
+POLL_CHURN_SMOOTHING = 0.3
+# Request budget shared by every check, with room for a short burst. Every city
+# hourly is 7 requests an hour, the rest is headroom for cities that churn.
+POLL_REQUESTS_PER_HOUR = int(os.environ.get("VISA_CHECKER_REQUESTS_PER_HOUR", "10"))
+POLL_BURST = 5
+# Each temp ban within the window doubles poll intervals, up to the max multiplier
+POLL_BAN_WINDOW = datetime.timedelta(hours=24)
+POLL_MAX_BAN_MULTIPLIER = 8
+# Cities are polled harder in the hours of the week they've released slots in
+# before. The interval is divided by how many times more releases the coming
+# hour has seen than the city's average hour, up to the max boost, but not below
+# the release window interval. Cities need enough releases on record first.
+POLL_RELEASE_MAX_BOOST = 4
+POLL_RELEASE_MIN_INTERVAL = 2 * 60
+POLL_RELEASE_MIN_RELEASES = 20
+
+# Keep the work queue in the db so a restart carries on where it stopped
+WORK_QUEUE_PERSIST = os.environ.get("VISA_CHECKER_WORK_QUEUE_PERSIST", "0") == "1"
+
+# Logs and the event log are rotated at this size (in bytes) or age, whichever
+# comes first
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_ROTATE_INTERVAL = datetime.timedelta(days=1)
+LOG_BACKUP_COUNT = 7
+# Each line of code gets this many messages below WARNING a minute, the rest are
+# dropped
+LOG_RATE_LIMIT_PER_MINUTE = 30
+# Share of each kind of event to keep in the event log, eg. {"check": 0.1}.
+# Kinds that aren't listed are all kept.
+EVENT_SAMPLE_RATES = json.loads(os.environ.get("VISA_CHECKER_EVENT_SAMPLE_RATES", "{}"))
+
+# Metrics are served on this local port unless it's 0, and written out every
+# interval (in seconds) when a metrics file is given
+METRICS_PORT = int(os.environ.get("VISA_CHECKER_METRICS_PORT", "9464"))
+METRICS_FILE_INTERVAL = 60
+
+# Cluster mode. Checkers pointed at the same db share the cities between them by
+# claiming due checks from the city_jobs table instead of each polling them all.
+CLUSTER_MODE = os.environ.get("VISA_CHECKER_CLUSTER", "0") == "1"
+CLUSTER_NODE_ID = os.environ.get(
+    "VISA_CHECKER_NODE_ID", f"{socket.gethostname()}-{os.getpid()}"
+)
+# Claimed checks are leased for this long (in seconds) and the lease is renewed
+# with every heartbeat, so a node's checks are taken over once it stops beating
+CLUSTER_LEASE_SECONDS = 90
+CLUSTER_HEARTBEAT_INTERVAL = 15
@@ -1,5 +1,7 @@
 import datetime
 import calendar
+import functools
+from typing import Iterable, Iterator, Union
 
 
 def is_between_dates(
@@ -31,28 +33,161 @@ def parse_month_year_str(s: str) -> tuple[int, int]:
 
 
 def get_weekday(s):
-    return calendar.day_name[datetime.datetime.strptime(s, "%Y-%m-%d").weekday()]
+    return calendar.day_name[datetime.date.fromisoformat(s).weekday()]
 
 
-def is_preferred_date(
-    proposed_date: datetime.datetime, current_date: datetime.datetime
-):
+# Bit 0 of an Availability bitset is this date. Appointments are always in the
+# future so nothing earlier ever needs to be represented.
+_EPOCH = datetime.date(2020, 1, 1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+
+
+def _to_date(d: Union[str, datetime.date]) -> datetime.date:
+    if isinstance(d, datetime.datetime):
+        return d.date()
+    if isinstance(d, datetime.date):
+        return d
+    return datetime.date.fromisoformat(d)
+
+
+def _bit_index(d: Union[str, datetime.date]) -> int:
+    index = _to_date(d).toordinal() - _EPOCH_ORDINAL
+    if index < 0:
+        raise ValueError(f"{d} is before the earliest supported date {_EPOCH}")
+    return index
+
+
+@functools.lru_cache(maxsize=None)
+def _weekday_mask(weekdays: frozenset[int], nbits: int) -> int:
     """
-    Return True if the given `date` is a preferred date over the `current_date`.
-
-    This implementation of this function will differ depending on the needs of the
-    user requesting a visa appointment. A more advanced version of this would expose
-    a configuration format to define different rules for what would qualify as a
-    preferred date eg. (anything sooner than X, anything between Y and Z, etc)
-    but since I made this script just for myself, it was by far simpler to just
-    define the logic I wanted as code.
+    Bitset with every day that falls on one of `weekdays` (0 = Monday) set, for
+    the first `nbits` days from the epoch.
     """
+    week = "".join(
+        "1" if (_EPOCH.weekday() + i) % 7 in weekdays else "0" for i in range(7)
+    )
+    return int((week * (nbits // 7 + 1))[:nbits][::-1] or "0", 2)
+
 
-    if is_between_dates(
-        start=datetime.datetime(year=2024, month=6, day=11),
-        end=datetime.datetime(year=2023, month=7, day=5),
-        query=proposed_date,
-    ):
-        return True
+class Availability:
+    """
+    Immutable set of dates stored as a bitset of day ordinals. Set operations,
+    counting and weekday filtering are integer operations instead of parsing and
+    comparing `%Y-%m-%d` strings.
+
+    Iterating yields the dates as `%Y-%m-%d` strings in ascending order so it can
+    stand in wherever a set of date strings was used.
+    """
 
-    return False
+    __slots__ = ("bits",)
+
+    def __init__(self, bits: int = 0):
+        self.bits = bits
+
+    @classmethod
+    def from_dates(cls, dates: Iterable[Union[str, datetime.date]]) -> "Availability":
+        bits = 0
+        for d in dates:
+            bits |= 1 << _bit_index(d)
+        return cls(bits)
+
+    @classmethod
+    def between(
+        cls, start: Union[str, datetime.date], end: Union[str, datetime.date]
+    ) -> "Availability":
+        """
+        Every date from `start` to `end`, inclusive.
+        """
+        start_index, end_index = _bit_index(start), _bit_index(end)
+        if end_index < start_index:
+            return cls()
+        return cls(((1 << (end_index - start_index + 1)) - 1) << start_index)
+
+    @classmethod
+    def before(cls, end: Union[str, datetime.date]) -> "Availability":
+        """
+        Every date before `end`, exclusive.
+        """
+        end_index = _to_date(end).toordinal() - _EPOCH_ORDINAL
+        return cls((1 << end_index) - 1 if end_index > 0 else 0)
+
+    def with_date(self, d: Union[str, datetime.date]) -> "Availability":
+        return Availability(self.bits | (1 << _bit_index(d)))
+
+    def without_date(self, d: Union[str, datetime.date]) -> "Availability":
+        return Availability(self.bits & ~(1 << _bit_index(d)))
+
+    def on_weekdays(self, weekdays: Iterable[int]) -> "Availability":
+        """
+        Only the dates that fall on one of `weekdays` (0 = Monday).
+        """
+        # Round the mask size up so masks get reused across snapshots
+        nbits = -(-self.bits.bit_length() // 512) * 512
+        return Availability(self.bits & _weekday_mask(frozenset(weekdays), nbits))
+
+    def dates(self) -> Iterator[datetime.date]:
+        bits = self.bits
+        while bits:
+            low_bit = bits & -bits
+            yield datetime.date.fromordinal(_EPOCH_ORDINAL + low_bit.bit_length() - 1)
+            bits ^= low_bit
+
+    def first(self) -> datetime.date:
+        """
+        The earliest date. Raises ValueError if there are no dates.
+        """
+        if not self.bits:
+            raise ValueError("No dates available")
+        low_bit = self.bits & -self.bits
+        return datetime.date.fromordinal(_EPOCH_ORDINAL + low_bit.bit_length() - 1)
+
+    def to_bytes(self) -> bytes:
+        """
+        Compact serialization for the db. The index of the first set bit followed
+        by the bits from there on.
+        """
+        if not self.bits:
+            return b""
+        offset = (self.bits & -self.bits).bit_length() - 1
+        bits = self.bits >> offset
+        return offset.to_bytes(4, "big") + bits.to_bytes(
+            (bits.bit_length() + 7) // 8, "little"
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Availability":
+        if not data:
+            return cls()
+        offset = int.from_bytes(data[:4], "big")
+        return cls(int.from_bytes(data[4:], "little") << offset)
+
+    def __iter__(self) -> Iterator[str]:
+        return (d.isoformat() for d in self.dates())
+
+    def __len__(self) -> int:
+        return self.bits.bit_count()
+
+    def __bool__(self) -> bool:
+        return self.bits != 0
+
+    def __contains__(self, d: Union[str, datetime.date]) -> bool:
+        index = _to_date(d).toordinal() - _EPOCH_ORDINAL
+        return index >= 0 and bool(self.bits >> index & 1)
+
+    def __or__(self, other: "Availability") -> "Availability":
+        return Availability(self.bits | other.bits)
+
+    def __and__(self, other: "Availability") -> "Availability":
+        return Availability(self.bits & other.bits)
+
+    def __sub__(self, other: "Availability") -> "Availability":
+        return Availability(self.bits & ~other.bits)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Availability) and self.bits == other.bits
+
+    def __hash__(self) -> int:
+        return hash(self.bits)
+
+    def __repr__(self) -> str:
+        return f"Availability({{{', '.join(self)}}})"
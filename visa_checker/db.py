@@ -1,14 +1,159 @@
+import contextlib
+import logging
+import threading
+import time
+from typing import Iterator, Optional
+
 import psycopg2
 from psycopg2.extensions import connection
+from psycopg2.pool import ThreadedConnectionPool
 
-from visa_checker.config import DB_HOST, DB_NAME, DB_PW, DB_USER
+from metrics import DB_QUERY_SECONDS
+from visa_checker.config import (
+    DB_HOST,
+    DB_NAME,
+    DB_POOL_HEALTH_CHECK_SECONDS,
+    DB_POOL_MAX_SIZE,
+    DB_POOL_MIN_SIZE,
+    DB_PW,
+    DB_USER,
+    SNAPSHOT_EVERY_EVENTS,
+    SNAPSHOT_MAX_AGE,
+)
 
 
 def create_db_connection() -> connection:
     return psycopg2.connect(dbname=DB_NAME, host=DB_HOST, user=DB_USER, password=DB_PW)
 
 
+class PooledConnection(connection):
+    """
+    Connection handed out by the pool. Remembers which statements have been
+    prepared on it and when it was last used.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements: set[str] = set()
+        self.last_used = time.monotonic()
+
+
+_pool: Optional[ThreadedConnectionPool] = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises instead of blocking when it runs out of
+# connections, so callers wait on this for a free slot first.
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)
+
+
+def _get_pool() -> ThreadedConnectionPool:
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadedConnectionPool(
+                DB_POOL_MIN_SIZE,
+                DB_POOL_MAX_SIZE,
+                dbname=DB_NAME,
+                host=DB_HOST,
+                user=DB_USER,
+                password=DB_PW,
+                connection_factory=PooledConnection,
+            )
+
+    return _pool
+
+
+def _is_healthy(conn: PooledConnection) -> bool:
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        return False
+
+
+def _checkout(db_pool: ThreadedConnectionPool) -> PooledConnection:
+    """
+    Get a working connection from the pool. Connections that were closed or have
+    been idle long enough to have possibly been dropped by a server restart are
+    checked and replaced with fresh ones.
+    """
+
+    for _ in range(DB_POOL_MAX_SIZE + 1):
+        conn = db_pool.getconn()
+
+        if conn.closed == 0 and (
+            time.monotonic() - conn.last_used < DB_POOL_HEALTH_CHECK_SECONDS
+            or _is_healthy(conn)
+        ):
+            return conn
+
+        logging.info("Discarding broken pooled DB connection")
+        db_pool.putconn(conn, close=True)
+
+    raise psycopg2.OperationalError("Could not get a working DB connection")
+
+
+@contextlib.contextmanager
+def pooled_connection() -> Iterator[PooledConnection]:
+    """
+    Borrow a connection from the pool for a single transaction. Commits on
+    success and rolls back on error, the same as `with create_db_connection()`.
+    Connections that break along the way are closed instead of being returned
+    so the next caller reconnects.
+    """
+
+    db_pool = _get_pool()
+
+    with _pool_slots:
+        conn = _checkout(db_pool)
+        broken = False
+
+        try:
+            with conn:
+                yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except Exception:
+            # Prepared statements outlive rolled back transactions. Start over
+            # rather than keep track of which ones made it.
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("DEALLOCATE ALL")
+            conn.prepared_statements.clear()
+            raise
+        finally:
+            conn.last_used = time.monotonic()
+            db_pool.putconn(conn, close=broken or conn.closed != 0)
+
+
+def execute_prepared(cur, name: str, query: str, params: tuple = ()):
+    """
+    Execute `query` as the server side prepared statement `name`, preparing it on
+    the cursor's pooled connection the first time it's used there. `query` takes
+    its parameters as $1, $2, etc.
+    """
+
+    conn = cur.connection
+    start_time = time.monotonic()
+
+    if name not in conn.prepared_statements:
+        cur.execute(f"PREPARE {name} AS {query}")
+        conn.prepared_statements.add(name)
+
+    if params:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f"EXECUTE {name}")
+
+    DB_QUERY_SECONDS.observe(time.monotonic() - start_time, name)
+
+
 def create_available_dates_table():
+    # Full date lists from before availability was stored as events. Only read by
+    # migrate_available_dates now.
     with create_db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
@@ -20,6 +165,265 @@ def create_available_dates_table():
                dates TEXT NOT NULL,
                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
             );
+            CREATE INDEX IF NOT EXISTS available_dates_city_id_created_at_idx
+                ON available_dates (city_id, created_at, id);
+            """
+            )
+
+
+def create_availability_tables():
+    """
+    Availability is stored as the dates that appeared or disappeared for a city
+    on each change, plus a periodic full snapshot so a city's availability at
+    any point can be rebuilt without replaying its whole history.
+    """
+    with create_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+            CREATE TABLE IF NOT EXISTS availability_events (
+               id BIGSERIAL PRIMARY KEY,
+               city_id VARCHAR(6) NOT NULL,
+               date DATE NOT NULL,
+               kind VARCHAR(11) NOT NULL CHECK (kind IN ('appeared', 'disappeared')),
+               created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE INDEX IF NOT EXISTS availability_events_city_id_id_idx
+                ON availability_events (city_id, id);
+            CREATE INDEX IF NOT EXISTS availability_events_city_id_created_at_idx
+                ON availability_events (city_id, created_at);
+
+            CREATE TABLE IF NOT EXISTS availability_snapshots (
+               id BIGSERIAL PRIMARY KEY,
+               city_id VARCHAR(6) NOT NULL,
+               dates TEXT NOT NULL,
+               last_event_id BIGINT,
+               created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE INDEX IF NOT EXISTS availability_snapshots_city_id_created_at_idx
+                ON availability_snapshots (city_id, created_at, id);
+
+            -- Snapshots are stored as a packed date_utils.Availability bitset.
+            -- Only snapshots migrated from available_dates use the text dates.
+            ALTER TABLE availability_snapshots
+                ADD COLUMN IF NOT EXISTS packed BYTEA;
+            ALTER TABLE availability_snapshots ALTER COLUMN dates DROP NOT NULL;
+            """
+            )
+
+
+def migrate_available_dates():
+    """
+    Convert the full date lists stored in available_dates on every poll into
+    availability events and snapshots. Only runs while the new tables are empty
+    so it's safe to call on every start.
+    """
+    with create_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "select exists(select 1 from availability_events) or"
+                " exists(select 1 from availability_snapshots)"
+            )
+            if cur.fetchone()[0]:
+                return
+
+        logging.info("Migrating available_dates into availability events")
+
+        with conn.cursor(name="available_dates_history") as history:
+            history.itersize = 10000
+            history.execute(
+                "select city_id, dates, created_at from available_dates"
+                " ORDER BY city_id, created_at, id"
+            )
+
+            city_id = None
+            rows = 0
+
+            with conn.cursor() as cur:
+                for row_city_id, dates, created_at in history:
+                    if row_city_id != city_id:
+                        city_id = row_city_id
+                        previous_dates = set()
+                        events_since_snapshot = 0
+                        last_snapshot_at = None
+
+                    current_dates = set(dates.split(",")) if dates else set()
+                    events = [
+                        (date, "appeared")
+                        for date in sorted(current_dates - previous_dates)
+                    ] + [
+                        (date, "disappeared")
+                        for date in sorted(previous_dates - current_dates)
+                    ]
+                    rows += 1
+
+                    if not events:
+                        continue
+
+                    for date, kind in events:
+                        cur.execute(
+                            "INSERT INTO availability_events (city_id, date, kind,"
+                            " created_at) VALUES (%s, %s, %s, %s) RETURNING id",
+                            (city_id, date, kind, created_at),
+                        )
+                    last_event_id = cur.fetchone()[0]
+                    events_since_snapshot += len(events)
+                    previous_dates = current_dates
+
+                    if (
+                        last_snapshot_at is None
+                        or events_since_snapshot >= SNAPSHOT_EVERY_EVENTS
+                        or created_at - last_snapshot_at >= SNAPSHOT_MAX_AGE
+                    ):
+                        cur.execute(
+                            "INSERT INTO availability_snapshots (city_id, dates,"
+                            " last_event_id, created_at) VALUES (%s, %s, %s, %s)",
+                            (
+                                city_id,
+                                ",".join(sorted(current_dates)),
+                                last_event_id,
+                                created_at,
+                            ),
+                        )
+                        events_since_snapshot = 0
+                        last_snapshot_at = created_at
+
+        logging.info(f"Migrated {rows} available_dates rows")
+
+
+def create_temp_ban_tables():
+    """
+    History of temp bans and the probes sent while waiting them out. Used to
+    learn how long bans tend to last.
+    """
+    with create_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+            CREATE TABLE IF NOT EXISTS temp_bans (
+               id SERIAL PRIMARY KEY,
+               started_at TIMESTAMP NOT NULL,
+               ended_at TIMESTAMP
+            );
+            CREATE INDEX IF NOT EXISTS temp_bans_started_at_idx
+                ON temp_bans (started_at);
+
+            CREATE TABLE IF NOT EXISTS temp_ban_probes (
+               id SERIAL PRIMARY KEY,
+               ban_id INTEGER NOT NULL REFERENCES temp_bans (id),
+               probed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+               still_banned BOOLEAN NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS temp_ban_probes_ban_id_idx
+                ON temp_ban_probes (ban_id);
+            """
+            )
+
+
+def create_booking_attempts_table():
+    """
+    Every attempt at rescheduling to a preferred date and how long it took, to
+    keep an eye on how fast slots get booked.
+    """
+    with create_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+            CREATE TABLE IF NOT EXISTS booking_attempts (
+               id SERIAL PRIMARY KEY,
+               city_id VARCHAR(6),
+               date DATE NOT NULL,
+               path VARCHAR(20) NOT NULL,
+               submitted BOOLEAN NOT NULL,
+               seconds DOUBLE PRECISION NOT NULL,
+               created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+            )
+
+
+def create_work_queue_table():
+    """
+    Checks waiting in the work queue, kept when persistence is on so a restart
+    carries on where it stopped.
+    """
+    with create_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+            CREATE TABLE IF NOT EXISTS work_queue (
+               city_id VARCHAR(6) PRIMARY KEY,
+               priority DOUBLE PRECISION NOT NULL,
+               due_at TIMESTAMP NOT NULL,
+               enqueued_at TIMESTAMP NOT NULL
+            );
+            """
+            )
+
+
+def create_cluster_tables():
+    """
+    Shared state for cluster mode. city_jobs holds when each city is next due
+    and which node, if any, has leased its check. checker_nodes holds every
+    node's latest heartbeat.
+    """
+    with create_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+            CREATE TABLE IF NOT EXISTS city_jobs (
+               city_id VARCHAR(6) PRIMARY KEY,
+               due_at TIMESTAMP NOT NULL,
+               leased_by VARCHAR(100),
+               lease_expires_at TIMESTAMP,
+               last_checked_at TIMESTAMP,
+               last_checked_by VARCHAR(100)
+            );
+            CREATE INDEX IF NOT EXISTS city_jobs_due_at_idx ON city_jobs (due_at);
+
+            CREATE TABLE IF NOT EXISTS checker_nodes (
+               node_id VARCHAR(100) PRIMARY KEY,
+               started_at TIMESTAMP NOT NULL,
+               heartbeat_at TIMESTAMP NOT NULL
+            );
+            """
+            )
+
+
+def create_analytics_tables():
+    """
+    Aggregates kept by analytics.py as availability is recorded. Releases are
+    counted per city by local weekday (0 is Monday) and hour, and slot lifetimes
+    per city in the buckets of analytics.LIFETIME_BUCKETS. open_slots holds when
+    each currently available date appeared.
+    """
+    with create_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+            CREATE TABLE IF NOT EXISTS release_stats (
+               city_id VARCHAR(6) NOT NULL,
+               weekday SMALLINT NOT NULL,
+               hour SMALLINT NOT NULL,
+               releases INTEGER NOT NULL,
+               dates_released INTEGER NOT NULL,
+               PRIMARY KEY (city_id, weekday, hour)
+            );
+
+            CREATE TABLE IF NOT EXISTS open_slots (
+               city_id VARCHAR(6) NOT NULL,
+               date DATE NOT NULL,
+               appeared_at TIMESTAMP NOT NULL,
+               PRIMARY KEY (city_id, date)
+            );
+
+            CREATE TABLE IF NOT EXISTS slot_lifetime_stats (
+               city_id VARCHAR(6) NOT NULL,
+               bucket SMALLINT NOT NULL,
+               slots INTEGER NOT NULL,
+               total_seconds DOUBLE PRECISION NOT NULL,
+               PRIMARY KEY (city_id, bucket)
+            );
             """
             )
 
@@ -44,4 +448,11 @@ def create_tables():
     for simplicity. This is more or less a one time use script.
     """
     create_available_dates_table()
+    create_availability_tables()
+    create_temp_ban_tables()
+    create_booking_attempts_table()
+    create_work_queue_table()
+    create_cluster_tables()
+    create_analytics_tables()
     create_misc_table()
+    migrate_available_dates()
@@ -0,0 +1,246 @@
+import atexit
+import dataclasses
+import datetime
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from dataclasses import dataclass
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import ClassVar, Optional
+
+from date_utils import Availability
+from config import (
+    EVENT_SAMPLE_RATES,
+    LOG_BACKUP_COUNT,
+    LOG_MAX_BYTES,
+    LOG_RATE_LIMIT_PER_MINUTE,
+    LOG_ROTATE_INTERVAL,
+)
+
+# Events only go where setup_logging sends them, never to the text log
+_events = logging.getLogger("visa_checker.events")
+_events.propagate = False
+
+
+@dataclass
+class CheckEvent:
+    kind: ClassVar[str] = "check"
+
+    city_id: str
+    # "dates", "not_modified" or the name of the error the check ran into
+    result: str
+    seconds: float
+    dates: Optional[int] = None
+
+    @classmethod
+    def of(
+        cls, city_id: str, current_dates: Optional[Availability], seconds: float
+    ) -> "CheckEvent":
+        """
+        Event for a check that got a response, `current_dates` being None for a 304
+        """
+        if current_dates is None:
+            return cls(city_id, "not_modified", seconds)
+
+        return cls(city_id, "dates", seconds, len(current_dates))
+
+
+@dataclass
+class DiffEvent:
+    kind: ClassVar[str] = "diff"
+
+    city_id: str
+    appeared: list[str]
+    disappeared: list[str]
+
+
+@dataclass
+class BanEvent:
+    kind: ClassVar[str] = "ban"
+
+    # "started", "still_banned" or "lifted"
+    phase: str
+    banned_at: str
+    seconds_banned: float
+
+
+@dataclass
+class RescheduleEvent:
+    kind: ClassVar[str] = "reschedule"
+
+    city_id: Optional[str]
+    date: str
+    path: str
+    # "submitted" or "abandoned"
+    result: str
+    seconds: float
+
+
+def emit(event):
+    """
+    Write `event` to the event log. Only queues it, the event is serialized and
+    written on the logging thread.
+    """
+    _events.info(event.kind, extra={"event": event})
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(
+            {
+                "ts": datetime.datetime.fromtimestamp(record.created).isoformat(),
+                "kind": record.event.kind,
+                **dataclasses.asdict(record.event),
+            },
+            separators=(",", ":"),
+        )
+
+
+class _RotatingFileHandler(RotatingFileHandler):
+    """
+    Rolls the file over once it reaches `max_bytes` or has been written to for
+    `interval`, whichever comes first.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        max_bytes: int,
+        interval: datetime.timedelta,
+        backup_count: int,
+    ):
+        super().__init__(
+            filename,
+            maxBytes=max_bytes,
+            backupCount=backup_count,
+            encoding="utf-8",
+            delay=True,
+        )
+        self._interval = interval.total_seconds()
+        self._rollover_at = time.time() + self._interval
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        return time.time() >= self._rollover_at or super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self._rollover_at = time.time() + self._interval
+
+
+class _RateLimiter(logging.Filter):
+    """
+    Lets each line of code log `per_minute` messages below WARNING a minute.
+    The rest are dropped, and how many were is noted on that line's next
+    message. Events are sampled instead (see `_EventSampler`).
+    """
+
+    def __init__(self, per_minute: int):
+        super().__init__()
+        self._per_minute = per_minute
+        self._lock = threading.Lock()
+        # (pathname, lineno) -> [window start, messages in window, suppressed]
+        self._windows: dict[tuple, list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or hasattr(record, "event"):
+            return True
+
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= 60:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+            elif window[1] < self._per_minute:
+                window[1] += 1
+                return True
+            else:
+                window[2] += 1
+                return False
+
+        if suppressed:
+            record.msg = (
+                f"{record.getMessage()} ({suppressed} more from this line were "
+                "suppressed in the last minute)"
+            )
+            record.args = None
+
+        return True
+
+
+class _EventSampler(logging.Filter):
+    """
+    Keeps the share of each kind of event given in `rates`, and all of the
+    kinds that aren't in it.
+    """
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self._rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        event = getattr(record, "event", None)
+        if event is None:
+            return True
+
+        rate = self._rates.get(event.kind, 1.0)
+        return rate >= 1 or random.random() < rate
+
+
+def _is_event(record: logging.LogRecord) -> bool:
+    return hasattr(record, "event")
+
+
+def _is_not_event(record: logging.LogRecord) -> bool:
+    return not hasattr(record, "event")
+
+
+def setup_logging(log_path: str, event_log_path: Optional[str] = None):
+    """
+    Send every log message, and events to `event_log_path` as JSON lines, through
+    a queue to a background thread that does the formatting and writing. Logging
+    on the hot path only costs the rate limiting and handing the record over.
+    """
+
+    text_formatter = logging.Formatter(
+        "%(asctime)s %(levelname)-1s [%(threadName)s]: %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    handlers = [
+        _RotatingFileHandler(
+            log_path, LOG_MAX_BYTES, LOG_ROTATE_INTERVAL, LOG_BACKUP_COUNT
+        ),
+        logging.StreamHandler(),
+    ]
+    for handler in handlers:
+        handler.setFormatter(text_formatter)
+        handler.addFilter(_is_not_event)
+
+    if event_log_path:
+        event_handler = _RotatingFileHandler(
+            event_log_path, LOG_MAX_BYTES, LOG_ROTATE_INTERVAL, LOG_BACKUP_COUNT
+        )
+        event_handler.setFormatter(_JsonFormatter())
+        event_handler.addFilter(_is_event)
+        handlers.append(event_handler)
+
+    records = queue.SimpleQueue()
+    queue_handler = QueueHandler(records)
+    queue_handler.addFilter(_RateLimiter(LOG_RATE_LIMIT_PER_MINUTE))
+    queue_handler.addFilter(_EventSampler(EVENT_SAMPLE_RATES))
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(queue_handler)
+    _events.addHandler(queue_handler)
+
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    # Writes out whatever is still queued
+    atexit.register(listener.stop)
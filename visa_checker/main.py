@@ -1,21 +1,61 @@
 import argparse
+import asyncio
 import datetime
 import logging
 import random
+import threading
 from time import sleep
+from typing import Optional
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from playwright.sync_api import sync_playwright
 
+from visa_checker import async_main
+from visa_checker.analytics import get_release_profile
+from visa_checker.browser import BrowserManager
+from visa_checker.cluster import ClusterCoordinator
 from visa_checker.db import create_tables
-from visa_checker.utils import AvailabilityCheckError, check_availability_for_city
-from visa_checker.config import CITIES, City
-from visa_checker.page import VisaPageWrapper
+from visa_checker.event_log import setup_logging
+from visa_checker.utils import (
+    AvailabilityCheckError,
+    check_availability_for_city,
+    process_unsolicited_availability,
+)
+from visa_checker.config import (
+    ACCOUNTS,
+    CITIES,
+    CLUSTER_MODE,
+    METRICS_FILE_INTERVAL,
+    METRICS_PORT,
+    WORK_QUEUE_PERSIST,
+    Account,
+)
+from visa_checker.page import RESPONSE_TIMEOUT, VisaPageWrapper
+from visa_checker.replay import ResponseRecorder, replay_capture
+from visa_checker.scheduler import PollScheduler
+from visa_checker.work_queue import PRIORITY_RETRY, WorkQueue
 
-work_queue: list[City] = []
+# Imported by its flat name like in the modules that record metrics, so they
+# share the same ones
+from metrics import WORK_QUEUE_DEPTH, start_metrics_server, write_metrics_file
 
+# Shared by every worker
+work_queue = WorkQueue(persist=WORK_QUEUE_PERSIST)
+WORK_QUEUE_DEPTH.set_function(lambda: len(work_queue))
+poll_scheduler = PollScheduler(list(CITIES.values()))
+# Set by --record
+response_recorder: Optional[ResponseRecorder] = None
+# Set in cluster mode, where cities are claimed from the db instead of work_queue
+cluster: Optional[ClusterCoordinator] = None
 
-def start_session(headed: bool, one_cycle: bool):
+
+def start_session(
+    browser_manager: BrowserManager,
+    one_cycle: bool,
+    direct: bool,
+    response_timeout: float,
+    account: Optional[Account] = None,
+) -> bool:
     """
     Starts a browser session which logs in and starts processing jobs from the
     work_queue. Each job means querying a city for its available dates and performing
@@ -24,80 +64,298 @@ def start_session(headed: bool, one_cycle: bool):
 
     The session will last until the authentication token expires at which point this
     function will exit. Continuous processing that persists across multiple auth sessions
-    can be performed by running this function in a loop.
+    can be performed by running this function in a loop. Sessions share the browser
+    from `browser_manager`, and a session also ends early when the browser is due to
+    be recycled.
+
+    When `direct` is set, availability is fetched straight from the days JSON
+    endpoint with the browser's session instead of through the facility dropdown.
+
+    In cluster mode jobs are claimed from the db, shared with the other nodes,
+    instead of taken from the work_queue.
+
+    :return bool - True if `one_cycle` is set and the work_queue has been drained
     """
-    global work_queue
 
     logging.info("Starting a new tracking browser session")
 
+    account = account or ACCOUNTS[0]
+    page_wrapper = VisaPageWrapper(
+        browser_manager.new_page(account),
+        direct=direct,
+        response_timeout=response_timeout,
+        account=account,
+        recorder=response_recorder,
+    )
+    page_wrapper.resume_or_sign_in()
+
+    while page_wrapper.logged_in:
+        if browser_manager.needs_recycle():
+            # The session is saved so the next one resumes it on a fresh browser
+            return False
+
+        page_wrapper.wait_out_ban()
+        page_wrapper.keep_booking_page_warm()
+
+        if cluster:
+            city = cluster.claim()
+        else:
+            # Waits a little for the poll scheduler to queue up more cities
+            city = work_queue.get(timeout=random.uniform(1, 3))
+
+        if city:
+            sleep(poll_scheduler.reserve_request())
+            logging.info(f"Checking dates for {city.name}")
+
+            try:
+                current_dates = check_availability_for_city(page_wrapper, city)
+            except AvailabilityCheckError as e:
+                if page_wrapper.last_temp_banned_time is not None:
+                    poll_scheduler.record_ban()
+                if cluster:
+                    cluster.release(city)
+                else:
+                    work_queue.put(city, priority=PRIORITY_RETRY)
+                continue
+            except BaseException:
+                # Don't leave the city leased to us until the process exits
+                if cluster:
+                    cluster.release(city)
+                raise
+
+            next_check_in = poll_scheduler.record_check(city, current_dates)
+            if cluster:
+                cluster.complete(city, next_check_in)
+            process_unsolicited_availability(page_wrapper)
+        elif one_cycle and (cluster or not work_queue):
+            logging.info("Finished running one cycle of checks and returning")
+            return True
+        elif cluster:
+            # Wait for a city to come due on this or any other node
+            sleep(random.uniform(1, 3))
+
+    return False
+
+
+def run_sessions(
+    headed: bool,
+    one_cycle: bool,
+    direct: bool,
+    response_timeout: float,
+    account: Optional[Account] = None,
+):
+    """
+    Keep starting new sessions as auth expires until a `one_cycle` run finishes.
+    The browser is launched once and kept across sessions.
+    """
+
     with sync_playwright() as p:
-        browser = p.firefox.launch(headless=not headed)
+        # Blocking resources turns off the browser's HTTP cache, which the days
+        # JSON requests made through the page rely on for 304s
+        browser_manager = BrowserManager(p, headed, block_resources=direct)
 
-        page_wrapper = VisaPageWrapper(browser.new_page())
-        page_wrapper.sign_in()
+        try:
+            while not start_session(
+                browser_manager, one_cycle, direct, response_timeout, account
+            ):
+                pass
+        finally:
+            browser_manager.close()
 
-        while page_wrapper.logged_in:
-            page_wrapper.wait_out_ban()
 
-            if work_queue:
-                city = work_queue.pop(0)
-                logging.info(f"Checking dates for {city.name}")
+def start_worker_pool(
+    workers: int, headed: bool, one_cycle: bool, direct: bool, response_timeout: float
+):
+    """
+    Run `workers` independent browser sessions on their own threads, all pulling
+    from the shared work_queue. Accounts from config are handed out round robin.
 
-                try:
-                    check_availability_for_city(page_wrapper, city)
-                except AvailabilityCheckError as e:
-                    work_queue.append(city)
-                    continue
-            else:
-                if one_cycle:
-                    logging.info("Finished running one cycle of checks and returning")
-                    exit(1)
+    Every worker keeps its own login and ban state, so a worker that is waiting out
+    a ban or signing back in simply stops taking jobs while the rest carry on.
+    Sync playwright objects can't be shared across threads so each worker launches
+    its own browser.
+    """
+
+    threads = [
+        threading.Thread(
+            target=run_sessions,
+            name=f"worker-{i + 1}",
+            args=(headed, one_cycle, direct, response_timeout),
+            kwargs={"account": ACCOUNTS[i % len(ACCOUNTS)]},
+            daemon=True,
+        )
+        for i in range(workers)
+    ]
+
+    for thread in threads:
+        thread.start()
 
-            # Just a small delay to prevent the loop from being run too
-            # frequently when the work_queue is empty
-            sleep(random.uniform(5, 10))
+    for thread in threads:
+        thread.join()
 
 
 def add_jobs():
-    global work_queue
+    for city in poll_scheduler.due_cities():
+        logging.info(f"Adding job for {city.name}")
+        # Cities whose availability changes most often go first
+        work_queue.put(city, priority=poll_scheduler.churn(city))
 
-    logging.info("Adding cities to job queue...")
 
-    for city in CITIES.values():
-        if city.skip:
-            continue
+def refresh_release_profile():
+    # Lets the poll scheduler check cities harder in their usual release windows
+    poll_scheduler.set_release_profile(get_release_profile())
 
-        logging.info(f"Adding job for {city.name}")
-        work_queue.append(city)
+
+def log_work_queue_stats():
+    stats = work_queue.stats()
+    wait_p90 = stats["wait_p90"]
+    logging.info(
+        f"Work queue has {stats['depth']} checks ({stats['ready']} due, oldest "
+        f"waiting {stats['oldest_ready_wait']:.1f}s). p90 wait "
+        f"{'n/a' if wait_p90 is None else f'{wait_p90:.1f}s'} over the last "
+        f"{stats['wait_samples']} checks, {stats['deduplicated']} of "
+        f"{stats['puts']} adds were already queued"
+    )
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--log", default='log.txt')
+    parser.add_argument("--log", default="log.txt")
+    parser.add_argument(
+        "--event-log",
+        default="events.jsonl",
+        help="JSON lines log of checks, availability changes, bans and reschedules",
+    )
     parser.add_argument("--headed", action=argparse.BooleanOptionalAction)
     parser.add_argument("--one-cycle", action=argparse.BooleanOptionalAction)
-    return parser.parse_args()
+    parser.add_argument("--direct", action=argparse.BooleanOptionalAction)
+    parser.add_argument(
+        "--engine",
+        choices=["sync", "async"],
+        default="sync",
+        help="async runs DB writes and notifications alongside the browser loop",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of browser sessions checking cities in parallel",
+    )
+    parser.add_argument(
+        "--response-timeout",
+        type=float,
+        default=RESPONSE_TIMEOUT,
+        help="Seconds to wait for a city's days JSON response",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="PATH",
+        help="Capture every days JSON response to a scrubbed gzipped file",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="PATH",
+        help="Process a capture from --record as fast as possible and exit. "
+        "Stores availability like normal so use a scratch db.",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=METRICS_PORT,
+        help="Local port to serve Prometheus metrics on, 0 to turn it off",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        metavar="PATH",
+        help=f"Also write the metrics to a file every {METRICS_FILE_INTERVAL}s",
+    )
+    parser.add_argument(
+        "--profile",
+        action=argparse.BooleanOptionalAction,
+        help="Profile CPU and memory use while replaying",
+    )
+    args = parser.parse_args()
+
+    if args.workers > 1 and args.engine == "async":
+        parser.error("--workers is only supported by the sync engine")
+
+    if CLUSTER_MODE and args.engine == "async":
+        parser.error("Cluster mode is only supported by the sync engine")
+
+    return args
 
 
 if __name__ == "__main__":
     args = parse_args()
     create_tables()
 
-    logging.basicConfig(
-        format="%(asctime)s %(levelname)-1s: %(message)s",
-        level=logging.INFO,
-        datefmt="%Y-%m-%d %H:%M:%S",
-        handlers=[logging.FileHandler(args.log), logging.StreamHandler()],
-    )
+    setup_logging(args.log, args.event_log)
+
+    if args.replay:
+        replay_capture(args.replay, profile=args.profile)
+        exit(0)
+
+    if args.record:
+        response_recorder = ResponseRecorder(args.record)
+
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
 
     scheduler = BackgroundScheduler()
+    if args.metrics_file:
+        scheduler.add_job(
+            write_metrics_file,
+            "interval",
+            seconds=METRICS_FILE_INTERVAL,
+            args=[args.metrics_file],
+        )
     scheduler.add_job(
-        add_jobs,
+        refresh_release_profile,
         "interval",
-        seconds=60 * 60,
+        hours=1,
         next_run_time=datetime.datetime.now(),
     )
+
+    if CLUSTER_MODE:
+        cluster = ClusterCoordinator()
+        cluster.start()
+    else:
+        if work_queue.persist:
+            work_queue.restore()
+
+        # The poll scheduler decides when each city is due, this just hands due
+        # cities to the workers
+        scheduler.add_job(
+            add_jobs,
+            "interval",
+            seconds=5,
+            next_run_time=datetime.datetime.now(),
+        )
+        scheduler.add_job(log_work_queue_stats, "interval", minutes=5)
+
     scheduler.start()
 
-    while True:
-        start_session(args.headed, args.one_cycle)
+    if args.engine == "async":
+        asyncio.run(
+            async_main.run_sessions(
+                work_queue,
+                poll_scheduler,
+                args.headed,
+                args.one_cycle,
+                args.direct,
+                args.response_timeout,
+                response_recorder,
+            )
+        )
+    elif args.workers > 1:
+        start_worker_pool(
+            args.workers,
+            args.headed,
+            args.one_cycle,
+            args.direct,
+            args.response_timeout,
+        )
+    else:
+        run_sessions(args.headed, args.one_cycle, args.direct, args.response_timeout)
+
+    exit(1)
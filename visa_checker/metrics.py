@@ -0,0 +1,255 @@
+import bisect
+import logging
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+# Every module imports this one by its flat name, including main.py, so there's
+# only one copy of the metrics no matter how the rest were imported.
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+]
+
+_metrics: list["_Metric"] = []
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+
+        return super().render() + [
+            f"{self.name}{_format_labels(self.labels, label_values)} "
+            f"{_format_value(value)}"
+            for label_values, value in sorted(values.items())
+        ]
+
+
+class Gauge(_Metric):
+    """
+    Gauge read from `func` whenever the metrics are rendered, so keeping it up
+    to date costs nothing.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self._func: Optional[Callable[[], float]] = None
+
+    def set_function(self, func: Callable[[], float]):
+        self._func = func
+
+    def render(self) -> list[str]:
+        if self._func is None:
+            return []
+
+        return super().render() + [f"{self.name} {_format_value(self._func())}"]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: list[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # label values -> (count per bucket with +Inf last, sum)
+        self._values: dict[tuple, tuple[list[int], float]] = {}
+
+    def observe(self, value: float, *label_values):
+        bucket = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts, total = self._values.get(label_values) or (
+                [0] * (len(self.buckets) + 1),
+                0.0,
+            )
+            counts[bucket] += 1
+            self._values[label_values] = (counts, total + value)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = {
+                label_values: (list(counts), total)
+                for label_values, (counts, total) in self._values.items()
+            }
+
+        lines = super().render()
+        for label_values, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + [float("inf")], counts):
+                cumulative += count
+                le = f'le="{_format_value(upper_bound)}"'
+                lines.append(
+                    f"{self.name}_bucket"
+                    f"{_format_labels(self.labels, label_values, le)} {cumulative}"
+                )
+
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+
+        return lines
+
+
+SIGN_IN_SECONDS = Histogram(
+    "visa_checker_sign_in_seconds",
+    "Time to get a signed in scheduler page, by whether a saved session was resumed",
+    ("kind",),
+)
+CHECK_STAGE_SECONDS = Histogram(
+    "visa_checker_check_stage_seconds",
+    "Time spent in each stage of checking a city's dates",
+    ("stage",),
+)
+DAYS_RESPONSES = Counter(
+    "visa_checker_days_responses_total",
+    "Days JSON responses by status, with suspected temp bans and missing "
+    "responses counted separately",
+    ("status",),
+)
+DB_QUERY_SECONDS = Histogram(
+    "visa_checker_db_query_seconds",
+    "Time to execute each prepared statement",
+    ("query",),
+)
+NOTIFICATION_SECONDS = Histogram(
+    "visa_checker_notification_seconds",
+    "Time to deliver a batch of notifications to ntfy, by result",
+    ("result",),
+)
+BOOKING_SECONDS = Histogram(
+    "visa_checker_booking_seconds",
+    "Time from starting a reschedule to confirming or abandoning it",
+    ("path", "result"),
+)
+WORK_QUEUE_WAIT_SECONDS = Histogram(
+    "visa_checker_work_queue_wait_seconds",
+    "Time checks waited in the work queue after coming due",
+)
+WORK_QUEUE_DEPTH = Gauge(
+    "visa_checker_work_queue_depth", "Checks waiting in the work queue"
+)
+
+
+def render_metrics() -> str:
+    """
+    Every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in list(_metrics):
+        lines.extend(metric.render())
+
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would drown out the checker's own logs
+        pass
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> Optional[str]:
+    """
+    Serve the metrics at /metrics from a background thread.
+
+    :return str - the metrics url, or None if the port couldn't be bound
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        logging.warning(f"Could not serve metrics on {host}:{port} - {e}")
+        return None
+
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+    url = f"http://{host}:{server.server_address[1]}/metrics"
+    logging.info(f"Serving metrics at {url}")
+    return url
+
+
+def write_metrics_file(path: str):
+    """
+    Write every metric to `path`, replacing it in one go so readers never see
+    a partial file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(
+        "w", dir=directory, prefix=".metrics-", delete=False, encoding="utf-8"
+    ) as f:
+        f.write(f"# Written at {time.time():.0f}\n")
+        f.write(render_metrics())
+
+    os.replace(f.name, path)
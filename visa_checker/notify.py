@@ -1,13 +1,173 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from typing import Optional
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import NTFY_TOPIC, NTFY_URL
+from metrics import NOTIFICATION_SECONDS
+
+# Notifications queued within this many seconds of each other go out as one digest
+COALESCE_SECONDS = 5
+MAX_QUEUED_NOTIFICATIONS = 100
+REQUEST_TIMEOUT = 10
+
+
+class NotificationDispatcher:
+    """
+    Sends notifications from a background thread so a slow or unreachable ntfy
+    server never holds up availability checks.
+
+    Notifications that come in close together (eg. several cities opening slots
+    at once) are coalesced into a single digest. Requests go over a keep-alive
+    session and are retried with backoff.
+
+    :param priority - ntfy priority to send every notification with
+    """
+
+    def __init__(
+        self,
+        url: str,
+        coalesce_seconds: float = COALESCE_SECONDS,
+        max_queued: int = MAX_QUEUED_NOTIFICATIONS,
+        timeout: float = REQUEST_TIMEOUT,
+        priority: Optional[str] = None,
+    ):
+        self.url = url
+        self.coalesce_seconds = coalesce_seconds
+        self.timeout = timeout
+        self.priority = priority
+        self.enabled = True
+
+        self._queue: queue.Queue[tuple[str, str]] = queue.Queue(maxsize=max_queued)
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+
+        self._session = requests.Session()
+        self._session.mount(
+            url.split("://")[0] + "://",
+            HTTPAdapter(
+                pool_maxsize=1,
+                max_retries=Retry(
+                    total=5,
+                    backoff_factor=1,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=["POST"],
+                ),
+            ),
+        )
+
+    def send(self, title: str, msg: str):
+        """
+        Queue a notification without waiting for it to be sent. Dropped with a
+        warning if the queue is full.
+        """
+        if not self.enabled:
+            return
+
+        self._ensure_thread()
+
+        try:
+            self._queue.put_nowait((title, msg))
+        except queue.Full:
+            logging.warning(f"Notification queue is full. Dropping - {title} - {msg}")
+
+    def flush(self, timeout: float = 30):
+        """
+        Wait up to `timeout` seconds for queued notifications to be sent.
+        """
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+    def _ensure_thread(self):
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="notifications", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+
+            deadline = time.monotonic() + self.coalesce_seconds
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self._post(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _post(self, batch: list[tuple[str, str]]):
+        if len(batch) == 1:
+            title, msg = batch[0]
+        else:
+            title = f"{len(batch)} Visa Appointment Updates"
+            msg = "\n\n".join(f"{t}\n{m}" for t, m in batch)
+
+        headers = {"Title": title}
+        if self.priority:
+            headers["Priority"] = self.priority
+
+        start_time = time.monotonic()
+        result = "sent"
+
+        try:
+            response = self._session.post(
+                self.url,
+                data=msg.encode("utf-8"),
+                headers=headers,
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+        except requests.RequestException as e:
+            result = "failed"
+            logging.warning(f"Failed to send notification - {title} - {e}")
+
+        NOTIFICATION_SECONDS.observe(time.monotonic() - start_time, result)
+
+
+_dispatcher = NotificationDispatcher(f"{NTFY_URL}/{NTFY_TOPIC}")
+# Urgent notifications get their own thread so they never wait behind a digest
+_urgent_dispatcher = NotificationDispatcher(
+    f"{NTFY_URL}/{NTFY_TOPIC}", coalesce_seconds=0, priority="high"
+)
+atexit.register(_dispatcher.flush)
+atexit.register(_urgent_dispatcher.flush)
+
+
+def send_notification(title: str, msg: str, urgent: bool = False):
+    """
+    :param urgent - send straight away with a high priority instead of as part of
+        a digest, for the alerts that can't wait (eg. a preferred date)
+    """
+    (_urgent_dispatcher if urgent else _dispatcher).send(title, msg)
+
 
-from visa_checker.config import NTFY_TOPIC
+def flush_notifications(timeout: float = 30):
+    """
+    Wait up to `timeout` seconds for queued notifications to be sent.
+    """
+    deadline = time.monotonic() + timeout
+    _urgent_dispatcher.flush(timeout)
+    _dispatcher.flush(max(0.0, deadline - time.monotonic()))
 
 
-def send_notification(title: str, msg: str):
-    requests.post(
-        f"https://ntfy.sh/{NTFY_TOPIC}",
-        data=msg,
-        headers={
-            "Title": title,
-        },
-    )
+def disable_notifications():
+    """
+    Drop every notification from now on, eg. while replaying a capture.
+    """
+    _dispatcher.enabled = False
+    _urgent_dispatcher.enabled = False
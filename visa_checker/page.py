@@ -1,16 +1,90 @@
 import calendar
+import hashlib
+import json
 import logging
 import datetime
+import os
 import random
 import time
 import re
-from typing import Optional
+from typing import TYPE_CHECKING, Callable, Iterator, Optional
 
-from date_utils import parse_month_year_str
-from config import CITIES, VISA_APP_USER_EMAIL, VISA_APP_USER_PW, City
+import requests
+from playwright.sync_api import Error as PlaywrightError
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+from requests.adapters import HTTPAdapter
 
-VISA_URL = "https://ais.usvisa-info.com/en-ca/niv/users/sign_in"
+from date_utils import Availability, parse_month_year_str
+from config import (
+    ACCOUNTS,
+    CITIES,
+    SESSION_STATE_DIR,
+    VISA_BASE_URL,
+    Account,
+    City,
+)
+from repo import (
+    get_ban_durations,
+    record_ban_end,
+    record_ban_probe,
+    record_ban_start,
+    record_booking_attempt,
+)
+from event_log import BanEvent, RescheduleEvent, emit
+from metrics import (
+    BOOKING_SECONDS,
+    CHECK_STAGE_SECONDS,
+    DAYS_RESPONSES,
+    SIGN_IN_SECONDS,
+)
+from scheduler import ban_probe_offsets
+
+if TYPE_CHECKING:
+    from replay import ResponseRecorder
+
+VISA_URL = f"{VISA_BASE_URL}/en-ca/niv/users/sign_in"
 JSON_URL_REGEX = re.compile(r"appointment\/days\/(\d+)\.json")
+APPOINTMENT_URL_REGEX = re.compile(r"^(.*\/schedule\/\d+\/appointment)")
+
+# Default seconds to wait for the days JSON response after selecting a facility
+RESPONSE_TIMEOUT = 2 * 60
+
+# Seconds to wait on a direct days JSON request before treating it as no response
+DIRECT_REQUEST_TIMEOUT = 30
+
+# Seconds to wait for the appointment form to load the time slots for a date
+TIME_SLOTS_TIMEOUT = 10
+
+# Sets the appointment date the same way the datepicker does, so the form's own
+# change handler loads the time slots for it
+SET_APPOINTMENT_DATE_JS = """
+date => {
+    const input = document.querySelector("#appointments_consulate_appointment_date");
+    input.value = date;
+    if (window.jQuery) {
+        window.jQuery(input).trigger("change");
+    } else {
+        input.dispatchEvent(new Event("change", { bubbles: true }));
+    }
+}
+"""
+HAS_TIME_OPTION_JS = """
+time => Array.from(
+    document.querySelectorAll("#appointments_consulate_appointment_time option")
+).some(option => option.value === time)
+"""
+HAS_TIME_OPTIONS_JS = """
+() => document.querySelectorAll(
+    "#appointments_consulate_appointment_time option"
+).length >= 2
+"""
+
+# Seconds between reloads of the page parked on the reschedule form
+BOOKING_PAGE_REFRESH_INTERVAL = 10 * 60
+
+# Cities that reliably have at least some availability. An empty result for any
+# of them almost always means that we've been temp banned.
+BAN_INDICATOR_CITY_NAMES = ["Calgary", "Vancouver", "Ottawa"]
 
 
 class ServiceUnavailableError(Exception):
@@ -29,33 +103,612 @@ class TempBannedError(Exception):
     pass
 
 
-class VisaPageWrapper:
-    def __init__(self, page):
+def handle_days_response(
+    city: City,
+    status: int,
+    url: str,
+    get_text: Callable[[], str],
+    recorder: Optional["ResponseRecorder"] = None,
+) -> Optional[Availability]:
+    """
+    Turn a days JSON response into the available dates for `city`. Shared by
+    every way of fetching the days JSON so they all raise the same errors.
+
+    :param recorder - captures the response for `replay.replay_capture`
+    """
+    logging.info(f"Handling response for {city.name}")
+    start_time = time.monotonic()
+
+    try:
+        return _handle_days_response(city, status, url, get_text, recorder)
+    finally:
+        CHECK_STAGE_SECONDS.observe(time.monotonic() - start_time, "handle")
+
+
+def _handle_days_response(
+    city: City,
+    status: int,
+    url: str,
+    get_text: Callable[[], str],
+    recorder: Optional["ResponseRecorder"],
+) -> Optional[Availability]:
+    if status in (301, 302, 303, 307, 308):
+        # Requests made with an expired session get redirected to the sign in page
+        logging.info(f"{city.name} response - Redirected to sign in. Treating as 401.")
+        status = 401
+
+    if status != 200:
+        DAYS_RESPONSES.inc(str(status))
+        if recorder is not None:
+            recorder.record(city.id, status)
+
+    if status == 401:
+        # Unauthorized - Auth expired
+        logging.info(
+            f"{city.name} response - Received 401. Adding job back to work_queue "
+            "and setting IS_LOGGED_IN to False to trigger new session."
+        )
+        raise UnauthorizedError()
+    elif status == 503:
+        logging.info("Received 503. Service temporarily unavailable.")
+        raise ServiceUnavailableError()
+    elif status >= 400:
+        logging.info("Ran into network request error. Exiting.")
+        logging.info(status)
+        logging.info(url)
+        logging.info(get_text())
+        exit(1)
+
+    if status == 304:
+        # Not modified
+        logging.info(f"304 Not Modified for {city.name}")
+        return None
+
+    # Temp bans sometimes come back as a 200 with no body at all
+    body = get_text()
+    try:
+        days = json.loads(body) if body.strip() else []
+    except json.JSONDecodeError as e:
+        # Followed a redirect to the sign in page, which comes back as a 200
+        logging.info(
+            f"{city.name} response - Received HTML instead of JSON, most likely the "
+            "sign in page. Treating as 401."
+        )
+        DAYS_RESPONSES.inc("401")
+        if recorder is not None:
+            recorder.record(city.id, 401)
+        raise UnauthorizedError() from e
+
+    current_dates = Availability.from_dates(d["date"] for d in days)
+
+    if recorder is not None:
+        recorder.record(city.id, status, list(current_dates))
+
+    if not current_dates and city.name in BAN_INDICATOR_CITY_NAMES:
+        # Most likely temp banned if we're getting empty results for any of these
+        # cities since I know they likely have at least some availability.
+        logging.info(
+            f"Received empty result for {city.name}. Most likely temp banned. "
+            "Setting TEMP_BANNED=True."
+        )
+        DAYS_RESPONSES.inc("ban")
+        raise TempBannedError()
+
+    DAYS_RESPONSES.inc("200")
+    return current_dates
+
+
+def parse_time_slots(body: str) -> list[str]:
+    """
+    Return the available times from a times JSON response body.
+    """
+    return json.loads(body).get("available_times") or []
+
+
+def ban_event(phase: str, banned_at: datetime.datetime) -> BanEvent:
+    return BanEvent(
+        phase,
+        banned_at.isoformat(),
+        (datetime.datetime.now() - banned_at).total_seconds(),
+    )
+
+
+def _session_state_path(account: Account) -> str:
+    digest = hashlib.sha256(account.email.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(SESSION_STATE_DIR, f"{digest}.json")
+
+
+def load_session_state(account: Account) -> Optional[dict]:
+    """
+    Return the browser storage state and scheduler page url saved by the
+    account's last sign in, if there is one.
+    """
+    try:
+        with open(_session_state_path(account)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_session_state(account: Account, storage_state: dict, scheduler_url: str):
+    """
+    Save the browser storage state (cookies, local storage) and scheduler page url
+    so the next session can skip signing in. The file holds live session cookies
+    so it's only readable by us.
+    """
+    os.makedirs(SESSION_STATE_DIR, exist_ok=True)
+    path = _session_state_path(account)
+    tmp_path = f"{path}.tmp"
+
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump({"storage_state": storage_state, "scheduler_url": scheduler_url}, f)
+
+    os.replace(tmp_path, path)
+
+
+def new_session_context(browser, account: Account):
+    """
+    Create a browser context for `account`, restoring the storage state from its
+    last sign in if there is one.
+    """
+    session_state = load_session_state(account)
+    return browser.new_context(
+        storage_state=session_state["storage_state"] if session_state else None
+    )
+
+
+class PageWrapperBase:
+    """
+    State and bookkeeping shared by `VisaPageWrapper` and
+    `async_page.AsyncVisaPageWrapper`. Nothing here calls into Playwright, so the
+    wrappers only make the browser calls, sync or awaitable, and hand what comes
+    back to these methods.
+    """
+
+    def __init__(
+        self,
+        page,
+        direct: bool,
+        response_timeout: float,
+        account: Optional[Account],
+        recorder: Optional["ResponseRecorder"],
+    ):
         self.page = page
+        self.account = account or ACCOUNTS[0]
+        self.recorder = recorder
+        self.direct = direct
+        self.response_timeout = response_timeout
         self.logged_in = False
         self.last_temp_banned_time = None
 
+        self._days_url_base: Optional[str] = None
+        # city_id -> conditional request headers from the last 200 response
+        self._validators: dict[str, dict[str, str]] = {}
+
+        session_state = load_session_state(self.account)
+        self._scheduler_url: Optional[str] = (
+            session_state["scheduler_url"] if session_state else None
+        )
+
+        # Second page parked on the reschedule form, see keep_booking_page_warm
+        self._booking_page = None
+        self.booking_page_ready = False
+        self._booking_page_loaded_at = 0.0
+
+        # city_id -> waiter for a requested days JSON response
+        self._response_waiters: dict[str, object] = {}
+        # city_id -> latest days JSON response that nobody was waiting for
+        self._unsolicited_responses: dict[str, object] = {}
+        self.page.on("response", self._route_response)
+
+    def _reset_request_state(self):
+        # Cookies and CSRF token change with every sign in
+        self._days_url_base = None
+        self._validators.clear()
+        self.booking_page_ready = False
+        self._booking_page_loaded_at = 0.0
+
+    def _on_scheduler_page(self) -> bool:
+        return APPOINTMENT_URL_REGEX.search(self.page.url) is not None
+
+    def _check_scheduler_page(self):
+        """
+        :raises UnauthorizedError - if loading the scheduler page was redirected,
+            which only happens once the session has expired
+        """
+        if not self._on_scheduler_page():
+            logging.info(f"Scheduler page redirected to {self.page.url}")
+            raise UnauthorizedError()
+
+    def _booking_page_due(self) -> bool:
+        """
+        Whether the booking page needs opening or reloading. The wrapper then
+        calls `_start_booking_page_load`, loads it and calls
+        `_finish_booking_page_load`.
+        """
+        if not self.logged_in or self._scheduler_url is None:
+            return False
+
+        return (
+            self._booking_page is None
+            or self._booking_page.is_closed()
+            or time.monotonic() - self._booking_page_loaded_at
+            >= BOOKING_PAGE_REFRESH_INTERVAL
+        )
+
+    def _start_booking_page_load(self):
+        self.booking_page_ready = False
+        self._booking_page_loaded_at = time.monotonic()
+
+    def _finish_booking_page_load(self):
+        # Bookings go back to the polling page until this one loads properly
+        self.booking_page_ready = (
+            APPOINTMENT_URL_REGEX.search(self._booking_page.url) is not None
+        )
+        if not self.booking_page_ready:
+            logging.info(f"Booking page ended up on {self._booking_page.url}")
+
+    def _take_booking_page(self):
+        """
+        Hand the booking page over to a booking. Later bookings go back to the
+        polling page until it's released again with `_release_booking_page`.
+        """
+        logging.info("Booking on the parked booking page")
+        self.booking_page_ready = False
+        return self._booking_page
+
+    def _release_booking_page(self):
+        # Whatever happened, it needs to be reloaded before the next booking
+        self._booking_page_loaded_at = 0.0
+
+    def _note_booking(
+        self,
+        city: Optional[City],
+        date: datetime.date,
+        path: str,
+        selected: bool,
+        start_time: float,
+    ) -> float:
+        """
+        Log and emit the outcome of a booking attempt.
+
+        :return float - seconds the attempt took
+        """
+        seconds = time.monotonic() - start_time
+        result = "submitted" if selected else "abandoned"
+        logging.info(f"Reschedule to {date} via {path} {result} after {seconds:.3f}s")
+        BOOKING_SECONDS.observe(seconds, path, result)
+        emit(
+            RescheduleEvent(
+                city.id if city else None, date.isoformat(), path, result, seconds
+            )
+        )
+        return seconds
+
+    def _ban_probe_waits(
+        self, banned_at: datetime.datetime, ban_durations: list[float]
+    ) -> Iterator[float]:
+        """
+        Yield the seconds to wait before each ban probe, timed from `banned_at`
+        with `scheduler.ban_probe_offsets`.
+        """
+        for offset in ban_probe_offsets(ban_durations):
+            probe_at = banned_at + datetime.timedelta(seconds=offset)
+            wait = (probe_at - datetime.datetime.now()).total_seconds()
+
+            if wait > 0:
+                logging.info(
+                    f"Temp banned since {banned_at}. Sleeping until {probe_at} "
+                    "before checking again."
+                )
+            yield max(wait, 0.0)
+
+    def _note_ban_probe(self, banned_at: datetime.datetime, still_banned: bool):
+        emit(ban_event("still_banned" if still_banned else "lifted", banned_at))
+
+        if still_banned:
+            logging.info("Still temp banned.")
+            return
+
+        logging.info(
+            "Received valid request. No longer TEMP_BAN. Setting "
+            "LAST_TEMP_BANNED_TIME to None."
+        )
+        self.last_temp_banned_time = None
+
+    def _note_ban_probe_unauthorized(self):
+        logging.info("Received Unauthorized. Setting LOGGED_IN to False")
+        self.logged_in = False
+
+    def _ban_probe_result(self, city: City, status: int, url: str, body: str) -> bool:
+        """
+        :return bool - True if the probe's days JSON response says we're still
+            banned, see `VisaPageWrapper.probe_ban`
+
+        :raises UnauthorizedError - if the session is no longer authorized
+        """
+        # handle_days_response exits on errors it doesn't expect, which mid ban
+        # are just another way of being turned away
+        if status >= 400 and status != 401:
+            logging.info(f"Ban probe received {status}")
+            return True
+
+        try:
+            handle_days_response(city, status, url, lambda: body, self.recorder)
+        except (TempBannedError, ServiceUnavailableError):
+            return True
+
+        return False
+
+    def _handle_selected_response(
+        self,
+        city: City,
+        status: int,
+        url: str,
+        get_text: Callable[[], str],
+        select_time: float,
+    ) -> Optional[Availability]:
+        try:
+            return handle_days_response(city, status, url, get_text, self.recorder)
+        finally:
+            logging.info(
+                f"Handled response for {city.name} "
+                f"{time.monotonic() - select_time:.3f}s after selecting the facility"
+            )
+
+    def _route_response(self, response):
+        """
+        The single response listener for the page. Days JSON responses are matched
+        once and handed to the waiter for their city. Responses for cities nobody is
+        waiting on are kept for `pop_unsolicited_dates`.
+        """
+        match = JSON_URL_REGEX.search(response.url)
+
+        if match is None:
+            return
+
+        city_id = match.group(1)
+        waiter = self._response_waiters.get(city_id)
+
+        if waiter is not None:
+            self._deliver_response(waiter, response)
+        elif city_id in CITIES:
+            logging.info(f"Keeping unsolicited dates JSON response for {city_id}")
+            self._unsolicited_responses[city_id] = response
+
+    def _deliver_response(self, waiter, response):
+        raise NotImplementedError
+
+    def _take_unsolicited_responses(self) -> list[tuple[str, object]]:
+        """
+        Take the unsolicited responses kept so far, skipping any that aren't a 200.
+        handle_days_response exits on statuses it doesn't expect, which is only
+        meant for the check we asked for.
+        """
+        responses, self._unsolicited_responses = self._unsolicited_responses, {}
+
+        kept = []
+        for city_id, response in responses.items():
+            if response.status != 200:
+                logging.info(
+                    f"Skipping unsolicited {response.status} response for {city_id}"
+                )
+                continue
+
+            kept.append((city_id, response))
+
+        return kept
+
+    def _unsolicited_dates(
+        self, city_id: str, response, body: str
+    ) -> Optional[Availability]:
+        """
+        :return None - if the response didn't contain dates
+        """
+        try:
+            return handle_days_response(
+                CITIES[city_id],
+                response.status,
+                response.url,
+                lambda: body,
+                self.recorder,
+            )
+        except (UnauthorizedError, TempBannedError) as e:
+            logging.info(f"Skipping unsolicited response for {city_id} - {e!r}")
+            return None
+
+    def _direct_url_base(self) -> str:
+        match = APPOINTMENT_URL_REGEX.search(self.page.url)
+        if match is None:
+            raise RuntimeError(
+                f"Could not find the appointment page in url {self.page.url}. "
+                "Direct requests need the scheduler page to be open."
+            )
+
+        return match.group(1)
+
+    def _direct_headers_for(self, csrf_token: Optional[str]) -> dict[str, str]:
+        return {
+            "X-CSRF-Token": csrf_token,
+            "X-Requested-With": "XMLHttpRequest",
+            "Accept": "application/json, text/javascript, */*; q=0.01",
+            "Referer": self.page.url,
+        }
+
+    def _days_json_url(self, city: City) -> str:
+        return f"{self._days_url_base}/days/{city.id}.json?appointments[expedite]=false"
+
+    def _times_json_url(self, facility_id: str, date: datetime.date) -> str:
+        return (
+            f"{self._days_url_base}/times/{facility_id}.json?date={date.isoformat()}"
+            "&appointments[expedite]=false"
+        )
+
+    def _conditional_headers(self, city: City, conditional: bool) -> dict[str, str]:
+        return self._validators.get(city.id, {}) if conditional else {}
+
+    def _store_validators(self, city: City, status: int, headers):
+        """
+        Keep the validators from a 200 days JSON response to send with the next
+        request for `city`.
+
+        :param headers - response headers, looked up by lowercase name
+        """
+        if status != 200:
+            return
+
+        validators = {}
+        if "etag" in headers:
+            validators["If-None-Match"] = headers["etag"]
+        if "last-modified" in headers:
+            validators["If-Modified-Since"] = headers["last-modified"]
+        self._validators[city.id] = validators
+
+    def _datepicker_step(
+        self,
+        target_month: int,
+        target_year: int,
+        current_datepicker_months: list[tuple[int, int]],
+    ) -> str:
+        """
+        :return str - selector for the datepicker button that moves towards the
+            target month
+        """
+        left_side_month, left_side_year = current_datepicker_months[0]
+        right_side_month, right_side_year = current_datepicker_months[1]
+
+        if target_year < left_side_year or (
+            target_year == left_side_year and target_month < left_side_month
+        ):
+            return 'span:text-is("Prev")'
+        elif target_year > right_side_year or (
+            target_year == right_side_year and target_month > right_side_month
+        ):
+            return 'span:text-is("Next")'
+
+        raise RuntimeError(
+            f"Impossible condition met. Target Month/Year "
+            f"({(target_month, target_year)}) not found and could not determine if "
+            f"it is before or after current dates {current_datepicker_months}."
+        )
+
+
+class _ResponseWaiter:
+    __slots__ = ("response",)
+
+    def __init__(self):
+        self.response = None
+
+
+class VisaPageWrapper(PageWrapperBase):
+    def __init__(
+        self,
+        page,
+        direct: bool = False,
+        response_timeout: float = RESPONSE_TIMEOUT,
+        account: Optional[Account] = None,
+        recorder: Optional["ResponseRecorder"] = None,
+    ):
+        """
+        :param page - playwright page used to sign in and drive the scheduler UI
+        :param direct - fetch the days JSON directly over HTTP with the browser's
+            session cookies instead of triggering it through the facility dropdown
+        :param response_timeout - seconds to wait for the days JSON response
+        :param account - account to sign in with, defaults to the main account
+        :param recorder - captures every days JSON response handled, see replay.py
+        """
+        super().__init__(page, direct, response_timeout, account, recorder)
+        self._http_session: Optional[requests.Session] = None
+
     def sign_in(self):
-        logging.info("Signing in")
+        logging.info(f"Signing in as {self.account.email}")
+        start_time = time.monotonic()
         self.page.goto(VISA_URL, timeout=60 * 1000)
-        self.page.type("#user_email", VISA_APP_USER_EMAIL, delay=200)
-        self.page.type("#user_password", VISA_APP_USER_PW, delay=200)
+        self.page.type("#user_email", self.account.email, delay=200)
+        self.page.type("#user_password", self.account.password, delay=200)
         self._random_delay()
         self.page.locator("#policy_confirmed").click(force=True)
         self._random_delay()
         self.page.click('input:text-is("Sign In")')
+        self.page.wait_for_selector('a:text-is("Continue")', timeout=60 * 1000)
         self.logged_in = True
         logging.info("Sign in complete")
 
         logging.info("Navigating to scheduler page")
-        self._random_delay()
-        self.page.click('a:text-is("Continue")')
-        self._random_delay()
-        self.page.click('h5:text-is("Reschedule Appointment")')
-        self._random_delay()
-        self.page.click('a:text-is("Reschedule Appointment")')
+        if self._scheduler_url:
+            self.page.goto(self._scheduler_url, timeout=60 * 1000)
+        else:
+            self._random_delay()
+            self.page.click('a:text-is("Continue")')
+            self._random_delay()
+            self.page.click('h5:text-is("Reschedule Appointment")')
+            self._random_delay()
+            self.page.click('a:text-is("Reschedule Appointment")')
+            self.page.wait_for_url(APPOINTMENT_URL_REGEX)
+            self._scheduler_url = self.page.url
         logging.info("Finished navigating to scheduler page")
 
+        save_session_state(
+            self.account, self.page.context.storage_state(), self._scheduler_url
+        )
+        self._reset_request_state()
+        SIGN_IN_SECONDS.observe(time.monotonic() - start_time, "full")
+
+    def resume_or_sign_in(self):
+        """
+        Pick up the session saved by the last sign in if it's still valid, which
+        only takes loading the scheduler page. Falls back to the full sign in.
+        """
+        if self._scheduler_url is None:
+            self.sign_in()
+            return
+
+        logging.info(f"Resuming saved session for {self.account.email}")
+        start_time = time.monotonic()
+        self.page.goto(self._scheduler_url, timeout=60 * 1000)
+
+        # An expired session gets redirected to the sign in page
+        if (
+            not self._on_scheduler_page()
+            or self.page.locator(
+                "#appointments_consulate_appointment_facility_id"
+            ).count()
+            == 0
+        ):
+            logging.info("Saved session has expired")
+            self.sign_in()
+            return
+
+        self.logged_in = True
+        self._reset_request_state()
+        SIGN_IN_SECONDS.observe(time.monotonic() - start_time, "resumed")
+        logging.info("Resumed saved session")
+
+    def keep_booking_page_warm(self):
+        """
+        Keep a second page parked on the reschedule form so a booking can start
+        filling it in straight away instead of navigating there first. The page
+        is opened if needed and reloaded every BOOKING_PAGE_REFRESH_INTERVAL
+        seconds so its form and CSRF token don't go stale, and straight after
+        it's been used. Cheap enough to call between every check.
+        """
+        if not self._booking_page_due():
+            return
+
+        if self._booking_page is None or self._booking_page.is_closed():
+            logging.info("Opening booking page")
+            self._booking_page = self.page.context.new_page()
+
+        self._start_booking_page_load()
+        try:
+            self._booking_page.goto(self._scheduler_url, timeout=60 * 1000)
+        except PlaywrightTimeoutError:
+            logging.warning("Timed out loading the booking page")
+            return
+
+        self._finish_booking_page_load()
+
     def wait_out_ban(self):
         """
         Sometimes our account can get temporarily banned for sending too many
@@ -63,7 +716,9 @@ class VisaPageWrapper:
         ban seems to be lifted after 1-3 hours.
 
         This function will regularly check our ban status and only exit if we're
-        good to send more requests.
+        good to send more requests. Checks are timed from how long previous bans
+        lasted (see `scheduler.ban_probe_offsets`) and the ban and every check are
+        recorded in the db to learn from next time.
 
         Note, this function only runs if we know we've been banned before so it's
         possible that we're banned but we're not aware of it yet even if this
@@ -72,192 +727,351 @@ class VisaPageWrapper:
         back to this function call and start the waiting/checking loop.
         """
 
-        while self.logged_in and self.last_temp_banned_time:
-            if (
-                datetime.datetime.now() - self.last_temp_banned_time
-            ) > datetime.timedelta(hours=1):
-                # More than an hour has passed. Check if we're still banned.
-                logging.info(
-                    "1 hour has passed since the last verified TEMP_BAN. Sending "
-                    "a request to check."
-                )
+        if not (self.logged_in and self.last_temp_banned_time):
+            return
 
-                try:
-                    # Check any city to see if we get a valid request
-                    self.get_available_dates_for_city(CITIES["92"])
-                    logging.info(
-                        "Received valid request. No longer TEMP_BAN. Setting "
-                        "LAST_TEMP_BANNED_TIME to None."
-                    )
-                    self.last_temp_banned_time = None
-                except UnauthorizedError:
-                    logging.info("Received Unauthorized. Setting LOGGED_IN to False")
-                    self.logged_in = False
-                except ServiceUnavailableError:
-                    logging.info("Waiting 30 minutes because service is unavailable.")
-                    time.sleep(30 * 60)
-            else:
-                # Less than an hour has passed since the last known TEMP_BAN.
-                # Sleep for a bit before trying again.
-                logging.info(
-                    "Less than 1 hour has passed since LAST_TEMP_BANNED_TIME "
-                    f"{self.last_temp_banned_time}. Sleeping for 30 minutes."
-                )
-                time.sleep(30 * 60)
+        banned_at = self.last_temp_banned_time
+        ban_id = record_ban_start(banned_at)
+        emit(ban_event("started", banned_at))
+
+        for wait in self._ban_probe_waits(banned_at, get_ban_durations()):
+            time.sleep(wait)
+
+            try:
+                still_banned = self.probe_ban()
+            except UnauthorizedError:
+                self._note_ban_probe_unauthorized()
+                return
+
+            record_ban_probe(ban_id, still_banned)
+            self._note_ban_probe(banned_at, still_banned)
+
+            if not still_banned:
+                record_ban_end(ban_id, datetime.datetime.now())
+                return
+
+    def probe_ban(self) -> bool:
+        """
+        Check if we're still temp banned with a single days JSON request for a city
+        that always has availability. The request goes straight over HTTP and skips
+        the conditional headers since a 304 wouldn't tell us anything.
+
+        The cookies and CSRF token copied over at sign in can go stale over a ban
+        that lasts hours, so the scheduler page is reloaded first to refresh them.
+        Any error other than a 401 counts as still banned.
+
+        :return bool - True if we're still banned or the site couldn't tell us
+
+        :raises UnauthorizedError - if the session is no longer authorized
+        """
+        city = CITIES["92"]
+
+        try:
+            self._refresh_request_state()
+            status, url, body = self._request_days_json(city, conditional=False)
+        except (
+            PlaywrightError,
+            requests.RequestException,
+            NoResponseError,
+            RuntimeError,
+        ) as e:
+            logging.info(f"Ban probe failed - {e!r}")
+            return True
+
+        return self._ban_probe_result(city, status, url, body)
+
+    def _refresh_request_state(self):
+        """
+        Reload the scheduler page to pick up current cookies and a new CSRF token,
+        and have direct requests copy them over again.
+
+        :raises UnauthorizedError - if the session has expired
+        """
+        if self._scheduler_url is None:
+            return
+
+        self.page.goto(self._scheduler_url, timeout=60 * 1000)
+        self._check_scheduler_page()
+        self._days_url_base = None
 
-    def reschedule_appointment(self, month: int, day: int, year: int):
+    def reschedule_appointment(
+        self, month: int, day: int, year: int, city: Optional[City] = None
+    ) -> bool:
+        """
+        Book the latest time slot on the given date at `city`, or at the facility
+        that's currently selected if no city is given.
+
+        Slots can go within seconds so the booking runs on the page parked on the
+        form by `keep_booking_page_warm` when it's ready, leaving the polling page
+        where it is. The date is set straight on the form with
+        `_select_appointment_directly`. Stepping through the datepicker is only
+        the fallback. Time to confirm is logged and recorded for every attempt.
+
+        :return bool - True if the booking was submitted
+        """
         logging.info(f"Rescheduling appointment to {month}/{day}/{year}")
-        self._select_appointment(month=month, day=day, year=year)
+        date = datetime.date(year, month, day)
+
+        if not self.booking_page_ready:
+            return self._book(self.page, date, city)
+
+        page = self._take_booking_page()
+        try:
+            return self._book(page, date, city)
+        finally:
+            self._release_booking_page()
+
+    def _book(self, page, date: datetime.date, city: Optional[City]) -> bool:
+        start_time = time.monotonic()
+        path = "direct"
+
+        if (
+            city is not None
+            and page.input_value("#appointments_consulate_appointment_facility_id")
+            != city.id
+        ):
+            page.select_option(
+                "#appointments_consulate_appointment_facility_id", city.id
+            )
+
+        try:
+            selected = self._select_appointment_directly(page, date)
+        except (
+            PlaywrightTimeoutError,
+            NoResponseError,
+            requests.RequestException,
+            ValueError,
+            RuntimeError,
+        ) as e:
+            logging.warning(f"Direct booking failed, using the datepicker - {e!r}")
+            path = "datepicker"
+            selected = self._select_appointment(
+                page, month=date.month, day=date.day, year=date.year
+            )
+
+        if selected:
+            logging.info("Clicking Reschedule")
+            page.click('input:text-is("Reschedule")')
+
+            logging.info("Clicking Confirm")
+            page.click('a:text-is("Confirm")')
+
+        seconds = self._note_booking(city, date, path, selected, start_time)
+        record_booking_attempt(city.id if city else None, date, path, selected, seconds)
+
+        return selected
+
+    def _select_appointment_directly(self, page, date: datetime.date) -> bool:
+        """
+        Fill in the appointment form without the datepicker. The time slots come
+        from the times JSON so we know which one to pick before the form has
+        loaded them, and then we only wait for that option to show up.
+
+        :return bool - False if there are no time slots left on `date`
+        """
+        facility_id = page.input_value(
+            "#appointments_consulate_appointment_facility_id"
+        )
+        times = self._fetch_time_slots(facility_id, date)
+
+        if not times:
+            logging.info(f"No time slots left on {date}")
+            return False
+
+        page.evaluate(SET_APPOINTMENT_DATE_JS, date.isoformat())
+        page.wait_for_function(
+            HAS_TIME_OPTION_JS, arg=times[-1], timeout=TIME_SLOTS_TIMEOUT * 1000
+        )
+
+        logging.info(f"Selecting appointment time {times[-1]}")
+        page.select_option("#appointments_consulate_appointment_time", times[-1])
+        return True
 
-        logging.info("Clicking Reschedule")
-        self.page.click('input:text-is("Reschedule")')
+    def _fetch_time_slots(self, facility_id: str, date: datetime.date) -> list[str]:
+        """
+        Request the available times for `date` the same way the appointment form
+        does once a date is picked.
+        """
+        session = self._get_http_session()
 
-        logging.info("Clicking Confirm")
-        self.page.click('a:text-is("Confirm")')
+        try:
+            response = session.get(
+                self._times_json_url(facility_id, date), timeout=DIRECT_REQUEST_TIMEOUT
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise NoResponseError() from e
 
-        logging.info("Reschedule complete")
+        response.raise_for_status()
+        return parse_time_slots(response.text)
 
-    def get_available_dates_for_city(self, city: City) -> Optional[set[str]]:
+    def get_available_dates_for_city(self, city: City) -> Optional[Availability]:
         """
         :return None - NotModified
-                set[str] - Set of available dates for the city in the format of `%Y-%m-%d` eg. `2022-3-29`
+                Availability - Available dates for the city, iterable as `%Y-%m-%d` eg. `2022-03-29`
 
         :raises UnauthorizedError - if the session is no longer authorized
         :raises NoResponseError - no matching JSON response found
         :raises ServiceUnavailableError - if 503 is returned
         :raises TempBannedError - Temp Banned
         """
-        city_response = None
+        if self.direct:
+            return self._fetch_available_dates_for_city(city)
 
-        def listen_response(response):
-            match = JSON_URL_REGEX.search(response.url)
-
-            if match is None:
-                logging.info(f"No match for response url {response.url}")
-                return
+        waiter = _ResponseWaiter()
+        self._response_waiters[city.id] = waiter
 
-            response_city_id = match.group(1)
-            assert response_city_id.isnumeric()
-            response_city = CITIES[response_city_id]
-            logging.info(
-                f"Found dates JSON response for url {response.url}. Matching city_id"
-                f" {response_city_id}. Matching city {response_city.name}."
+        # Start waiting before triggering the request so the response can't be
+        # missed. The router fills in the waiter so the predicate is just a check.
+        select_time = time.monotonic()
+        try:
+            with self.page.expect_response(
+                lambda _: waiter.response is not None,
+                timeout=self.response_timeout * 1000,
+            ):
+                self.page.select_option(
+                    "#appointments_consulate_appointment_facility_id", city.id
+                )
+            city_response = waiter.response
+            CHECK_STAGE_SECONDS.observe(time.monotonic() - select_time, "response")
+        except PlaywrightTimeoutError as e:
+            logging.warning(
+                f"No matching response in {self.response_timeout} seconds. Something "
+                "probably went wrong. Exiting response handler."
             )
+            raise NoResponseError() from e
+        finally:
+            self._response_waiters.pop(city.id, None)
 
-            if response_city.id is not city.id:
-                logging.warning(
-                    f"Requested {city.name} but found response for {response_city.name}"
-                )
-                return
+        return self._handle_selected_response(
+            city,
+            city_response.status,
+            city_response.url,
+            city_response.text,
+            select_time,
+        )
+
+    def pop_unsolicited_dates(self) -> dict[str, Availability]:
+        """
+        Return the availability from days JSON responses that arrived for cities
+        we weren't waiting on, keyed by city id. Only the latest response per city
+        is kept and responses that didn't contain dates are skipped, as are errors
+        since the next requested check will run into the same problem.
+        """
+        unsolicited_dates = {}
+        for city_id, response in self._take_unsolicited_responses():
+            try:
+                # The page may have navigated since, taking the body with it
+                body = response.text()
+            except PlaywrightError as e:
+                logging.info(f"Unsolicited response for {city_id} is gone - {e}")
+                continue
 
-            logging.info(f"Found response for {city.name}")
-            nonlocal city_response
-            city_response = response
+            current_dates = self._unsolicited_dates(city_id, response, body)
+            if current_dates is not None:
+                unsolicited_dates[city_id] = current_dates
 
-        self.page.on("response", listen_response)
+        return unsolicited_dates
 
-        # Select option to trigger
-        self.page.select_option(
-            "#appointments_consulate_appointment_facility_id", city.id
-        )
+    def _deliver_response(self, waiter: _ResponseWaiter, response):
+        waiter.response = response
 
-        # wait for the response
-        start_listen_time = datetime.datetime.now()
-        while city_response is None:
-            if datetime.datetime.now() - start_listen_time > datetime.timedelta(
-                minutes=2
-            ):
-                logging.warning(
-                    "No matching response in 2 minutes. Something probably went wrong. "
-                    "Exiting response handler."
-                )
-                raise NoResponseError()
+    def _fetch_available_dates_for_city(
+        self, city: City, conditional: bool = True
+    ) -> Optional[Availability]:
+        """
+        Request the days JSON for `city` straight from the server, reusing the
+        signed-in browser's cookies over a pooled keep-alive session. Validators
+        from the previous 200 are sent along so that unchanged availability comes
+        back as a cheap 304.
+        """
+        status, url, body = self._request_days_json(city, conditional)
+        return handle_days_response(city, status, url, lambda: body, self.recorder)
+
+    def _request_days_json(self, city: City, conditional: bool) -> tuple[int, str, str]:
+        """
+        :return tuple - status, url and body of the days JSON response
+        """
+        start_time = time.monotonic()
+        session = self._get_http_session()
+        url = self._days_json_url(city)
+        request_time = time.monotonic()
+        CHECK_STAGE_SECONDS.observe(request_time - start_time, "session")
 
-            self.page.evaluate(
-                "async() => {await new Promise(r => setTimeout(r, 1000));}"
+        try:
+            response = session.get(
+                url,
+                headers=self._conditional_headers(city, conditional),
+                timeout=DIRECT_REQUEST_TIMEOUT,
+                # A redirect here is to the sign in page, see handle_days_response
+                allow_redirects=False,
             )
-            time.sleep(1)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            logging.warning(f"Direct request for {city.name} failed - {e}")
+            raise NoResponseError() from e
 
-        self.page.remove_listener("response", listen_response)
+        CHECK_STAGE_SECONDS.observe(time.monotonic() - request_time, "request")
 
-        # Handle response
-        logging.info(f"Handling response for {city.name}")
-        response = city_response
-        if response.status == 401:
-            # Unauthorized - Auth expired
-            logging.info(
-                f"{city.name} response - Received 401. Adding job back to work_queue "
-                "and setting IS_LOGGED_IN to False to trigger new session."
+        self._store_validators(city, response.status_code, response.headers)
+        return response.status_code, url, response.text
+
+    def _get_http_session(self) -> requests.Session:
+        """
+        Return the pooled HTTP session used for direct requests, copying the
+        cookies and CSRF headers over from the browser context if the browser
+        has signed in again or reloaded the scheduler page since the last sync.
+        """
+        if self._http_session is None:
+            self._http_session = requests.Session()
+            self._http_session.mount(
+                "https://", HTTPAdapter(pool_connections=1, pool_maxsize=4)
             )
-            raise UnauthorizedError()
-        elif response.status == 503:
-            logging.info("Received 503. Service temporarily unavailable.")
-            raise ServiceUnavailableError()
-        elif response.status >= 400:
-            logging.info("Ran into network request error. Exiting.")
-            logging.info(response)
-            logging.info(response.status)
-            logging.info(response.url)
-            logging.info(response.text())
-            exit(1)
-
-        if response.status == 304:
-            # Not modified
-            logging.info(f"304 Not Modified for {city.name}")
-            return None
 
-        current_dates = {d["date"] for d in response.json()}
+        if self._days_url_base is None:
+            url_base = self._direct_url_base()
 
-        if not current_dates and city.name in ["Calgary", "Vancouver", "Ottawa"]:
-            # Most likely temp banned if we're getting empty results for any of these
-            # cities since I know they likely have at least some availability.
-            logging.info(
-                f"Received empty result for {city.name}. Most likely temp banned. "
-                "Setting TEMP_BANNED=True."
+            self._http_session.cookies.clear()
+            for cookie in self.page.context.cookies():
+                self._http_session.cookies.set(
+                    cookie["name"],
+                    cookie["value"],
+                    domain=cookie["domain"],
+                    path=cookie["path"],
+                )
+
+            self._http_session.headers.update(
+                {
+                    "User-Agent": self.page.evaluate("navigator.userAgent"),
+                    **self._direct_headers_for(
+                        self.page.get_attribute('meta[name="csrf-token"]', "content")
+                    ),
+                }
             )
-            raise TempBannedError()
+            self._days_url_base = url_base
+            logging.info("Copied browser session over for direct requests")
 
-        return current_dates
+        return self._http_session
 
     def _random_delay(self):
         time.sleep(random.uniform(0.5, 2))
 
-    def _get_current_datepicker_months(self) -> tuple[int, int]:
+    def _get_current_datepicker_months(self, page) -> tuple[int, int]:
         return [
             parse_month_year_str(s.replace("\xa0", " "))
-            for s in self.page.locator(".ui-datepicker-title").all_text_contents()
+            for s in page.locator(".ui-datepicker-title").all_text_contents()
         ]
 
-    def _go_prev_month_datepicker(self):
-        self.page.click('span:text-is("Prev")')
-
-    def _go_next_month_datepicker(self):
-        self.page.click('span:text-is("Next")')
-
-    def _go_to_month_datepicker(self, target_month: int, target_year: int):
+    def _go_to_month_datepicker(self, page, target_month: int, target_year: int):
         target_month_year = (target_month, target_year)
 
         i = 0
-        current_datepicker_months = self._get_current_datepicker_months()
+        current_datepicker_months = self._get_current_datepicker_months(page)
 
         while target_month_year not in current_datepicker_months:
-            left_side_month, left_side_year = current_datepicker_months[0]
-            right_side_month, right_side_year = current_datepicker_months[1]
-
-            if target_year < left_side_year or (
-                target_year == left_side_year and target_month < left_side_month
-            ):
-                self._go_prev_month_datepicker()
-            elif target_year > right_side_year or (
-                target_year == right_side_year and target_month > right_side_month
-            ):
-                self._go_next_month_datepicker()
-            else:
-                raise RuntimeError(
-                    f"Impossible condition met. Target Month/Year ({target_month_year})"
-                    " not found and could not determine if it is before or after "
-                    f"current dates {current_datepicker_months}."
+            page.click(
+                self._datepicker_step(
+                    target_month, target_year, current_datepicker_months
                 )
+            )
 
             i += 1
 
@@ -267,14 +1081,14 @@ class VisaPageWrapper:
                     " iterations."
                 )
 
-            current_datepicker_months = self._get_current_datepicker_months()
+            current_datepicker_months = self._get_current_datepicker_months(page)
 
-    def _select_day_datepicker(self, month: int, day: int):
+    def _select_day_datepicker(self, page, month: int, day: int):
         # Assumes datepicker is already open to correct month
         month_name = calendar.month_name[month]
-        datepicker_month = self.page.locator(
+        datepicker_month = page.locator(
             ".ui-datepicker-group",
-            has=self.page.locator(f'span:text-is("{month_name}")'),
+            has=page.locator(f'span:text-is("{month_name}")'),
         )
         date_cell = datepicker_month.locator(f'td a:text-is("{day}")')
 
@@ -285,39 +1099,32 @@ class VisaPageWrapper:
         date_cell.click()
         return True
 
-    def _get_time_option_values(self):
-        while (
-            self.page.locator("#appointments_consulate_appointment_time option").count()
-            < 2
-        ):
-            count = self.page.locator(
-                "#appointments_consulate_appointment_time option"
-            ).count()
-            logging.info(f"Option count is {count}")
-            time.sleep(1)
+    def _get_time_option_values(self, page):
+        page.wait_for_function(HAS_TIME_OPTIONS_JS, timeout=TIME_SLOTS_TIMEOUT * 1000)
 
         return [
             value
             for value in [
                 option.evaluate("e => e.value")
-                for option in self.page.query_selector_all(
+                for option in page.query_selector_all(
                     "#appointments_consulate_appointment_time option"
                 )
             ]
             if value
         ]
 
-    def _open_datepicker(self):
-        self.page.click("#appointments_consulate_appointment_date_input")
+    def _open_datepicker(self, page):
+        page.click("#appointments_consulate_appointment_date_input")
 
-    def _select_appointment(self, month: int, day: int, year: int):
+    def _select_appointment(self, page, month: int, day: int, year: int) -> bool:
         logging.info(f"Selecting appointment date {month}/{day}/{year}")
-        self._open_datepicker()
-        self._go_to_month_datepicker(month, year)
-
-        if self._select_day_datepicker(month, day):
-            times = self._get_time_option_values()
-            logging.info(f"Selecting appointment time {times[-1]}")
-            self.page.select_option(
-                "#appointments_consulate_appointment_time", times[-1]
-            )
+        self._open_datepicker(page)
+        self._go_to_month_datepicker(page, month, year)
+
+        if not self._select_day_datepicker(page, month, day):
+            return False
+
+        times = self._get_time_option_values(page)
+        logging.info(f"Selecting appointment time {times[-1]}")
+        page.select_option("#appointments_consulate_appointment_time", times[-1])
+        return True
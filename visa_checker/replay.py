@@ -0,0 +1,156 @@
+import atexit
+import cProfile
+import gzip
+import json
+import logging
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Iterator, Optional
+
+from config import CITIES
+from notify import disable_notifications
+from page import (
+    ServiceUnavailableError,
+    TempBannedError,
+    UnauthorizedError,
+    handle_days_response,
+)
+from utils import find_preferred_dates, process_availability_for_city
+
+CAPTURE_VERSION = 1
+
+# Statuses handle_days_response turns into something other than exiting
+_REPLAYABLE_STATUSES = {200, 304, 401, 503}
+
+
+class ResponseRecorder:
+    """
+    Captures every days JSON response the checker handles to a gzipped JSON
+    lines file that `replay_capture` can feed back through later.
+
+    Only the city id, status, dates and seconds since recording started are
+    kept. URLs, headers, cookies and anything else that could identify the
+    account never make it into the file.
+
+    Thread-safe so every worker can share one.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._start_time = time.monotonic()
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._write({"version": CAPTURE_VERSION})
+        atexit.register(self.close)
+
+        logging.info(f"Recording days JSON responses to {path}")
+
+    def record(self, city_id: str, status: int, dates: Optional[list[str]] = None):
+        line = {
+            "t": round(time.monotonic() - self._start_time, 3),
+            "city": city_id,
+            "status": status,
+        }
+        if dates is not None:
+            line["dates"] = dates
+
+        self._write(line)
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def _write(self, line: dict):
+        with self._lock:
+            if self._file.closed:
+                return
+
+            self._file.write(json.dumps(line, separators=(",", ":")) + "\n")
+            # A crash or kill shouldn't lose more than the line being written
+            self._file.flush()
+
+
+def read_capture(path: str) -> Iterator[dict]:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(next(f))
+        if header.get("version") != CAPTURE_VERSION:
+            raise ValueError(f"Unsupported capture version in {path}: {header}")
+
+        for line in f:
+            yield json.loads(line)
+
+
+def replay_capture(path: str, profile: bool = False):
+    """
+    Feed a capture from `ResponseRecorder` back through the response handling
+    in page.py and the processing in utils.py/repo.py as fast as possible.
+    Nothing is requested from the site and no notifications are sent, but
+    availability is stored like normal so point it at a scratch db.
+
+    With `profile`, CPU time is profiled and peak memory traced along the way.
+    """
+
+    disable_notifications()
+
+    statuses = Counter()
+    handle_time = 0.0
+    process_time = 0.0
+    captured_seconds = 0.0
+
+    profiler = cProfile.Profile() if profile else None
+    if profile:
+        tracemalloc.start()
+        profiler.enable()
+
+    start_time = time.monotonic()
+
+    for record in read_capture(path):
+        city = CITIES.get(record["city"])
+        status = record["status"]
+        captured_seconds = record["t"]
+        statuses[status] += 1
+
+        if city is None or status not in _REPLAYABLE_STATUSES:
+            continue
+
+        body = json.dumps(
+            [{"date": date, "business_day": True} for date in record.get("dates", [])]
+        )
+
+        handle_start_time = time.monotonic()
+        try:
+            current_dates = handle_days_response(city, status, "replay", lambda: body)
+        except (UnauthorizedError, TempBannedError, ServiceUnavailableError):
+            current_dates = None
+        handle_time += time.monotonic() - handle_start_time
+
+        if current_dates is None:
+            continue
+
+        process_start_time = time.monotonic()
+        process_availability_for_city(city.id, current_dates)
+        find_preferred_dates(city, current_dates)
+        process_time += time.monotonic() - process_start_time
+
+    elapsed = time.monotonic() - start_time
+
+    if profile:
+        profiler.disable()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    responses = sum(statuses.values())
+    logging.info(
+        f"Replayed {responses} responses covering {captured_seconds / 3600:.1f} hours "
+        f"in {elapsed:.2f}s ({responses / max(elapsed, 1e-9):.0f}/s). "
+        f"Handling took {handle_time:.2f}s and processing {process_time:.2f}s. "
+        f"Statuses: {dict(statuses)}"
+    )
+
+    if profile:
+        logging.info(f"Peak traced memory {peak_memory / (1024 * 1024):.1f}MB")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
@@ -1,10 +1,57 @@
 import datetime
 import logging
-from typing import Set
+import threading
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Optional
 
-from db import create_db_connection
-from date_utils import date_str_to_datetime
-from config import City
+from analytics import record_availability_changes
+from db import execute_prepared, pooled_connection
+from event_log import DiffEvent, emit
+from date_utils import Availability, date_str_to_datetime
+from config import (
+    CITIES,
+    CLUSTER_MODE,
+    SNAPSHOT_EVERY_EVENTS,
+    SNAPSHOT_MAX_AGE,
+    City,
+)
+
+
+@dataclass
+class _CityAvailability:
+    """
+    What we know about a city's availability as of its latest recorded event.
+    """
+
+    dates: Availability = field(default_factory=Availability)
+    # id of the latest availability_events row reflected in `dates`
+    last_event_id: Optional[int] = None
+    events_since_snapshot: int = 0
+    last_snapshot_at: Optional[datetime.datetime] = None
+
+    def snapshot_due(self, now: datetime.datetime) -> bool:
+        return (
+            self.last_snapshot_at is None
+            or self.events_since_snapshot >= SNAPSHOT_EVERY_EVENTS
+            or now - self.last_snapshot_at >= SNAPSHOT_MAX_AGE
+        )
+
+
+# This process is normally the only writer of availability, so the latest state
+# for each city is cached here and kept current by record_new_dates instead of
+# being rebuilt from the db on every check. In cluster mode record_new_dates
+# checks the cache against the db before trusting it.
+_city_availability: dict[str, _CityAvailability] = {}
+_cache_warm = False
+_cache_lock = threading.Lock()
+# Held by record_new_dates from reading a city's cached dates to updating them,
+# so two checks of the same city on different threads can't both record (and
+# notify about) the same change. Created under _cache_lock.
+_city_locks: dict[str, threading.Lock] = defaultdict(threading.Lock)
+
+# Only changes when we reschedule, which goes through update_appointment_date
+_current_appointment_date: Optional[datetime.datetime] = None
 
 
 def update_appointment_date(date: datetime.datetime):
@@ -12,61 +59,582 @@ def update_appointment_date(date: datetime.datetime):
     Commit the current appointment date to the db
     """
 
+    global _current_appointment_date
+
     logging.info(f"Updating database current_appointment_date to {date}")
 
-    with create_db_connection() as conn:
+    with pooled_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                "update misc set value=%s where key='current_appointment_date'",
+            execute_prepared(
+                cur,
+                "update_appointment_date",
+                "update misc set value=$1 where key='current_appointment_date'",
                 (date.strftime("%Y-%m-%d"),),
             )
 
+    _current_appointment_date = date
+
 
 def get_current_appointment_date() -> datetime.datetime:
     """
-    Retrieve the current appointment date from the db
+    Retrieve the current appointment date, from the db the first time and from
+    memory after that.
     """
 
-    with create_db_connection() as conn:
+    global _current_appointment_date
+
+    if _current_appointment_date is not None:
+        return _current_appointment_date
+
+    with pooled_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(
+            execute_prepared(
+                cur,
+                "get_current_appointment_date",
                 "select value from misc where key='current_appointment_date'",
             )
 
             result = cur.fetchone()
 
-            return date_str_to_datetime(result[0])
+    _current_appointment_date = date_str_to_datetime(result[0])
+    return _current_appointment_date
 
 
-def record_new_dates(city: City, dates: Set[str]):
+def invalidate_last_known_dates():
+    """
+    Drop the cached dates so the next lookup reloads them from the db. Needed if
+    something other than this process records availability.
+    """
+
+    global _cache_warm
+
+    logging.info("Invalidating last known dates cache")
+
+    with _cache_lock:
+        _city_availability.clear()
+        _cache_warm = False
+
+
+def _load_availability(cur, city_id: str, at: datetime.datetime) -> _CityAvailability:
+    """
+    Rebuild a city's availability as of `at` from the latest snapshot taken at or
+    before `at` plus the events recorded after that snapshot.
+    """
+
+    execute_prepared(
+        cur,
+        "get_availability_snapshot_at",
+        "select packed, dates, last_event_id, created_at from availability_snapshots"
+        " where city_id=$1 and created_at <= $2 ORDER BY created_at desc, id desc"
+        " LIMIT 1",
+        (city_id, at),
+    )
+    snapshot = cur.fetchone()
+
+    availability = _CityAvailability()
+    if snapshot is not None:
+        (
+            packed,
+            dates,
+            availability.last_event_id,
+            availability.last_snapshot_at,
+        ) = snapshot
+        # Snapshots migrated from available_dates only have the text dates
+        availability.dates = (
+            Availability.from_bytes(bytes(packed))
+            if packed is not None
+            else Availability.from_dates(dates.split(",") if dates else [])
+        )
+
+    execute_prepared(
+        cur,
+        "get_availability_events_at",
+        "select id, date, kind from availability_events where city_id=$1 and id > $2"
+        " and created_at <= $3 ORDER BY id",
+        (city_id, availability.last_event_id or 0, at),
+    )
+
+    for event_id, date, kind in cur:
+        if kind == "appeared":
+            availability.dates = availability.dates.with_date(date)
+        else:
+            availability.dates = availability.dates.without_date(date)
+
+        availability.last_event_id = event_id
+        availability.events_since_snapshot += 1
+
+    return availability
+
+
+def _warm_last_known_dates_cache():
+    """
+    Rebuild the current availability of every city.
+    """
+
+    global _cache_warm
+
+    now = datetime.datetime.now()
+
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            city_availability = {
+                city_id: _load_availability(cur, city_id, now) for city_id in CITIES
+            }
+
+    with _cache_lock:
+        _city_availability.update(city_availability)
+        _cache_warm = True
+
+    logging.info(f"Warmed last known dates cache for {len(city_availability)} cities")
+
+
+def _get_city_availability(city: City) -> _CityAvailability:
+    if not _cache_warm:
+        _warm_last_known_dates_cache()
+
+    with _cache_lock:
+        return _city_availability.setdefault(city.id, _CityAvailability())
+
+
+def record_new_dates(city: City, dates: Availability) -> Availability:
     """
     Store the given `dates` for the given `city` into the db.
+
+    Only the dates that appeared or disappeared since the last known dates are
+    stored, along with a full snapshot every so often to keep rebuilding a
+    city's availability cheap. Nothing is written if nothing changed.
+
+    In cluster mode other nodes record availability too, so the city is locked
+    for the transaction and the cached dates are reloaded if another node has
+    recorded since. That way each change is recorded, and reported, by exactly
+    one node.
+
+    :return Availability - the dates that appeared, for notifying about
     """
 
-    with create_db_connection() as conn:
+    with _cache_lock:
+        city_lock = _city_locks[city.id]
+
+    with city_lock:
+        return _record_new_dates(city, dates)
+
+
+def _record_new_dates(city: City, dates: Availability) -> Availability:
+    availability = _get_city_availability(city)
+
+    if not CLUSTER_MODE and availability.dates == dates:
+        return Availability()
+
+    now = datetime.datetime.now()
+    external_write = False
+
+    with pooled_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO available_dates (city_id, city_name, dates) VALUES (%s,"
-                " %s, %s)",
-                (city.id, city.name, ",".join(dates)),
+            if CLUSTER_MODE:
+                execute_prepared(
+                    cur,
+                    "lock_city_availability",
+                    "select pg_advisory_xact_lock(hashtext('availability_events:'"
+                    " || $1::text))",
+                    (city.id,),
+                )
+                execute_prepared(
+                    cur,
+                    "get_latest_availability_event_id",
+                    "select max(id) from availability_events where city_id=$1",
+                    (city.id,),
+                )
+                if cur.fetchone()[0] != availability.last_event_id:
+                    # Other nodes' clocks may be slightly ahead of ours
+                    availability = _load_availability(
+                        cur, city.id, datetime.datetime.max
+                    )
+                    with _cache_lock:
+                        _city_availability[city.id] = availability
+
+            appeared = dates - availability.dates
+            disappeared = availability.dates - dates
+
+            if not appeared and not disappeared:
+                return appeared
+
+            events = [(date, "appeared") for date in sorted(appeared)] + [
+                (date, "disappeared") for date in sorted(disappeared)
+            ]
+            previous_event_id = availability.last_event_id
+
+            for i, (date, kind) in enumerate(events):
+                # The subquery runs against the table as it was before this insert
+                # so it returns the city's latest event up until now.
+                execute_prepared(
+                    cur,
+                    "record_availability_event",
+                    "INSERT INTO availability_events (city_id, date, kind, created_at)"
+                    " VALUES ($1, $2, $3, $4) RETURNING id, (select max(id) from"
+                    " availability_events where city_id=$1)",
+                    (city.id, date, kind, now),
+                )
+                event_id, latest_event_id = cur.fetchone()
+
+                if i == 0:
+                    external_write = latest_event_id != previous_event_id
+
+            record_availability_changes(
+                cur,
+                city.id,
+                appeared,
+                disappeared,
+                now,
+                first_record=previous_event_id is None,
+            )
+
+            updated = _CityAvailability(
+                dates=dates,
+                last_event_id=event_id,
+                events_since_snapshot=availability.events_since_snapshot + len(events),
+                last_snapshot_at=availability.last_snapshot_at,
             )
 
+            if updated.snapshot_due(now):
+                execute_prepared(
+                    cur,
+                    "record_availability_snapshot",
+                    "INSERT INTO availability_snapshots (city_id, packed,"
+                    " last_event_id, created_at) VALUES ($1, $2, $3, $4)",
+                    (city.id, dates.to_bytes(), event_id, now),
+                )
+                updated.events_since_snapshot = 0
+                updated.last_snapshot_at = now
+
+    with _cache_lock:
+        _city_availability[city.id] = updated
+
+    emit(DiffEvent(city.id, list(appeared), list(disappeared)))
+
+    if external_write:
+        logging.warning(
+            f"Availability for {city.name} was recorded by someone else. The "
+            "changes just recorded may have been diffed against stale dates."
+        )
+        invalidate_last_known_dates()
 
-def get_last_known_dates(city: City) -> Set[str]:
+    return appeared
+
+
+def get_last_known_dates(city: City) -> Availability:
     """
     Fetch the last known available dates for the given `city`
     """
-    with create_db_connection() as conn:
+
+    return _get_city_availability(city).dates
+
+
+def get_dates_at(city: City, at: datetime.datetime) -> Availability:
+    """
+    Rebuild the available dates for the given `city` as they were at `at`.
+    """
+
+    with pooled_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                "select dates from available_dates where city_id=%s ORDER BY created_at"
-                " desc LIMIT 1",
-                (city.id,),
+            return _load_availability(cur, city.id, at).dates
+
+
+def record_ban_start(started_at: datetime.datetime) -> int:
+    """
+    Store the start of a temp ban and return its id
+    """
+
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(
+                cur,
+                "record_ban_start",
+                "INSERT INTO temp_bans (started_at) VALUES ($1) RETURNING id",
+                (started_at,),
             )
 
-            result = cur.fetchone()
+            return cur.fetchone()[0]
+
+
+def record_ban_probe(ban_id: int, still_banned: bool):
+    """
+    Store the result of checking whether a temp ban has been lifted
+    """
+
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(
+                cur,
+                "record_ban_probe",
+                "INSERT INTO temp_ban_probes (ban_id, still_banned) VALUES ($1, $2)",
+                (ban_id, still_banned),
+            )
+
+
+def record_ban_end(ban_id: int, ended_at: datetime.datetime):
+    """
+    Store when a temp ban was found to be lifted
+    """
+
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(
+                cur,
+                "record_ban_end",
+                "update temp_bans set ended_at=$2 where id=$1",
+                (ban_id, ended_at),
+            )
+
+
+def get_ban_durations(limit: int = 50) -> list[float]:
+    """
+    Fetch how long the most recent lifted temp bans lasted, in seconds.
+
+    A ban was lifted somewhere between the last probe that found us still banned
+    and the probe that found it lifted, so the midpoint is used.
+    """
+
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(
+                cur,
+                "get_ban_durations",
+                "select extract(epoch from coalesce(max(p.probed_at) filter (where"
+                " p.still_banned), b.started_at) - b.started_at), extract(epoch from"
+                " b.ended_at - b.started_at) from temp_bans b left join temp_ban_probes"
+                " p on p.ban_id = b.id where b.ended_at is not null group by b.id"
+                " ORDER BY b.started_at desc LIMIT $1",
+                (limit,),
+            )
+
+            return [
+                (float(still_banned) + float(lifted)) / 2
+                for still_banned, lifted in cur.fetchall()
+            ]
+
+
+def record_booking_attempt(
+    city_id: Optional[str],
+    date: datetime.date,
+    path: str,
+    submitted: bool,
+    seconds: float,
+):
+    """
+    Store a reschedule attempt and how long it took from starting to submitting
+    """
+
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(
+                cur,
+                "record_booking_attempt",
+                "INSERT INTO booking_attempts (city_id, date, path, submitted, seconds)"
+                " VALUES ($1, $2, $3, $4, $5)",
+                (city_id, date, path, submitted, seconds),
+            )
+
+
+def save_work_queue_entry(
+    city_id: str,
+    priority: float,
+    due_at: datetime.datetime,
+    enqueued_at: datetime.datetime,
+):
+    """
+    Store a check waiting in the work queue, replacing any earlier one for the
+    city
+    """
+
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(
+                cur,
+                "save_work_queue_entry",
+                "INSERT INTO work_queue (city_id, priority, due_at, enqueued_at)"
+                " VALUES ($1, $2, $3, $4) ON CONFLICT (city_id) DO UPDATE SET"
+                " priority = EXCLUDED.priority, due_at = EXCLUDED.due_at,"
+                " enqueued_at = EXCLUDED.enqueued_at",
+                (city_id, priority, due_at, enqueued_at),
+            )
+
+
+def delete_work_queue_entry(city_id: str):
+    """
+    Remove a check from the stored work queue once it's been handed out
+    """
+
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(
+                cur,
+                "delete_work_queue_entry",
+                "DELETE FROM work_queue WHERE city_id = $1",
+                (city_id,),
+            )
+
+
+def get_work_queue_entries() -> list[tuple]:
+    """
+    Fetch the stored work queue as (city_id, priority, due_at, enqueued_at) rows
+    """
+
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(
+                cur,
+                "get_work_queue_entries",
+                "SELECT city_id, priority, due_at, enqueued_at FROM work_queue"
+                " ORDER BY due_at",
+            )
+
+            return cur.fetchall()
+
+
+def register_checker_node(node_id: str, city_ids: list[str]):
+    """
+    Add a node to the cluster and make sure every city it checks has a job
+    """
+
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(
+                cur,
+                "register_checker_node",
+                "INSERT INTO checker_nodes (node_id, started_at, heartbeat_at)"
+                " VALUES ($1, now(), now()) ON CONFLICT (node_id) DO UPDATE SET"
+                " started_at = now(), heartbeat_at = now()",
+                (node_id,),
+            )
+
+            for city_id in city_ids:
+                execute_prepared(
+                    cur,
+                    "create_city_job",
+                    "INSERT INTO city_jobs (city_id, due_at) VALUES ($1, now())"
+                    " ON CONFLICT (city_id) DO NOTHING",
+                    (city_id,),
+                )
+
+
+def record_node_heartbeat(node_id: str, lease_seconds: float) -> int:
+    """
+    Mark a node as alive and renew the leases it holds
 
-            if result is None:
-                return set()
+    :return int - number of nodes that are alive, counting this one
+    """
+
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(
+                cur,
+                "record_node_heartbeat",
+                "UPDATE checker_nodes SET heartbeat_at = now() WHERE node_id = $1",
+                (node_id,),
+            )
+            execute_prepared(
+                cur,
+                "renew_city_job_leases",
+                "UPDATE city_jobs SET lease_expires_at = now() + make_interval(secs"
+                " => $2::double precision) WHERE leased_by = $1",
+                (node_id, lease_seconds),
+            )
+            execute_prepared(
+                cur,
+                "count_live_checker_nodes",
+                "select count(*) from checker_nodes where heartbeat_at > now() -"
+                " make_interval(secs => $1::double precision)",
+                (lease_seconds,),
+            )
 
-            return set(result[0].split(","))
+            return cur.fetchone()[0]
+
+
+def deregister_checker_node(node_id: str):
+    """
+    Remove a node from the cluster and hand back any leases it still holds
+    """
+
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(
+                cur,
+                "release_node_city_jobs",
+                "UPDATE city_jobs SET leased_by = NULL, lease_expires_at = NULL"
+                " WHERE leased_by = $1",
+                (node_id,),
+            )
+            execute_prepared(
+                cur,
+                "deregister_checker_node",
+                "DELETE FROM checker_nodes WHERE node_id = $1",
+                (node_id,),
+            )
+
+
+def claim_city_job(
+    node_id: str, lease_seconds: float, city_ids: list[str]
+) -> Optional[tuple[str, Optional[str]]]:
+    """
+    Lease the most overdue city check out of `city_ids` that isn't leased by a
+    live node. Rows locked by nodes claiming at the same time are skipped rather
+    than waited on.
+
+    :return tuple - (city_id, node the lease was taken over from if it expired)
+        or None if nothing is due
+    """
+
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(
+                cur,
+                "claim_city_job",
+                "WITH job AS (SELECT city_id, leased_by FROM city_jobs WHERE due_at <="
+                " now() AND city_id = ANY($3) AND (leased_by IS NULL OR"
+                " lease_expires_at < now()) ORDER BY due_at LIMIT 1 FOR UPDATE SKIP"
+                " LOCKED) UPDATE city_jobs SET leased_by = $1, lease_expires_at ="
+                " now() + make_interval(secs => $2::double precision) FROM job WHERE"
+                " city_jobs.city_id = job.city_id RETURNING job.city_id, job.leased_by",
+                (node_id, lease_seconds, city_ids),
+            )
+
+            return cur.fetchone()
+
+
+def complete_city_job(city_id: str, node_id: str, next_check_in: float) -> bool:
+    """
+    Release a node's lease on a city check and schedule the next one
+
+    :return bool - False if the lease had already been taken over by another node
+    """
+
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(
+                cur,
+                "complete_city_job",
+                "UPDATE city_jobs SET leased_by = NULL, lease_expires_at = NULL,"
+                " due_at = now() + make_interval(secs => $3::double precision),"
+                " last_checked_at = now(), last_checked_by = $2 WHERE city_id = $1"
+                " AND leased_by = $2",
+                (city_id, node_id, next_check_in),
+            )
+
+            return cur.rowcount == 1
+
+
+def release_city_job(city_id: str, node_id: str):
+    """
+    Hand back a node's lease on a city check without checking it, so any node
+    can claim it straight away
+    """
+
+    with pooled_connection() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(
+                cur,
+                "release_city_job",
+                "UPDATE city_jobs SET leased_by = NULL, lease_expires_at = NULL"
+                " WHERE city_id = $1 AND leased_by = $2",
+                (city_id, node_id),
+            )
@@ -0,0 +1,125 @@
+import logging
+import re
+import threading
+from collections import Counter
+
+from config import (
+    ROUTE_ALLOWED_DOMAINS,
+    ROUTE_ALLOWED_URL_PATTERNS,
+    ROUTE_BLOCKED_EXTENSIONS,
+)
+
+# Rough size of a typical response of each type on the site, used to estimate
+# how much blocking saves since aborted responses are never seen
+_ESTIMATED_BYTES = {
+    "image": 30_000,
+    "font": 60_000,
+    "media": 500_000,
+    "stylesheet": 40_000,
+    "script": 80_000,
+}
+_DEFAULT_ESTIMATED_BYTES = 10_000
+
+
+def blocked_url_regex(
+    blocked_extensions: list[str],
+    allowed_domains: list[str],
+    allowed_url_patterns: list[str],
+) -> re.Pattern:
+    """
+    Build the regex for the urls to block: files with any of the
+    `blocked_extensions` and anything on a host outside the `allowed_domains`,
+    unless it matches one of the `allowed_url_patterns`. Playwright runs it in
+    the browser driver so it's kept to syntax JavaScript shares.
+    """
+    blocked = []
+
+    if allowed_domains:
+        domains = "|".join(re.escape(domain.lower()) for domain in allowed_domains)
+        # A scheme, then a host that isn't one of the domains or a subdomain
+        blocked.append(
+            rf"[a-z][a-z0-9+.-]*://(?!(?:[^/?#]*\.)?(?:{domains})(?::\d+)?(?:[/?#]|$))"
+        )
+
+    if blocked_extensions:
+        extensions = "|".join(re.escape(extension) for extension in blocked_extensions)
+        blocked.append(rf"[^?#]*\.(?:{extensions})(?:[?#]|$)")
+
+    allowed = "|".join(f"(?:{pattern})" for pattern in allowed_url_patterns)
+
+    return re.compile(
+        (f"^(?!.*(?:{allowed}))" if allowed else "^")
+        # Never matches if there's nothing to block
+        + (f"(?:{'|'.join(blocked)})" if blocked else "(?!)"),
+        re.IGNORECASE,
+    )
+
+
+class ResourceBlocker:
+    """
+    Route handler that aborts browser requests the checker doesn't need, like
+    images, fonts and third party scripts. Fewer requests means less bandwidth
+    and renderer CPU per check, and fewer responses for the page's response
+    listener to look at.
+
+    Only urls matching `url_regex` are routed. Playwright matches them in the
+    browser driver, so every other request (the days JSON included) goes
+    through without a round trip to us. Having any route at all turns off the
+    browser's HTTP cache though, so browser requests for the days JSON would go
+    out without the headers that get a 304 back. It's only installed for
+    sessions that fetch the days JSON directly, which send their own.
+
+    Install it on a context (or page) with `install`. Counters are kept across
+    every context it's installed on.
+    """
+
+    def __init__(
+        self,
+        blocked_extensions: list[str] = ROUTE_BLOCKED_EXTENSIONS,
+        allowed_domains: list[str] = ROUTE_ALLOWED_DOMAINS,
+        allowed_url_patterns: list[str] = ROUTE_ALLOWED_URL_PATTERNS,
+    ):
+        self.url_regex = blocked_url_regex(
+            blocked_extensions, allowed_domains, allowed_url_patterns
+        )
+
+        self._lock = threading.Lock()
+        self._blocked = Counter()
+        self._estimated_bytes_saved = 0
+
+    def install(self, target):
+        target.route(self.url_regex, self.handle)
+
+    async def install_async(self, target):
+        await target.route(self.url_regex, self.handle_async)
+
+    def handle(self, route):
+        self._count(route.request.resource_type)
+        route.abort("blockedbyclient")
+
+    async def handle_async(self, route):
+        self._count(route.request.resource_type)
+        await route.abort("blockedbyclient")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "blocked": dict(self._blocked),
+                "blocked_total": sum(self._blocked.values()),
+                "estimated_bytes_saved": self._estimated_bytes_saved,
+            }
+
+    def log_stats(self):
+        stats = self.stats()
+        logging.info(
+            f"Blocked {stats['blocked_total']} browser requests "
+            f"(~{stats['estimated_bytes_saved'] / (1024 * 1024):.1f}MB). Blocked by "
+            f"type: {stats['blocked']}"
+        )
+
+    def _count(self, resource_type: str):
+        with self._lock:
+            self._blocked[resource_type] += 1
+            self._estimated_bytes_saved += _ESTIMATED_BYTES.get(
+                resource_type, _DEFAULT_ESTIMATED_BYTES
+            )
@@ -0,0 +1,111 @@
+import calendar
+import datetime
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Optional
+
+from date_utils import Availability
+
+_WEEKDAY_TO_INT = {day.lower(): index for index, day in enumerate(calendar.day_name)}
+
+_RULE_KEYS = {"before", "after", "between", "weekdays", "cities", "min_days_earlier"}
+
+
+@dataclass(frozen=True)
+class _CompiledRule:
+    # Dates must be in `include` (if set) and not in `exclude`
+    include: Optional[Availability]
+    exclude: Availability
+    weekdays: Optional[frozenset[int]]
+    min_days_earlier: Optional[int]
+
+    def apply(
+        self, snapshot: Availability, current_date: datetime.date
+    ) -> Availability:
+        dates = snapshot - self.exclude
+
+        if self.include is not None:
+            dates &= self.include
+
+        if self.weekdays is not None:
+            dates = dates.on_weekdays(self.weekdays)
+
+        if self.min_days_earlier is not None:
+            dates &= Availability.before(
+                current_date - datetime.timedelta(days=self.min_days_earlier - 1)
+            )
+
+        return dates
+
+
+def _compile_rule(rule: dict) -> _CompiledRule:
+    unknown_keys = set(rule) - _RULE_KEYS
+    if unknown_keys:
+        raise ValueError(f"Unknown preferred date rule keys {unknown_keys} in {rule}")
+
+    include = None
+    exclude = Availability()
+
+    if "before" in rule:
+        include = Availability.before(rule["before"])
+
+    if "between" in rule:
+        start, end = rule["between"]
+        between = Availability.between(start, end)
+        include = between if include is None else include & between
+
+    if "after" in rule:
+        after = datetime.date.fromisoformat(rule["after"])
+        exclude = Availability.before(after + datetime.timedelta(days=1))
+
+    weekdays = None
+    if "weekdays" in rule:
+        weekdays = frozenset(_WEEKDAY_TO_INT[day.lower()] for day in rule["weekdays"])
+
+    return _CompiledRule(
+        include=include,
+        exclude=exclude,
+        weekdays=weekdays,
+        min_days_earlier=rule.get("min_days_earlier"),
+    )
+
+
+class PreferredDateRules:
+    """
+    Preferred date rules from config compiled down to date masks. A date is
+    preferred if it matches any rule that applies to its city, and a rule
+    matches when all of its conditions do. Rules are indexed by city so a
+    snapshot is only run through the rules that apply to it.
+    """
+
+    def __init__(self, rules: list[dict]):
+        self._any_city_rules: list[_CompiledRule] = []
+        self._rules_by_city: dict[str, list[_CompiledRule]] = defaultdict(list)
+
+        for rule in rules:
+            compiled_rule = _compile_rule(rule)
+
+            if "cities" in rule:
+                for city_id in rule["cities"]:
+                    self._rules_by_city[city_id].append(compiled_rule)
+            else:
+                self._any_city_rules.append(compiled_rule)
+
+    def preferred_dates(
+        self,
+        city_id: str,
+        snapshot: Availability,
+        current_date: datetime.datetime,
+    ) -> Availability:
+        """
+        Return the dates in `snapshot` that are preferred over the `current_date`
+        appointment for the given city.
+        """
+
+        current_date = current_date.date()
+        preferred = Availability()
+
+        for rule in self._any_city_rules + self._rules_by_city.get(city_id, []):
+            preferred |= rule.apply(snapshot, current_date)
+
+        return preferred
@@ -0,0 +1,259 @@
+import datetime
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+from config import (
+    POLL_BAN_WINDOW,
+    POLL_BURST,
+    POLL_CHURN_SMOOTHING,
+    POLL_MAX_BAN_MULTIPLIER,
+    POLL_MAX_INTERVAL,
+    POLL_MIN_INTERVAL,
+    POLL_RELEASE_MAX_BOOST,
+    POLL_RELEASE_MIN_INTERVAL,
+    POLL_RELEASE_MIN_RELEASES,
+    POLL_REQUESTS_PER_HOUR,
+    City,
+)
+from date_utils import Availability
+
+
+@dataclass
+class _CitySchedule:
+    city: City
+    next_due: float
+    interval: float
+    # Exponentially weighted share of recent checks that found a change
+    churn: float = 0.0
+    last_dates: Optional[Availability] = None
+    queued: bool = False
+
+
+class PollScheduler:
+    """
+    Decides when each city should be checked next.
+
+    Cities start out checked every POLL_MAX_INTERVAL. Those whose availability
+    changes often move towards POLL_MIN_INTERVAL and drift back out when they
+    go quiet. All checks draw from a token bucket of POLL_REQUESTS_PER_HOUR.
+    Every temp ban in the last POLL_BAN_WINDOW doubles the intervals and halves
+    the refill rate, which recovers again as those bans age out.
+
+    Once a release profile has been set, cities are also checked more often
+    around the hours of the week they've released slots in before.
+
+    Thread-safe so it can be shared by every worker.
+    """
+
+    def __init__(self, cities: list[City]):
+        now = time.monotonic()
+        self._lock = threading.Lock()
+        self._schedules = {
+            city.id: _CitySchedule(city=city, next_due=now, interval=POLL_MAX_INTERVAL)
+            for city in cities
+            if not city.skip
+        }
+        self._tokens = float(POLL_BURST)
+        self._last_refill = now
+        self._bans: deque[datetime.datetime] = deque()
+        self._release_profile: dict[str, list[int]] = {}
+
+    def due_cities(self) -> list[City]:
+        """
+        Return the cities that are due for a check and aren't already waiting on
+        one. They're considered queued until `record_check` is called for them.
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            due = [
+                schedule
+                for schedule in self._schedules.values()
+                if not schedule.queued and schedule.next_due <= now
+            ]
+
+            for schedule in due:
+                schedule.queued = True
+
+        return [schedule.city for schedule in due]
+
+    def churn(self, city: City) -> float:
+        """
+        Share of recent checks of `city` that found a change, from 0 to 1.
+        """
+        with self._lock:
+            schedule = self._schedules.get(city.id)
+            return schedule.churn if schedule is not None else 0.0
+
+    def set_release_profile(self, profile: dict[str, list[int]]):
+        """
+        Update how many releases each city has had in each hour of the week, as
+        returned by `analytics.get_release_profile`.
+        """
+        with self._lock:
+            self._release_profile = profile
+
+    def reserve_request(self) -> float:
+        """
+        Take a token for one request.
+
+        :return float - seconds to wait before sending the request
+        """
+        with self._lock:
+            now = time.monotonic()
+            rate = POLL_REQUESTS_PER_HOUR / 3600 / self._ban_multiplier()
+            self._tokens = min(
+                POLL_BURST, self._tokens + (now - self._last_refill) * rate
+            )
+            self._last_refill = now
+            self._tokens -= 1
+
+            return max(0.0, -self._tokens / rate)
+
+    def record_check(
+        self, city: City, current_dates: Optional[Availability]
+    ) -> Optional[float]:
+        """
+        Schedule the next check for `city` based on how often its availability
+        has been changing.
+
+        :param current_dates - dates from the check or None if it was unchanged (304)
+        :return float - seconds until the next check, None for skipped cities
+        """
+        with self._lock:
+            schedule = self._schedules.get(city.id)
+            if schedule is None:
+                return None
+
+            # The first dates seen for a city aren't a change
+            changed = (
+                current_dates is not None
+                and schedule.last_dates is not None
+                and current_dates != schedule.last_dates
+            )
+            if current_dates is not None:
+                schedule.last_dates = current_dates
+
+            schedule.churn += POLL_CHURN_SMOOTHING * (changed - schedule.churn)
+
+            ban_multiplier = self._ban_multiplier()
+            interval = (
+                POLL_MAX_INTERVAL
+                - (POLL_MAX_INTERVAL - POLL_MIN_INTERVAL) * schedule.churn
+            ) * ban_multiplier
+            release_boost = self._release_boost(city.id, interval)
+            if release_boost > 1:
+                interval = max(
+                    POLL_RELEASE_MIN_INTERVAL * ban_multiplier, interval / release_boost
+                )
+            schedule.interval = interval
+            # Jitter so checks don't line up into a recognizable pattern
+            next_check_in = schedule.interval * random.uniform(0.9, 1.1)
+            schedule.next_due = time.monotonic() + next_check_in
+            schedule.queued = False
+
+        logging.info(
+            f"Scheduling next check for {city.name} in "
+            f"{schedule.interval / 60:.1f} minutes (changed: {changed}, churn: "
+            f"{schedule.churn:.2f}, release boost: {release_boost:.1f}, ban "
+            f"multiplier: {ban_multiplier})"
+        )
+
+        return next_check_in
+
+    def record_ban(self):
+        """
+        Slow every city down after a temp ban.
+        """
+        with self._lock:
+            self._bans.append(datetime.datetime.now())
+            ban_multiplier = self._ban_multiplier()
+
+        logging.info(f"Recorded temp ban. Poll ban multiplier is now {ban_multiplier}")
+
+    def stats(self) -> dict:
+        """
+        Current scheduling decisions, for logs and metrics.
+        """
+        with self._lock:
+            return {
+                "tokens": self._tokens,
+                "ban_multiplier": self._ban_multiplier(),
+                "cities": {
+                    schedule.city.name: {
+                        "interval": schedule.interval,
+                        "churn": schedule.churn,
+                        "due_in": schedule.next_due - time.monotonic(),
+                        "queued": schedule.queued,
+                    }
+                    for schedule in self._schedules.values()
+                },
+            }
+
+    def _release_boost(self, city_id: str, interval: float) -> float:
+        # Expects self._lock to be held
+        releases = self._release_profile.get(city_id)
+        if not releases or sum(releases) < POLL_RELEASE_MIN_RELEASES:
+            return 1.0
+
+        # Every hour up to the next check, so a window opening before then
+        # isn't slept through
+        now = datetime.datetime.now()
+        hours = [
+            now + datetime.timedelta(hours=i) for i in range(int(interval // 3600) + 1)
+        ] + [now + datetime.timedelta(seconds=interval)]
+        busiest = max(releases[hour.weekday() * 24 + hour.hour] for hour in hours)
+
+        return min(
+            POLL_RELEASE_MAX_BOOST, max(1.0, busiest * len(releases) / sum(releases))
+        )
+
+    def _ban_multiplier(self) -> int:
+        # Expects self._lock to be held
+        cutoff = datetime.datetime.now() - POLL_BAN_WINDOW
+        while self._bans and self._bans[0] < cutoff:
+            self._bans.popleft()
+
+        return min(POLL_MAX_BAN_MULTIPLIER, 2 ** len(self._bans))
+
+
+# Probe quantiles of past ban durations, so most probes land around the median
+_BAN_PROBE_QUANTILES = [0.2, 0.35, 0.5, 0.65, 0.8]
+# Fewer lifted bans than this aren't enough to learn from
+_MIN_BAN_HISTORY = 3
+
+
+def ban_probe_offsets(ban_durations: list[float]) -> Iterator[float]:
+    """
+    Yield when to probe whether a temp ban has been lifted, in seconds since the
+    ban started.
+
+    Probes are spread over the quantiles of `ban_durations` around the median and
+    back off exponentially once the ban outlasts most previous ones. Without
+    enough history, probes start after an hour and repeat every 30 minutes.
+    """
+
+    if len(ban_durations) < _MIN_BAN_HISTORY:
+        yield from itertools.count(60 * 60, 30 * 60)
+        return
+
+    durations = sorted(ban_durations)
+    last_offset = 0.0
+
+    for quantile in _BAN_PROBE_QUANTILES:
+        offset = durations[min(len(durations) - 1, int(quantile * len(durations)))]
+        if offset > last_offset:
+            last_offset = offset
+            yield offset
+
+    step = max(last_offset / 4, 5 * 60)
+    while True:
+        last_offset += step
+        step = min(step * 2, 2 * 60 * 60)
+        yield last_offset
@@ -0,0 +1,582 @@
+"""
+A local stand-in for the visa appointment site, for benchmarking the checker
+without hitting the real site or risking bans.
+
+Serves just enough of the site for the checker to run end to end: the sign in
+form, the pages leading to the scheduler, the appointment form with its
+facility dropdown, the days and times JSON and the reschedule submit. It also
+accepts ntfy notifications. Availability churns on its own and the site can be
+made slow, flaky, quick to expire sessions or quick to ban.
+
+Run on its own with `python visa_checker/standin.py --port 8765` and point the
+checker at it with VISA_CHECKER_BASE_URL=http://127.0.0.1:8765, or let bench.py
+start one.
+"""
+
+import argparse
+import datetime
+import html
+import json
+import logging
+import random
+import re
+import secrets
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+# Same facilities as config.CITIES. Kept separate so the stand-in can run
+# without the checker's environment.
+DEFAULT_FACILITIES = {
+    "89": "Calgary",
+    "90": "Halifax",
+    "91": "Montreal",
+    "92": "Ottawa",
+    "93": "Quebec City",
+    "94": "Toronto",
+    "95": "Vancouver",
+}
+
+SIGN_IN_PATH = "/en-ca/niv/users/sign_in"
+GROUPS_PATH = "/en-ca/niv/groups/1"
+CONTINUE_PATH = "/en-ca/niv/schedule/1/continue_actions"
+APPOINTMENT_PATH = "/en-ca/niv/schedule/1/appointment"
+DAYS_JSON_REGEX = re.compile(rf"^{APPOINTMENT_PATH}/days/(\d+)\.json$")
+TIMES_JSON_REGEX = re.compile(rf"^{APPOINTMENT_PATH}/times/(\d+)\.json$")
+NTFY_REGEX = re.compile(r"^/ntfy/([^/]+)$")
+
+SESSION_COOKIE = "_yatri_session"
+SLOT_TIMES = ["08:00", "08:15", "09:30", "10:45", "13:00", "14:15"]
+# Every facility keeps at least this many dates so empty results only ever
+# come from bans, like on the real site
+MIN_DATES = 3
+
+
+@dataclass
+class StandInConfig:
+    # Seconds added to every days and times JSON response, +-50%
+    latency: float = 0.2
+    # Average seconds between availability changes at each facility
+    churn_interval: float = 30.0
+    # Share of appearing dates that land in the preferred window
+    preferred_share: float = 0.1
+    # Days from today covered by the preferred window, inclusive
+    preferred_window: tuple[int, int] = (7, 21)
+    # Dates are offered up to this many days out
+    horizon_days: int = 365
+    initial_dates: int = 30
+    # Seconds a sign in stays valid before days JSON starts returning 401
+    session_ttl: float = 60 * 60
+    # Share of days JSON requests that get a 503
+    unavailable_rate: float = 0.0
+    # More days JSON requests than this within a minute gets a temp ban, where
+    # every facility comes back empty. 0 disables bans.
+    ban_after_requests: int = 0
+    ban_duration: float = 10 * 60
+    seed: Optional[int] = None
+
+
+@dataclass
+class Booking:
+    facility_id: str
+    date: str
+    time: str
+    booked_at: float
+    # When the booked date last appeared, None if it was there from the start
+    appeared_at: Optional[float]
+
+
+@dataclass
+class Notification:
+    topic: str
+    title: str
+    body: str
+    received_at: float
+
+
+@dataclass
+class _Facility:
+    name: str
+    dates: set[str] = field(default_factory=set)
+    version: int = 0
+
+
+class StandInSite:
+    """
+    State of the stand-in site. Times are `time.monotonic()` so whoever runs it
+    in the same process can compare them with their own.
+    """
+
+    def __init__(
+        self,
+        config: StandInConfig = StandInConfig(),
+        facilities: dict[str, str] = DEFAULT_FACILITIES,
+    ):
+        self.config = config
+        self._random = random.Random(config.seed)
+        self._lock = threading.Lock()
+        self._today = datetime.date.today()
+
+        self._facilities = {
+            facility_id: _Facility(name=name)
+            for facility_id, name in facilities.items()
+        }
+        for facility in self._facilities.values():
+            while len(facility.dates) < config.initial_dates:
+                facility.dates.add(self._random_date(preferred=False))
+
+        # (facility_id, date) -> when it last appeared
+        self.appeared_at: dict[tuple[str, str], float] = {}
+        self.bookings: list[Booking] = []
+        self.notifications: list[Notification] = []
+        self.requests = Counter()
+        self.churn_events = 0
+
+        # session token -> when it was signed in
+        self._sessions: dict[str, float] = {}
+        self._recent_days_requests: deque[float] = deque()
+        self._banned_until = 0.0
+
+        self._stop = threading.Event()
+        self._churn_thread: Optional[threading.Thread] = None
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._server_thread: Optional[threading.Thread] = None
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Serve the site from background threads and return its base url.
+        """
+        handler = type("_BoundHandler", (_Handler,), {"site": self})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+
+        self._server_thread = threading.Thread(
+            target=self._server.serve_forever, name="standin-http", daemon=True
+        )
+        self._churn_thread = threading.Thread(
+            target=self._churn, name="standin-churn", daemon=True
+        )
+        self._server_thread.start()
+        self._churn_thread.start()
+
+        return f"http://{host}:{self._server.server_address[1]}"
+
+    def stop(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def sign_in(self) -> str:
+        token = secrets.token_hex(16)
+        with self._lock:
+            self._sessions[token] = time.monotonic()
+        return token
+
+    def is_signed_in(self, token: Optional[str]) -> bool:
+        with self._lock:
+            signed_in_at = self._sessions.get(token)
+        return (
+            signed_in_at is not None
+            and time.monotonic() - signed_in_at < self.config.session_ttl
+        )
+
+    def has_facility(self, facility_id: str) -> bool:
+        return facility_id in self._facilities
+
+    def facility_options(self) -> list[tuple[str, str]]:
+        return [(id, facility.name) for id, facility in self._facilities.items()]
+
+    def days(self, facility_id: str) -> tuple[int, list[str]]:
+        """
+        Available dates for a facility along with its version for the ETag.
+        Applies the ban rules since every days JSON request counts towards them.
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            if self.config.ban_after_requests:
+                self._recent_days_requests.append(now)
+                while self._recent_days_requests[0] < now - 60:
+                    self._recent_days_requests.popleft()
+
+                if (
+                    now >= self._banned_until
+                    and len(self._recent_days_requests) > self.config.ban_after_requests
+                ):
+                    logging.info("Stand-in site temp banning the checker")
+                    self._banned_until = now + self.config.ban_duration
+
+            facility = self._facilities[facility_id]
+            if now < self._banned_until:
+                return -1, []
+
+            return facility.version, sorted(facility.dates)
+
+    def times(self, facility_id: str, date: str) -> list[str]:
+        with self._lock:
+            if date not in self._facilities[facility_id].dates:
+                return []
+
+        # Stable per date so the form and the times JSON agree
+        return sorted(random.Random(f"{facility_id}-{date}").sample(SLOT_TIMES, 3))
+
+    def book(self, facility_id: str, date: str, slot: str) -> bool:
+        if not self.has_facility(facility_id) or slot not in self.times(
+            facility_id, date
+        ):
+            return False
+
+        with self._lock:
+            facility = self._facilities[facility_id]
+            facility.dates.discard(date)
+            facility.version += 1
+            self.bookings.append(
+                Booking(
+                    facility_id=facility_id,
+                    date=date,
+                    time=slot,
+                    booked_at=time.monotonic(),
+                    appeared_at=self.appeared_at.get((facility_id, date)),
+                )
+            )
+
+        return True
+
+    def notify(self, topic: str, title: str, body: str):
+        with self._lock:
+            self.notifications.append(
+                Notification(
+                    topic=topic, title=title, body=body, received_at=time.monotonic()
+                )
+            )
+
+    def count_request(self, kind: str):
+        with self._lock:
+            self.requests[kind] += 1
+
+    def _random_date(self, preferred: bool) -> str:
+        if preferred:
+            offset = self._random.randint(*self.config.preferred_window)
+        else:
+            offset = self._random.randint(
+                self.config.preferred_window[1] + 1, self.config.horizon_days
+            )
+
+        return (self._today + datetime.timedelta(days=offset)).isoformat()
+
+    def _churn(self):
+        tick = 0.5
+
+        while not self._stop.wait(tick):
+            with self._lock:
+                for facility_id, facility in self._facilities.items():
+                    if self._random.random() >= tick / self.config.churn_interval:
+                        continue
+
+                    if len(facility.dates) > MIN_DATES and self._random.random() < 0.5:
+                        facility.dates.discard(
+                            self._random.choice(sorted(facility.dates))
+                        )
+                    else:
+                        date = self._random_date(
+                            self._random.random() < self.config.preferred_share
+                        )
+                        if date in facility.dates:
+                            continue
+                        facility.dates.add(date)
+                        self.appeared_at[(facility_id, date)] = time.monotonic()
+
+                    facility.version += 1
+                    self.churn_events += 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    site: StandInSite
+
+    def log_message(self, format, *args):
+        logging.debug(f"Stand-in site - {format % args}")
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+
+        if url.path == SIGN_IN_PATH:
+            self.site.count_request("sign_in_page")
+            return self._send_html(_SIGN_IN_HTML)
+
+        if not self.site.is_signed_in(self._session_token()):
+            if DAYS_JSON_REGEX.match(url.path) or TIMES_JSON_REGEX.match(url.path):
+                self.site.count_request("401")
+                return self._send(401, "application/json", b'{"error": "expired"}')
+
+            return self._redirect(SIGN_IN_PATH)
+
+        if url.path == GROUPS_PATH:
+            return self._send_html(_GROUPS_HTML)
+
+        if url.path == CONTINUE_PATH:
+            return self._send_html(_CONTINUE_HTML)
+
+        if url.path == APPOINTMENT_PATH:
+            self.site.count_request("appointment_page")
+            return self._send_html(_appointment_html(self.site.facility_options()))
+
+        match = DAYS_JSON_REGEX.match(url.path)
+        if match:
+            return self._send_days(match.group(1))
+
+        match = TIMES_JSON_REGEX.match(url.path)
+        if match and self.site.has_facility(match.group(1)):
+            self._sleep_latency()
+            self.site.count_request("times")
+            date = parse_qs(url.query).get("date", [""])[0]
+            times = self.site.times(match.group(1), date)
+            return self._send_json({"available_times": times, "business_times": times})
+
+        self._send(404, "text/plain", b"Not found")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        match = NTFY_REGEX.match(url.path)
+        if match:
+            self.site.notify(
+                match.group(1), self.headers.get("Title", ""), body.decode("utf-8")
+            )
+            return self._send_json({"id": secrets.token_hex(6)})
+
+        if url.path == SIGN_IN_PATH:
+            self.site.count_request("sign_in")
+            token = self.site.sign_in()
+            self.send_response(302)
+            self.send_header("Location", GROUPS_PATH)
+            self.send_header(
+                "Set-Cookie", f"{SESSION_COOKIE}={token}; Path=/; HttpOnly"
+            )
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if url.path == APPOINTMENT_PATH and self.site.is_signed_in(
+            self._session_token()
+        ):
+            form = parse_qs(body.decode("utf-8"))
+            booked = self.site.book(
+                form.get("appointments[consulate_appointment][facility_id]", [""])[0],
+                form.get("appointments[consulate_appointment][date]", [""])[0],
+                form.get("appointments[consulate_appointment][time]", [""])[0],
+            )
+            self.site.count_request("booked" if booked else "booking_rejected")
+
+            if booked:
+                return self._send_html(_BOOKED_HTML)
+            return self._send_html(_appointment_html(self.site.facility_options()))
+
+        self._redirect(SIGN_IN_PATH)
+
+    def _send_days(self, facility_id: str):
+        if not self.site.has_facility(facility_id):
+            return self._send(404, "application/json", b"[]")
+
+        self._sleep_latency()
+
+        if random.random() < self.site.config.unavailable_rate:
+            self.site.count_request("503")
+            return self._send(503, "text/html", b"Service Unavailable")
+
+        version, dates = self.site.days(facility_id)
+        etag = f'"{facility_id}-{version}"'
+
+        if version >= 0 and self.headers.get("If-None-Match") == etag:
+            self.site.count_request("304")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.site.count_request("days")
+        body = json.dumps(
+            [{"date": date, "business_day": True} for date in dates]
+        ).encode("utf-8")
+        self._send(200, "application/json", body, {"ETag": etag})
+
+    def _sleep_latency(self):
+        if self.site.config.latency:
+            time.sleep(self.site.config.latency * random.uniform(0.5, 1.5))
+
+    def _session_token(self) -> Optional[str]:
+        for cookie in self.headers.get("Cookie", "").split(";"):
+            name, _, value = cookie.strip().partition("=")
+            if name == SESSION_COOKIE:
+                return value
+        return None
+
+    def _redirect(self, location: str):
+        self.send_response(302)
+        self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _send_html(self, page: str):
+        self._send(200, "text/html; charset=utf-8", page.encode("utf-8"))
+
+    def _send_json(self, data):
+        self._send(200, "application/json", json.dumps(data).encode("utf-8"))
+
+    def _send(self, status: int, content_type: str, body: bytes, headers: dict = {}):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+_SIGN_IN_HTML = f"""<!DOCTYPE html>
+<html><body>
+<form method="post" action="{SIGN_IN_PATH}">
+  <input type="email" id="user_email" name="user[email]">
+  <input type="password" id="user_password" name="user[password]">
+  <input type="checkbox" id="policy_confirmed" name="policy_confirmed">
+  <input type="submit" value="Sign In">
+</form>
+</body></html>
+"""
+
+_GROUPS_HTML = f"""<!DOCTYPE html>
+<html><body><a href="{CONTINUE_PATH}">Continue</a></body></html>
+"""
+
+_CONTINUE_HTML = f"""<!DOCTYPE html>
+<html><body>
+<h5>Reschedule Appointment</h5>
+<a href="{APPOINTMENT_PATH}">Reschedule Appointment</a>
+</body></html>
+"""
+
+_BOOKED_HTML = """<!DOCTYPE html>
+<html><body><p>Successfully Scheduled</p></body></html>
+"""
+
+
+def _appointment_html(facilities: list[tuple[str, str]]) -> str:
+    options = "".join(
+        f'<option value="{id}">{html.escape(name)}</option>' for id, name in facilities
+    )
+
+    return f"""<!DOCTYPE html>
+<html><head><meta name="csrf-token" content="{secrets.token_hex(16)}"></head>
+<body>
+<form id="appointment_form" method="post" action="{APPOINTMENT_PATH}">
+  <select id="appointments_consulate_appointment_facility_id"
+      name="appointments[consulate_appointment][facility_id]">
+    <option value=""></option>{options}
+  </select>
+  <input type="hidden" id="appointments_consulate_appointment_date"
+      name="appointments[consulate_appointment][date]">
+  <input type="text" id="appointments_consulate_appointment_date_input" readonly>
+  <select id="appointments_consulate_appointment_time"
+      name="appointments[consulate_appointment][time]">
+    <option value=""></option>
+  </select>
+  <input type="button" id="reschedule" value="Reschedule">
+  <div id="confirm" style="display: none"><a href="#">Confirm</a></div>
+</form>
+<script>
+  const base = "{APPOINTMENT_PATH}";
+  const csrf = document.querySelector('meta[name="csrf-token"]').content;
+  const headers = {{
+    "X-CSRF-Token": csrf,
+    "X-Requested-With": "XMLHttpRequest",
+    "Accept": "application/json, text/javascript, */*; q=0.01",
+  }};
+  const facility = document.getElementById(
+    "appointments_consulate_appointment_facility_id"
+  );
+  const date = document.getElementById("appointments_consulate_appointment_date");
+  const time = document.getElementById("appointments_consulate_appointment_time");
+
+  facility.addEventListener("change", () => fetch(
+    `${{base}}/days/${{facility.value}}.json?appointments[expedite]=false`,
+    {{ headers }}
+  ));
+  date.addEventListener("change", async () => {{
+    const response = await fetch(
+      `${{base}}/times/${{facility.value}}.json?date=${{date.value}}` +
+        "&appointments[expedite]=false",
+      {{ headers }}
+    );
+    const slots = (await response.json()).available_times;
+    time.innerHTML = '<option value=""></option>' + slots.map(
+      slot => `<option value="${{slot}}">${{slot}}</option>`
+    ).join("");
+  }});
+  document.getElementById("reschedule").addEventListener("click", () => {{
+    document.getElementById("confirm").style.display = "block";
+  }});
+  document.querySelector("#confirm a").addEventListener("click", event => {{
+    event.preventDefault();
+    document.getElementById("appointment_form").submit();
+  }});
+</script>
+</body></html>
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=StandInConfig.latency)
+    parser.add_argument(
+        "--churn-interval", type=float, default=StandInConfig.churn_interval
+    )
+    parser.add_argument("--session-ttl", type=float, default=StandInConfig.session_ttl)
+    parser.add_argument(
+        "--unavailable-rate", type=float, default=StandInConfig.unavailable_rate
+    )
+    parser.add_argument(
+        "--ban-after-requests", type=int, default=StandInConfig.ban_after_requests
+    )
+    parser.add_argument(
+        "--ban-duration", type=float, default=StandInConfig.ban_duration
+    )
+    parser.add_argument("--seed", type=int)
+    return parser.parse_args()
+
+
+def config_from_args(args) -> StandInConfig:
+    return StandInConfig(
+        latency=args.latency,
+        churn_interval=args.churn_interval,
+        session_ttl=args.session_ttl,
+        unavailable_rate=args.unavailable_rate,
+        ban_after_requests=args.ban_after_requests,
+        ban_duration=args.ban_duration,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-1s: %(message)s",
+        level=logging.INFO,
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+    site = StandInSite(config_from_args(args))
+    logging.info(f"Stand-in site running at {site.start(args.host, args.port)}")
+
+    try:
+        while True:
+            time.sleep(60)
+            logging.info(f"Requests so far: {dict(site.requests)}")
+    except KeyboardInterrupt:
+        site.stop()
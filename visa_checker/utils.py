@@ -1,16 +1,19 @@
 import datetime
 import logging
 import time
+from typing import Optional
 
-from config import CITIES, City
+from config import CITIES, PREFERRED_DATE_RULES, City
 from repo import (
     get_current_appointment_date,
-    get_last_known_dates,
     record_new_dates,
     update_appointment_date,
 )
+from event_log import CheckEvent, emit
+from metrics import CHECK_STAGE_SECONDS, DAYS_RESPONSES
 from notify import send_notification
-from date_utils import get_weekday, date_str_to_datetime, is_preferred_date
+from date_utils import Availability, date_str_to_datetime, get_weekday
+from rules import PreferredDateRules
 from page import (
     VisaPageWrapper,
     UnauthorizedError,
@@ -24,81 +27,123 @@ class AvailabilityCheckError(Exception):
     pass
 
 
-def process_availability_for_city(city_id: str, current_dates: set[str]):
+# Compiled once at startup so a bad rule config fails right away
+_preferred_date_rules = PreferredDateRules(PREFERRED_DATE_RULES)
+
+
+def process_availability_for_city(city_id: str, current_dates: Availability):
     """
-    Process current availability for a city by sending out notifications
-    if new dates are detected and storing availability in the db.
+    Process current availability for a city by storing availability in the db
+    and sending out notifications if new dates are detected. The notification
+    covers the dates this call recorded, so in cluster mode only the node that
+    records a new date notifies about it.
     """
 
     city = CITIES[city_id]
     logging.info(f"Updating {city.name} with new dates.")
+    start_time = time.monotonic()
 
-    new_dates = current_dates - get_last_known_dates(city)
+    new_dates = record_new_dates(city, current_dates)
 
     if new_dates:
         title = f"New Visa Appointment Dates ({city.name})"
-        formatted_dates = [f"{d} ({get_weekday(d)})" for d in sorted(list(new_dates))]
+        formatted_dates = [f"{d} ({get_weekday(d)})" for d in new_dates]
         msg = "\n".join(formatted_dates)
 
         send_notification(title=title, msg=msg)
-        send_notification(title=title, msg='test message')
-        logging.info(f"Sent notification - {title} - {msg}")
+        logging.info(f"Queued notification - {title} - {msg}")
         logging.info(title)
         logging.info(msg)
     else:
         logging.info(f"No new dates for {city.name}")
 
-    record_new_dates(city, current_dates)
+    CHECK_STAGE_SECONDS.observe(time.monotonic() - start_time, "process")
+
+
+def process_unsolicited_availability(page_wrapper: VisaPageWrapper):
+    """
+    Process availability that the page picked up for cities other than the one
+    being checked. It cost no extra requests so there's no reason to throw it away.
+    """
+
+    for city_id, current_dates in page_wrapper.pop_unsolicited_dates().items():
+        process_availability_for_city(city_id, current_dates)
+
 
+def note_check_error(page_wrapper, e: Exception) -> float:
+    """
+    Update the page wrapper's session state for an error raised while fetching
+    dates.
+
+    :return float - seconds the caller should back off before its next request
+    """
+
+    if isinstance(e, UnauthorizedError):
+        page_wrapper.logged_in = False
+        logging.info("Received Unauthorized. Setting LOGGED_IN to False")
+    elif isinstance(e, TempBannedError):
+        page_wrapper.last_temp_banned_time = datetime.datetime.now()
+        logging.info(
+            f"Temp Banned. Setting TEMP_BAN to {page_wrapper.last_temp_banned_time}."
+        )
+    elif isinstance(e, ServiceUnavailableError):
+        logging.info("Waiting 30 minutes because service is unavailable.")
+        return 30 * 60
+    elif isinstance(e, NoResponseError):
+        DAYS_RESPONSES.inc("no_response")
+        logging.info("No matching JSON response found. Adding job back to queue.")
+
+    return 0
 
-def check_availability_for_city(page_wrapper: VisaPageWrapper, city: City):
+
+def find_preferred_dates(city: City, current_dates: Availability) -> list[str]:
+    """
+    Return the dates in `current_dates` that are preferred over our current
+    appointment slot, earliest first.
+    """
+
+    return list(
+        _preferred_date_rules.preferred_dates(
+            city.id, current_dates, get_current_appointment_date()
+        )
+    )
+
+
+def check_availability_for_city(
+    page_wrapper: VisaPageWrapper, city: City
+) -> Optional[Availability]:
     """
     Fetch the current availability for a given city and execute any necessary
     follow ups with the new dates.
+
+    :return None - NotModified
+            Availability - Available dates for the city
     """
 
+    start_time = time.monotonic()
     try:
         current_dates = page_wrapper.get_available_dates_for_city(city)
-        print(f'{city} dates - {current_dates}')
     except (
         UnauthorizedError,
         TempBannedError,
         ServiceUnavailableError,
         NoResponseError,
     ) as e:
-        if isinstance(e, UnauthorizedError):
-            page_wrapper.logged_in = False
-            logging.info("Received Unauthorized. Setting LOGGED_IN to False")
-        elif isinstance(e, TempBannedError):
-            page_wrapper.last_temp_banned_time = datetime.datetime.now()
-            logging.info(
-                f"Temp Banned. Setting TEMP_BAN to {page_wrapper.last_temp_banned_time}."
-            )
-        elif isinstance(e, ServiceUnavailableError):
-            logging.info("Waiting 30 minutes because service is unavailable.")
-            time.sleep(30 * 60)
-        elif isinstance(e, NoResponseError):
-            logging.info("No matching JSON response found. Adding job back to queue.")
-
+        emit(CheckEvent(city.id, type(e).__name__, time.monotonic() - start_time))
+        time.sleep(note_check_error(page_wrapper, e))
         raise AvailabilityCheckError()
 
+    emit(CheckEvent.of(city.id, current_dates, time.monotonic() - start_time))
+
     if current_dates is None:
         logging.info(f"304 - No new dates for {city.name}")
-        return
+        return None
 
     process_availability_for_city(city.id, current_dates)
 
     # Check if any of the current_dates are preferred over our current
     # appointment slot. If so, reschedule to one of those dates.
-    preferred_dates = sorted(
-        [
-            date
-            for date in current_dates
-            if is_preferred_date(
-                date_str_to_datetime(date), get_current_appointment_date()
-            )
-        ]
-    )
+    preferred_dates = find_preferred_dates(city, current_dates)
 
     if preferred_dates:
         logging.info(f"Found preferred dates - {', '.join(preferred_dates)}")
@@ -108,17 +153,24 @@ def check_availability_for_city(page_wrapper: VisaPageWrapper, city: City):
         msg = f"Rescheduling to {new_date}"
         logging.info(msg)
         send_notification(
-            title=f"Found preferrable appointment date - {city.name}", msg=msg
+            title=f"Found preferrable appointment date - {city.name}",
+            msg=msg,
+            urgent=True,
         )
 
         logging.info(f"Running rescheduler for preferred date - {new_date}")
-        page_wrapper.reschedule_appointment(
+        booked = page_wrapper.reschedule_appointment(
             year=new_date.year,
             month=new_date.month,
             day=new_date.day,
+            city=city,
         )
-        update_appointment_date(
-            datetime.datetime(
-                month=new_date.month, day=new_date.day, year=new_date.year
+
+        if booked:
+            update_appointment_date(
+                datetime.datetime(
+                    month=new_date.month, day=new_date.day, year=new_date.year
+                )
             )
-        )
+
+    return current_dates
@@ -0,0 +1,272 @@
+import atexit
+import datetime
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+from config import CITIES, City
+from metrics import WORK_QUEUE_WAIT_SECONDS
+from repo import (
+    delete_work_queue_entry,
+    get_work_queue_entries,
+    save_work_queue_entry,
+)
+
+# Failed checks go back in behind every scheduled check
+PRIORITY_RETRY = -1.0
+
+# How many recent wait times are kept for stats
+_RECENT_WAITS = 1000
+
+
+@dataclass
+class _Entry:
+    city: City
+    priority: float
+    # time.monotonic() at which the check becomes due
+    due: float
+    enqueued_at: float
+    # Entries are replaced rather than updated in place. Heap items from older
+    # versions of an entry are skipped when they come up.
+    version: int
+
+
+class WorkQueue:
+    """
+    Queue of city checks for the workers. Each city is in it at most once, so
+    re-adding a city that's already waiting only moves it up if the new entry
+    is due sooner or has a higher priority.
+
+    Checks are handed out once they're due, highest priority first and then in
+    the order they became due. Adding and taking a check are O(log n) in the
+    number of queued checks, which is at most one per city.
+
+    With `persist`, entries are also kept in the db so a restart carries on
+    where it stopped. A single writer thread applies the changes in the order
+    they were made, so the workers never wait on the db.
+
+    Thread-safe so it can be shared by every worker.
+    """
+
+    def __init__(self, persist: bool = False):
+        self.persist = persist
+        # (func, args) db writes for the writer thread
+        self._writes: queue.Queue[tuple] = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+
+        self._condition = threading.Condition()
+        self._entries: dict[str, _Entry] = {}
+        # (due, seq, city_id, version) for entries that aren't due yet
+        self._waiting: list[tuple] = []
+        # (-priority, due, seq, city_id, version) for entries that are due
+        self._ready: list[tuple] = []
+        self._seq = itertools.count()
+        self._versions = itertools.count()
+
+        self._puts = 0
+        self._deduplicated = 0
+        self._gets = 0
+        self._recent_waits: deque[float] = deque(maxlen=_RECENT_WAITS)
+
+    def put(self, city: City, priority: float = 0.0, delay: float = 0.0) -> bool:
+        """
+        Queue a check of `city` that becomes due in `delay` seconds.
+
+        :return bool - False if the city was already queued at least as soon and
+            with at least as high a priority, in which case nothing changes
+        """
+        now = time.monotonic()
+        due = now + delay
+
+        with self._condition:
+            self._puts += 1
+            existing = self._entries.get(city.id)
+
+            if existing is not None:
+                if existing.due <= due and existing.priority >= priority:
+                    self._deduplicated += 1
+                    return False
+
+                # Keep the best of both
+                due = min(due, existing.due)
+                priority = max(priority, existing.priority)
+
+            entry = _Entry(
+                city=city,
+                priority=priority,
+                due=due,
+                enqueued_at=existing.enqueued_at if existing else now,
+                version=next(self._versions),
+            )
+            self._entries[city.id] = entry
+            heapq.heappush(
+                self._waiting, (entry.due, next(self._seq), city.id, entry.version)
+            )
+            self._condition.notify()
+
+            if self.persist:
+                self._write(
+                    save_work_queue_entry,
+                    city.id,
+                    entry.priority,
+                    _to_datetime(entry.due),
+                    _to_datetime(entry.enqueued_at),
+                )
+
+        return True
+
+    def get(self, timeout: Optional[float] = None) -> Optional[City]:
+        """
+        Take the next due check, waiting up to `timeout` seconds for one.
+
+        :return None - if nothing became due in time
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._condition:
+            while True:
+                city = self._pop_ready()
+                if city is not None:
+                    if self.persist:
+                        self._write(delete_work_queue_entry, city.id)
+                    return city
+
+                now = time.monotonic()
+                wait = None if deadline is None else deadline - now
+                if wait is not None and wait <= 0:
+                    return None
+
+                # Wake up for the next entry to become due if that's sooner
+                if self._waiting:
+                    next_due = self._waiting[0][0] - now
+                    wait = next_due if wait is None else min(wait, next_due)
+
+                self._condition.wait(wait)
+
+    def get_nowait(self) -> Optional[City]:
+        return self.get(timeout=0)
+
+    def flush(self, timeout: float = 10):
+        """
+        Wait up to `timeout` seconds for queued db writes to finish.
+        """
+        deadline = time.monotonic() + timeout
+        while self._writes.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def restore(self):
+        """
+        Load the entries persisted by a previous run.
+        """
+        restored = 0
+        now = datetime.datetime.now()
+
+        for city_id, priority, due_at, enqueued_at in get_work_queue_entries():
+            city = CITIES.get(city_id)
+            if city is None:
+                delete_work_queue_entry(city_id)
+                continue
+
+            self.put(city, priority, max(0.0, (due_at - now).total_seconds()))
+            restored += 1
+
+        logging.info(f"Restored {restored} work queue entries")
+
+    def stats(self) -> dict:
+        """
+        Queue depth and how long checks have been waiting, for logs and metrics.
+        """
+        now = time.monotonic()
+
+        with self._condition:
+            self._promote(now)
+            waits = sorted(self._recent_waits)
+
+            return {
+                "depth": len(self._entries),
+                "ready": len(self._entries)
+                - sum(1 for e in self._entries.values() if e.due > now),
+                "oldest_ready_wait": max(
+                    (now - e.due for e in self._entries.values() if e.due <= now),
+                    default=0.0,
+                ),
+                "wait_samples": len(waits),
+                "wait_p50": waits[len(waits) // 2] if waits else None,
+                "wait_p90": waits[int(len(waits) * 0.9)] if waits else None,
+                "wait_max": waits[-1] if waits else None,
+                "puts": self._puts,
+                "deduplicated": self._deduplicated,
+                "gets": self._gets,
+            }
+
+    def __len__(self) -> int:
+        with self._condition:
+            return len(self._entries)
+
+    def __contains__(self, city: City) -> bool:
+        with self._condition:
+            return city.id in self._entries
+
+    def _write(self, func, *args):
+        # Expects self._condition to be held, which keeps writes in order
+        if self._writer is None:
+            self._writer = threading.Thread(
+                target=self._run_writes, name="work-queue-writer", daemon=True
+            )
+            self._writer.start()
+            atexit.register(self.flush)
+
+        self._writes.put((func, args))
+
+    def _run_writes(self):
+        while True:
+            func, args = self._writes.get()
+            try:
+                func(*args)
+            except Exception as e:
+                logging.warning(f"Failed to persist work queue entry {args[0]} - {e}")
+            finally:
+                self._writes.task_done()
+
+    def _promote(self, now: float):
+        # Expects self._condition to be held
+        while self._waiting and self._waiting[0][0] <= now:
+            due, seq, city_id, version = heapq.heappop(self._waiting)
+            entry = self._entries.get(city_id)
+
+            if entry is not None and entry.version == version:
+                heapq.heappush(
+                    self._ready, (-entry.priority, due, seq, city_id, version)
+                )
+
+    def _pop_ready(self) -> Optional[City]:
+        # Expects self._condition to be held
+        now = time.monotonic()
+        self._promote(now)
+
+        while self._ready:
+            _, due, _, city_id, version = heapq.heappop(self._ready)
+            entry = self._entries.get(city_id)
+
+            if entry is None or entry.version != version:
+                continue
+
+            del self._entries[city_id]
+            self._gets += 1
+            self._recent_waits.append(now - due)
+            WORK_QUEUE_WAIT_SECONDS.observe(now - due)
+            return entry.city
+
+        return None
+
+
+def _to_datetime(monotonic_time: float) -> datetime.datetime:
+    return datetime.datetime.now() + datetime.timedelta(
+        seconds=monotonic_time - time.monotonic()
+    )